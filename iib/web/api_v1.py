@@ -1,18 +1,17 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import copy
+import json
 import os
+import time
 from datetime import datetime
 
 import flask
-import kombu
 from flask_login import current_user, login_required
-from sqlalchemy.orm import with_polymorphic
 from sqlalchemy.sql import text
-from werkzeug.exceptions import Forbidden, Gone, NotFound
+from werkzeug.exceptions import Forbidden, Gone, NotFound, RequestedRangeNotSatisfiable
 
 from iib.exceptions import IIBError, ValidationError
 from iib.web import db, messaging
-from iib.web.errors import handle_broker_error, handle_broker_batch_error
 from iib.web.models import (
     Architecture,
     Batch,
@@ -27,18 +26,32 @@ from iib.web.models import (
     RequestStateMapping,
     get_request_query_options,
     RequestTypeMapping,
+    reserve_primary_keys,
+)
+from iib.web.outbox import add_task_to_outbox
+from iib.web.utils import (
+    gzip_chunks,
+    is_privileged_user,
+    is_worker_user,
+    iter_file_chunks,
+    paginate_by_id,
+    pagination_metadata,
+    str_to_bool,
 )
-from iib.web.utils import pagination_metadata, str_to_bool
 from iib.workers.tasks.build import (
     handle_add_request,
     handle_regenerate_bundle_request,
     handle_rm_request,
 )
 from iib.workers.tasks.build_merge_index_image import handle_merge_request
-from iib.workers.tasks.general import failed_request_callback
 
 api_v1 = flask.Blueprint('api_v1', __name__)
 
+# The maximum number of bytes of logs read at a time when following the logs of a request
+_LOGS_FOLLOW_CHUNK_SIZE = 1024 * 1024
+# The number of seconds without any logs after which a keepalive comment is sent to the client
+_LOGS_FOLLOW_KEEPALIVE_INTERVAL = 15
+
 
 def _get_rm_args(payload, request, overwrite_from_index):
     """
@@ -140,14 +153,59 @@ def get_build(request_id):
     """
     Retrieve the build request.
 
+    The JSON of requests in a final state is cached in the database, so that it doesn't need to be
+    generated from the request relationships each time. The response has an entity tag so that
+    clients can revalidate it with the ``If-None-Match`` header.
+
     :param int request_id: the request ID that was passed in through the URL.
     :rtype: flask.Response
     :raise NotFound: if the request is not found
     """
-    # Create an alias class to load the polymorphic classes
-    poly_request = with_polymorphic(Request, '*')
-    query = poly_request.query.options(*get_request_query_options(verbose=True))
-    return flask.jsonify(query.get_or_404(request_id).to_json())
+    row = (
+        db.session.query(Request.serialized_json, RequestState.updated)
+        .outerjoin(Request.state)
+        .filter(Request.id == request_id)
+        .first()
+    )
+    if row is None:
+        raise NotFound()
+
+    serialized_json, state_updated = row
+    if serialized_json:
+        rv = json.loads(serialized_json)
+        if flask.current_app.config['IIB_REQUEST_LOGS_DIR']:
+            rv['logs'] = Request.get_logs_json(request_id, state_updated)
+    else:
+        query = Request.query.options(*get_request_query_options(verbose=True))
+        request = query.get_or_404(request_id)
+        rv = request.to_json()
+        if rv['state'] in RequestStateMapping.get_final_states():
+            _cache_request_json(request, rv)
+
+    response = flask.jsonify(rv)
+    response.add_etag()
+    # Make clients revalidate the response since the request may still be modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(flask.request)
+
+
+def _cache_request_json(request, rv):
+    """
+    Cache the verbose JSON of the request in a final state.
+
+    The logs are not cached since their URL depends on the host of the API request and their
+    expiration depends on the configuration.
+
+    :param Request request: the request to cache the JSON of
+    :param dict rv: the verbose JSON of the request
+    """
+    serialized_json = json.dumps({k: v for k, v in rv.items() if k != 'logs'}, sort_keys=True)
+    # Only cache the JSON if the state of the request didn't change since it was loaded, so that the
+    # JSON of an outdated request doesn't replace the cached JSON that was reset by a patch
+    Request.query.filter(
+        Request.id == request.id, Request.request_state_id == request.request_state_id
+    ).update({Request.serialized_json: serialized_json}, synchronize_session=False)
+    db.session.commit()
 
 
 @api_v1.route('/builds/<int:request_id>/logs')
@@ -155,6 +213,9 @@ def get_build_logs(request_id):
     """
     Retrieve the logs for the build request.
 
+    If the ``follow`` query parameter is ``true``, the logs are streamed as Server-Sent Events as
+    they are written. See ``_follow_logs`` for details.
+
     :param int request_id: the request ID that was passed in through the URL.
     :rtype: flask.Response
     :raise NotFound: if the request is not found or there are no logs for the request
@@ -166,6 +227,7 @@ def get_build_logs(request_id):
 
     request = Request.query.get_or_404(request_id)
     log_file_path = os.path.join(request_log_dir, f'{request_id}.log')
+    follow = str_to_bool(flask.request.args.get('follow'))
     if not os.path.exists(log_file_path):
         expired = request.logs_expiration < datetime.utcnow()
         if expired:
@@ -173,11 +235,232 @@ def get_build_logs(request_id):
         finalized = request.state.state_name in RequestStateMapping.get_final_states()
         if finalized:
             raise NotFound()
-        # The request may not have been initiated yet. Return empty logs until it's processed.
-        return flask.Response('', mimetype='text/plain')
+        if not follow:
+            # The request may not have been initiated yet. Return empty logs until it's processed.
+            return flask.Response('', mimetype='text/plain')
+
+    if follow:
+        return _follow_logs(request_id, log_file_path)
+
+    stat = os.stat(log_file_path)
+    # The log file is only ever appended to, so only the bytes present now are sent. This keeps the
+    # response consistent with its headers while the request is still being processed.
+    size = stat.st_size
+    start = _get_logs_start(size)
+    length = size - start
+
+    byte_range = None
+    if flask.request.range and len(flask.request.range.ranges) == 1:
+        if_range = flask.request.if_range
+        if not (if_range.etag or if_range.date) or if_range.etag == _get_logs_etag(stat, start):
+            byte_range = flask.request.range.range_for_length(length)
+            if byte_range is None:
+                raise RequestedRangeNotSatisfiable(length=length)
+
+    # Partial content is never compressed since the range refers to the uncompressed logs
+    compress = byte_range is None and length > 0 and flask.request.accept_encodings['gzip'] > 0
+    etag = _get_logs_etag(stat, start, 'gzip' if compress else None)
+    headers = {'Accept-Ranges': 'bytes', 'Vary': 'Accept-Encoding', 'X-IIB-Log-Size': size}
+    if flask.request.if_none_match.contains_weak(etag):
+        rv = flask.Response(status=304, headers=headers)
+    elif byte_range:
+        range_start, range_stop = byte_range
+        rv = flask.Response(
+            iter_file_chunks(log_file_path, start + range_start, range_stop - range_start),
+            status=206,
+            mimetype='text/plain',
+            headers=headers,
+            direct_passthrough=True,
+        )
+        rv.headers['Content-Range'] = f'bytes {range_start}-{range_stop - 1}/{length}'
+        rv.content_length = range_stop - range_start
+    elif compress:
+        rv = flask.Response(
+            gzip_chunks(iter_file_chunks(log_file_path, start, length)),
+            mimetype='text/plain',
+            headers=headers,
+            direct_passthrough=True,
+        )
+        rv.content_encoding = 'gzip'
+    else:
+        rv = flask.Response(
+            iter_file_chunks(log_file_path, start, length),
+            mimetype='text/plain',
+            headers=headers,
+            direct_passthrough=True,
+        )
+        rv.content_length = length
+
+    rv.set_etag(etag)
+    # The logs change while the request is processed, so clients must always revalidate them
+    rv.cache_control.no_cache = True
+    return rv
+
+
+def _follow_logs(request_id, log_file_path):
+    """
+    Stream the logs of the request as Server-Sent Events until the request is finalized.
+
+    Each event contains the complete lines appended to the log file since the previous event and
+    its ID is the position in the log file after those lines. This lets ``EventSource`` clients
+    resume from where they stopped when they reconnect since they send the ``Last-Event-ID``
+    header. Once the request reaches a final state, the remaining logs are sent followed by an
+    ``end`` event. The stream is closed after ``IIB_REQUEST_LOGS_FOLLOW_TIMEOUT`` seconds so that
+    an API thread isn't held indefinitely, in which case the client should reconnect.
 
-    with open(log_file_path) as f:
-        return flask.Response(f.read(), mimetype='text/plain')
+    :param int request_id: the ID of the request
+    :param str log_file_path: the path to the log file of the request
+    :rtype: flask.Response
+    :raises ValidationError: if the ``Last-Event-ID`` header or the query parameters are invalid
+    """
+    config = flask.current_app.config
+    interval = config['IIB_REQUEST_LOGS_FOLLOW_INTERVAL']
+    timeout = config['IIB_REQUEST_LOGS_FOLLOW_TIMEOUT']
+    last_event_id = flask.request.headers.get('Last-Event-ID')
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            raise ValidationError('The "Last-Event-ID" header must be a non-negative integer')
+        start = int(last_event_id)
+    else:
+        try:
+            start = _get_logs_start(os.path.getsize(log_file_path))
+        except FileNotFoundError:
+            start = 0
+
+    final_states = RequestStateMapping.get_final_states()
+
+    def _generate():
+        position = start
+        deadline = time.monotonic() + timeout
+        last_sent = time.monotonic()
+        # Tell the client how long to wait before reconnecting if the stream is closed
+        yield f'retry: {int(interval * 1000)}\n\n'
+        while True:
+            finalized = _get_request_state_name(request_id) in final_states
+            # Read everything that is available before waiting again
+            while True:
+                lines, position = _read_log_lines(log_file_path, position, finalized)
+                if not lines:
+                    break
+                data = ''.join(f'data: {line}\n' for line in lines)
+                yield f'id: {position}\n{data}\n'
+                last_sent = time.monotonic()
+
+            if finalized:
+                yield f'id: {position}\nevent: end\ndata: \n\n'
+                return
+
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if now - last_sent >= _LOGS_FOLLOW_KEEPALIVE_INTERVAL:
+                # A comment keeps proxies from closing the connection while no logs are written
+                yield ': keepalive\n\n'
+                last_sent = now
+            time.sleep(interval)
+
+    rv = flask.Response(flask.stream_with_context(_generate()), mimetype='text/event-stream')
+    rv.cache_control.no_cache = True
+    return rv
+
+
+def _get_request_state_name(request_id):
+    """
+    Get the name of the current state of the request from the database.
+
+    :param int request_id: the ID of the request
+    :return: the name of the state
+    :rtype: str
+    """
+    state = (
+        db.session.query(RequestState.state)
+        .join(Request, Request.request_state_id == RequestState.id)
+        .filter(Request.id == request_id)
+        .scalar()
+    )
+    # End the transaction so that the next query sees the latest state and the database connection
+    # isn't held while waiting for more logs
+    db.session.rollback()
+    return RequestStateMapping(state).name
+
+
+def _read_log_lines(log_file_path, position, complete):
+    """
+    Read the complete lines appended to the log file since the position.
+
+    At most ``_LOGS_FOLLOW_CHUNK_SIZE`` bytes are read at a time so that the memory usage is
+    bounded when a client starts following a large log file.
+
+    :param str log_file_path: the path to the log file
+    :param int position: the position in the log file to read from
+    :param bool complete: if ``True``, a final line without a line ending is also read since
+        nothing else will be appended to the log file
+    :return: a tuple of the lines without their line endings and the position after them
+    :rtype: tuple
+    """
+    try:
+        with open(log_file_path, 'rb') as f:
+            f.seek(position)
+            data = f.read(_LOGS_FOLLOW_CHUNK_SIZE)
+    except FileNotFoundError:
+        return [], position
+
+    if not complete:
+        end = data.rfind(b'\n') + 1
+        # A partial line is kept for the next read unless it's too long to ever fit in a chunk
+        if end or len(data) < _LOGS_FOLLOW_CHUNK_SIZE:
+            data = data[:end]
+
+    if not data:
+        return [], position
+    return data.decode('utf-8', errors='replace').splitlines(), position + len(data)
+
+
+def _get_logs_start(size):
+    """
+    Get the position in the log file to start sending the logs from.
+
+    This is determined by the optional ``offset`` and ``tail`` query parameters, which are the
+    number of bytes to skip and the number of bytes to send from the end of the logs respectively.
+
+    :param int size: the size of the log file in bytes
+    :return: the position of the first byte to send
+    :rtype: int
+    :raises ValidationError: if the query parameters are invalid
+    """
+    params = {}
+    for param in ('offset', 'tail'):
+        value = flask.request.args.get(param)
+        if value is None:
+            continue
+        if not value.isdigit():
+            raise ValidationError(f'The "{param}" query parameter must be a non-negative integer')
+        params[param] = int(value)
+
+    if len(params) > 1:
+        raise ValidationError('The "offset" and "tail" query parameters are mutually exclusive')
+
+    if 'tail' in params:
+        return max(size - params['tail'], 0)
+    return min(params.get('offset', 0), size)
+
+
+def _get_logs_etag(stat, start, encoding=None):
+    """
+    Get the ETag of the logs sent from the position in the log file.
+
+    :param os.stat_result stat: the status of the log file
+    :param int start: the position of the first byte sent
+    :param str encoding: the content encoding of the response if the logs are compressed
+    :return: the ETag
+    :rtype: str
+    """
+    # The log file is only appended to, so its size identifies its content as long as it's not
+    # recreated, which the inode and modification time account for
+    etag = f'{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}-{start:x}'
+    if encoding:
+        etag = f'{etag}-{encoding}'
+    return etag
 
 
 @api_v1.route('/builds')
@@ -185,16 +468,20 @@ def get_builds():
     """
     Retrieve the paginated build requests.
 
+    The requests are paginated by page number unless one of the ``after_id`` or ``before_id``
+    query parameters is set or ``count`` is ``false``, in which case they are paginated by seeking
+    on the request ID. The latter doesn't slow down on deep pages and, without counting the
+    requests, only queries the requests on the page.
+
     :rtype: flask.Response
+    :raises ValidationError: if the query parameters are invalid
     """
     batch_id = flask.request.args.get('batch')
     state = flask.request.args.get('state')
     verbose = str_to_bool(flask.request.args.get('verbose'))
     max_per_page = flask.current_app.config['IIB_MAX_PER_PAGE']
 
-    # Create an alias class to load the polymorphic classes
-    poly_request = with_polymorphic(Request, '*')
-    query = poly_request.query.options(*get_request_query_options(verbose=verbose))
+    query = Request.query.options(*get_request_query_options(verbose=verbose))
     if state:
         RequestStateMapping.validate_state(state)
         state_int = RequestStateMapping.__members__[state].value
@@ -205,9 +492,6 @@ def get_builds():
         batch_id = Batch.validate_batch(batch_id)
         query = query.filter_by(batch_id=batch_id)
 
-    pagination_query = query.order_by(Request.id.desc()).paginate(max_per_page=max_per_page)
-    requests = pagination_query.items
-
     query_params = {}
     if state:
         query_params['state'] = state
@@ -216,6 +500,31 @@ def get_builds():
     if batch_id:
         query_params['batch'] = batch_id
 
+    after_id = _get_int_query_param('after_id')
+    before_id = _get_int_query_param('before_id')
+    count = str_to_bool(flask.request.args.get('count', 'true'))
+    if after_id is not None and before_id is not None:
+        raise ValidationError(
+            'The "after_id" and "before_id" query parameters are mutually exclusive'
+        )
+
+    if after_id is not None or before_id is not None or not count:
+        # Seek on the primary key instead of using an offset, which is slow for deep pages
+        per_page = _get_int_query_param('per_page', 20, minimum=1)
+        pagination_query = paginate_by_id(
+            query,
+            Request.id,
+            min(per_page, max_per_page),
+            after_id=after_id,
+            before_id=before_id,
+            count=count,
+        )
+        if not count:
+            query_params['count'] = 'false'
+    else:
+        pagination_query = query.order_by(Request.id.desc()).paginate(max_per_page=max_per_page)
+    requests = pagination_query.items
+
     response = {
         'items': [request.to_json(verbose=verbose) for request in requests],
         'meta': pagination_metadata(pagination_query, **query_params),
@@ -223,6 +532,27 @@ def get_builds():
     return flask.jsonify(response)
 
 
+def _get_int_query_param(name, default=None, minimum=0):
+    """
+    Get the value of an integer query parameter.
+
+    :param str name: the name of the query parameter
+    :param int default: the value to return if the query parameter isn't set
+    :param int minimum: the minimum valid value
+    :return: the value of the query parameter
+    :rtype: int
+    :raises ValidationError: if the value isn't an integer greater than or equal to ``minimum``
+    """
+    value = flask.request.args.get(name)
+    if value is None:
+        return default
+    if not value.isdigit() or int(value) < minimum:
+        raise ValidationError(
+            f'The "{name}" query parameter must be an integer greater than or equal to {minimum}'
+        )
+    return int(value)
+
+
 @api_v1.route('/healthcheck')
 def get_healthcheck():
     """
@@ -255,10 +585,9 @@ def _should_force_overwrite():
     # current_user.is_authenticated is only ever False when auth is disabled
     if not current_user.is_authenticated:
         return False
-    privileged_users = flask.current_app.config['IIB_PRIVILEGED_USERNAMES']
     force_ovewrite = flask.current_app.config['IIB_FORCE_OVERWRITE_FROM_INDEX']
 
-    should_force = current_user.username in privileged_users and force_ovewrite
+    should_force = is_privileged_user(current_user.username) and force_ovewrite
     if should_force:
         flask.current_app.logger.info(
             'The "overwrite_from_index" parameter is being forced to True'
@@ -311,53 +640,48 @@ def add_bundles():
 
     request = RequestAdd.from_json(payload)
     db.session.add(request)
-    db.session.commit()
-    messaging.send_message_for_state_change(request, new_batch_msg=True)
+    # Flush the request to get its ID for the arguments of the task
+    db.session.flush()
 
     overwrite_from_index = _should_force_overwrite() or payload.get('overwrite_from_index')
     celery_queue = _get_user_queue(serial=overwrite_from_index)
     args = _get_add_args(payload, request, overwrite_from_index, celery_queue)
     safe_args = _get_safe_args(args, payload)
-    error_callback = failed_request_callback.s(request.id)
-
-    try:
-        handle_add_request.apply_async(
-            args=args, link_error=error_callback, argsrepr=repr(safe_args), queue=celery_queue
-        )
-    except kombu.exceptions.OperationalError:
-        handle_broker_error(request)
+    add_task_to_outbox(handle_add_request, request, args, celery_queue, safe_args)
+    db.session.commit()
+    messaging.send_message_for_state_change(request, new_batch_msg=True)
 
     flask.current_app.logger.debug('Successfully scheduled request %d', request.id)
     return flask.jsonify(request.to_json()), 201
 
 
-@api_v1.route('/builds/<int:request_id>', methods=['PATCH'])
-@login_required
-def patch_request(request_id):
+def _check_worker_user():
     """
-    Modify the given request.
+    Verify that the current user is an IIB worker.
 
-    :param int request_id: the request ID from the URL
-    :return: a Flask JSON response
-    :rtype: flask.Response
-    :raise Forbidden: If the user trying to patch a request is not an IIB worker
-    :raise NotFound: if the request is not found
-    :raise ValidationError: if the JSON is invalid
+    :raise Forbidden: if the user is not an IIB worker
     """
-    allowed_users = flask.current_app.config['IIB_WORKER_USERNAMES']
     # current_user.is_authenticated is only ever False when auth is disabled
-    if current_user.is_authenticated and current_user.username not in allowed_users:
+    if current_user.is_authenticated and not is_worker_user(current_user.username):
         raise Forbidden('This API endpoint is restricted to IIB workers')
 
-    payload = flask.request.get_json()
+
+def _apply_request_patch(request, payload):
+    """
+    Apply the modifications of a PATCH payload to the request without committing them.
+
+    :param Request request: the request to modify
+    :param dict payload: the modifications to apply
+    :return: ``True`` if a new state was added to the request
+    :rtype: bool
+    :raise ValidationError: if the payload is invalid
+    """
     if not isinstance(payload, dict):
         raise ValidationError('The input data must be a JSON object')
 
     if not payload:
         raise ValidationError('At least one key must be specified to update the request')
 
-    request = Request.query.get_or_404(request_id)
-
     invalid_keys = payload.keys() - request.get_mutable_keys()
     if invalid_keys:
         raise ValidationError(
@@ -382,6 +706,9 @@ def patch_request(request_id):
     elif 'state_reason' in payload and 'state' not in payload:
         raise ValidationError('The "state" key is required when "state_reason" is supplied')
 
+    # The cached JSON of the request is outdated once it's modified
+    request.serialized_json = None
+
     state_updated = False
     if 'state' in payload and 'state_reason' in payload:
         RequestStateMapping.validate_state(payload['state'])
@@ -398,11 +725,11 @@ def patch_request(request_id):
     if 'omps_operator_version' in payload:
         # `omps_operator_version` is defined in RequestAdd only
         if request.type == RequestTypeMapping.add.value:
-            request_add = RequestAdd.query.get(request_id)
+            request_add = RequestAdd.query.get(request.id)
             request_add.omps_operator_version = payload.get('omps_operator_version')
         else:
             raise ValidationError(
-                f'Request {request_id} is type of "{RequestTypeMapping.pretty(request.type)}" '
+                f'Request {request.id} is type of "{RequestTypeMapping.pretty(request.type)}" '
                 f'request and does not support setting "omps_operator_version"'
             )
 
@@ -416,22 +743,46 @@ def patch_request(request_id):
         'source_from_index_resolved',
         'target_index_resolved',
     )
+    bundle_mapping = payload.get('bundle_mapping', {})
+    # Get or create all the images and operators at once instead of one by one
+    pull_specs = {payload[key] for key in image_keys if key in payload}
+    for bundles in bundle_mapping.values():
+        pull_specs.update(bundles)
+    images = Image.get_or_create_many(pull_specs)
+    operators = Operator.get_or_create_many(bundle_mapping.keys())
+
     for key in image_keys:
-        if key not in payload:
-            continue
-        key_value = payload.get(key, None)
-        key_object = Image.get_or_create(key_value)
-        # SQLAlchemy will not add the object to the database if it's already present
-        setattr(request, key, key_object)
+        if key in payload:
+            setattr(request, key, images[payload[key]])
 
     for arch in payload.get('arches', []):
         request.add_architecture(arch)
 
-    for operator, bundles in payload.get('bundle_mapping', {}).items():
-        operator_img = Operator.get_or_create(operator)
+    for operator, bundles in bundle_mapping.items():
         for bundle in bundles:
-            bundle_img = Image.get_or_create(bundle)
-            bundle_img.operator = operator_img
+            images[bundle].operator = operators[operator]
+
+    return state_updated
+
+
+@api_v1.route('/builds/<int:request_id>', methods=['PATCH'])
+@login_required
+def patch_request(request_id):
+    """
+    Modify the given request.
+
+    :param int request_id: the request ID from the URL
+    :return: a Flask JSON response
+    :rtype: flask.Response
+    :raise Forbidden: If the user trying to patch a request is not an IIB worker
+    :raise NotFound: if the request is not found
+    :raise ValidationError: if the JSON is invalid
+    """
+    _check_worker_user()
+
+    payload = flask.request.get_json()
+    request = Request.query.get_or_404(request_id)
+    state_updated = _apply_request_patch(request, payload)
 
     db.session.commit()
 
@@ -448,6 +799,62 @@ def patch_request(request_id):
     return flask.jsonify(request.to_json()), 200
 
 
+@api_v1.route('/builds/<int:request_id>/updates', methods=['PATCH'])
+@login_required
+def patch_request_updates(request_id):
+    """
+    Apply several modifications to the given request in a single transaction.
+
+    Each modification accepts the same keys as the payload of ``PATCH /builds/<id>`` and they're
+    applied in order, so several state transitions can be recorded at once. Either all the
+    modifications are applied or none of them are.
+
+    :param int request_id: the request ID from the URL
+    :return: a Flask JSON response
+    :rtype: flask.Response
+    :raise Forbidden: If the user trying to patch a request is not an IIB worker
+    :raise NotFound: if the request is not found
+    :raise ValidationError: if the JSON is invalid
+    """
+    _check_worker_user()
+
+    payloads = flask.request.get_json()
+    if not isinstance(payloads, list) or not payloads:
+        raise ValidationError('The input data must be a non-empty JSON array')
+
+    request = Request.query.get_or_404(request_id)
+    state_updated = False
+    try:
+        for payload in payloads:
+            if _apply_request_patch(request, payload):
+                state_updated = True
+    except Exception:
+        # Discard the updates that were already applied since they are flushed to the database
+        db.session.rollback()
+        raise
+
+    db.session.commit()
+
+    # A single message is sent with the latest state since the intermediate states were only
+    # visible within the transaction
+    if state_updated:
+        messaging.send_message_for_state_change(request)
+
+    if current_user.is_authenticated:
+        flask.current_app.logger.info(
+            'The user %s patched request %d with %d updates',
+            current_user.username,
+            request.id,
+            len(payloads),
+        )
+    else:
+        flask.current_app.logger.info(
+            'An anonymous user patched request %d with %d updates', request.id, len(payloads)
+        )
+
+    return flask.jsonify(request.to_json()), 200
+
+
 @api_v1.route('/builds/rm', methods=['POST'])
 @login_required
 def rm_operators():
@@ -463,24 +870,18 @@ def rm_operators():
 
     request = RequestRm.from_json(payload)
     db.session.add(request)
-    db.session.commit()
-    messaging.send_message_for_state_change(request, new_batch_msg=True)
+    # Flush the request to get its ID for the arguments of the task
+    db.session.flush()
 
     overwrite_from_index = _should_force_overwrite() or payload.get('overwrite_from_index')
 
     args = _get_rm_args(payload, request, overwrite_from_index)
     safe_args = _get_safe_args(args, payload)
-
-    error_callback = failed_request_callback.s(request.id)
-    try:
-        handle_rm_request.apply_async(
-            args=args,
-            link_error=error_callback,
-            argsrepr=repr(safe_args),
-            queue=_get_user_queue(serial=overwrite_from_index),
-        )
-    except kombu.exceptions.OperationalError:
-        handle_broker_error(request)
+    add_task_to_outbox(
+        handle_rm_request, request, args, _get_user_queue(serial=overwrite_from_index), safe_args,
+    )
+    db.session.commit()
+    messaging.send_message_for_state_change(request, new_batch_msg=True)
 
     flask.current_app.logger.debug('Successfully scheduled request %d', request.id)
     return flask.jsonify(request.to_json()), 201
@@ -501,23 +902,41 @@ def regenerate_bundle():
 
     request = RequestRegenerateBundle.from_json(payload)
     db.session.add(request)
+    # Flush the request to get its ID for the arguments of the task
+    db.session.flush()
+
+    add_task_to_outbox(
+        handle_regenerate_bundle_request,
+        request,
+        [payload['from_bundle_image'], payload.get('organization'), request.id],
+        _get_user_queue(),
+    )
     db.session.commit()
     messaging.send_message_for_state_change(request, new_batch_msg=True)
 
-    error_callback = failed_request_callback.s(request.id)
-    try:
-        handle_regenerate_bundle_request.apply_async(
-            args=[payload['from_bundle_image'], payload.get('organization'), request.id],
-            link_error=error_callback,
-            queue=_get_user_queue(),
-        )
-    except kombu.exceptions.OperationalError:
-        handle_broker_error(request)
-
     flask.current_app.logger.debug('Successfully scheduled request %d', request.id)
     return flask.jsonify(request.to_json()), 201
 
 
+def _get_batch_requests(batch_id):
+    """
+    Get the requests of a new batch with the relationships used in their JSON loaded in bulk.
+
+    Once the requests are committed, their attributes are expired, so this avoids reloading the
+    attributes and the relationships of each request individually.
+
+    :param int batch_id: the ID of the batch
+    :return: the requests of the batch ordered by their IDs
+    :rtype: list
+    """
+    return (
+        Request.query.options(*get_request_query_options(verbose=True))
+        .filter(Request.batch_id == batch_id)
+        .order_by(Request.id)
+        .all()
+    )
+
+
 @api_v1.route('/builds/regenerate-bundle-batch', methods=['POST'])
 @login_required
 def regenerate_bundle_batch():
@@ -532,13 +951,14 @@ def regenerate_bundle_batch():
 
     batch = Batch(annotations=payload.get('annotations'))
     db.session.add(batch)
+    images, _ = Batch.get_or_create_images_and_operators(payload['build_requests'])
 
     requests = []
     # Iterate through all the build requests and verify that the requests are valid before
     # committing them and scheduling the tasks
     for build_request in payload['build_requests']:
         try:
-            request = RequestRegenerateBundle.from_json(build_request, batch)
+            request = RequestRegenerateBundle.from_json(build_request, batch, images)
         except ValidationError as e:
             # Rollback the transaction if any of the build requests are invalid
             db.session.rollback()
@@ -549,37 +969,30 @@ def regenerate_bundle_batch():
         db.session.add(request)
         requests.append(request)
 
+    # Flush the requests to get their IDs for the arguments of the tasks. The IDs are reserved
+    # beforehand when possible, so that the requests and their states are inserted in bulk.
+    reserve_primary_keys(db.session.new)
+    db.session.flush()
+    celery_queue = _get_user_queue()
+    for build_request, request in zip(payload['build_requests'], requests):
+        add_task_to_outbox(
+            handle_regenerate_bundle_request,
+            request,
+            [build_request['from_bundle_image'], build_request.get('organization'), request.id],
+            celery_queue,
+        )
+
+    reserve_primary_keys(db.session.new)
+    batch_id = batch.id
     db.session.commit()
+    requests = _get_batch_requests(batch_id)
     messaging.send_messages_for_new_batch_of_requests(requests)
 
-    request_jsons = []
-    # This list will be used for the log message below and avoids the need of having to iterate
-    # through the list of requests another time
-    processed_request_ids = []
-    build_and_requests = zip(payload['build_requests'], requests)
-    try:
-        for build_request, request in build_and_requests:
-            error_callback = failed_request_callback.s(request.id)
-            handle_regenerate_bundle_request.apply_async(
-                args=[
-                    build_request['from_bundle_image'],
-                    build_request.get('organization'),
-                    request.id,
-                ],
-                link_error=error_callback,
-                queue=_get_user_queue(),
-            )
-
-            request_jsons.append(request.to_json())
-            processed_request_ids.append(str(request.id))
-    except kombu.exceptions.OperationalError:
-        unprocessed_requests = [r for r in requests if str(r.id) not in processed_request_ids]
-        handle_broker_batch_error(unprocessed_requests)
-
+    request_jsons = [request.to_json() for request in requests]
     flask.current_app.logger.debug(
         'Successfully scheduled the batch %d with requests: %s',
-        batch.id,
-        ', '.join(processed_request_ids),
+        batch_id,
+        ', '.join(str(request.id) for request in requests),
     )
     return flask.jsonify(request_jsons), 201
 
@@ -600,6 +1013,7 @@ def add_rm_batch():
 
     batch = Batch(annotations=payload.get('annotations'))
     db.session.add(batch)
+    images, operators = Batch.get_or_create_images_and_operators(payload['build_requests'])
 
     requests = []
     # Iterate through all the build requests and verify that the requests are valid before
@@ -608,12 +1022,12 @@ def add_rm_batch():
         try:
             if build_request.get('operators'):
                 # Check for the validity of a RM request
-                request = RequestRm.from_json(build_request, batch)
+                request = RequestRm.from_json(build_request, batch, images, operators)
             elif build_request.get('bundles'):
                 build_request_uniq = copy.deepcopy(build_request)
                 build_request_uniq['bundles'] = _get_unique_bundles(build_request_uniq['bundles'])
                 # Check for the validity of an Add request
-                request = RequestAdd.from_json(build_request_uniq, batch)
+                request = RequestAdd.from_json(build_request_uniq, batch, images)
             else:
                 raise ValidationError('Build request is not a valid Add/Rm request.')
         except ValidationError as e:
@@ -624,53 +1038,36 @@ def add_rm_batch():
         db.session.add(request)
         requests.append(request)
 
-    db.session.commit()
-    messaging.send_messages_for_new_batch_of_requests(requests)
-
-    request_jsons = []
-    # This list will be used for the log message below and avoids the need of having to iterate
-    # through the list of requests another time
-    processed_request_ids = []
+    # Flush the requests to get their IDs for the arguments of the tasks. The IDs are reserved
+    # beforehand when possible, so that the requests and their states are inserted in bulk.
+    reserve_primary_keys(db.session.new)
+    db.session.flush()
     for build_request, request in zip(payload['build_requests'], requests):
-        request_jsons.append(request.to_json())
-
         overwrite_from_index = _should_force_overwrite() or build_request.get(
             'overwrite_from_index'
         )
         celery_queue = _get_user_queue(serial=overwrite_from_index)
         if isinstance(request, RequestAdd):
+            task = handle_add_request
             args = _get_add_args(build_request, request, overwrite_from_index, celery_queue)
         elif isinstance(request, RequestRm):
+            task = handle_rm_request
             args = _get_rm_args(build_request, request, overwrite_from_index)
 
         safe_args = _get_safe_args(args, build_request)
+        add_task_to_outbox(task, request, args, celery_queue, safe_args)
 
-        error_callback = failed_request_callback.s(request.id)
-        try:
-            if isinstance(request, RequestAdd):
-                handle_add_request.apply_async(
-                    args=args,
-                    link_error=error_callback,
-                    argsrepr=repr(safe_args),
-                    queue=celery_queue,
-                )
-            else:
-                handle_rm_request.apply_async(
-                    args=args,
-                    link_error=error_callback,
-                    argsrepr=repr(safe_args),
-                    queue=celery_queue,
-                )
-        except kombu.exceptions.OperationalError:
-            unprocessed_requests = [r for r in requests if str(r.id) not in processed_request_ids]
-            handle_broker_batch_error(unprocessed_requests)
-
-        processed_request_ids.append(str(request.id))
+    reserve_primary_keys(db.session.new)
+    batch_id = batch.id
+    db.session.commit()
+    requests = _get_batch_requests(batch_id)
+    messaging.send_messages_for_new_batch_of_requests(requests)
 
+    request_jsons = [request.to_json() for request in requests]
     flask.current_app.logger.debug(
         'Successfully scheduled the batch %d with requests: %s',
-        batch.id,
-        ', '.join(processed_request_ids),
+        batch_id,
+        ', '.join(str(request.id) for request in requests),
     )
     return flask.jsonify(request_jsons), 201
 
@@ -689,8 +1086,8 @@ def merge_index_image():
         raise ValidationError('The input data must be a JSON object')
     request = RequestMergeIndexImage.from_json(payload)
     db.session.add(request)
-    db.session.commit()
-    messaging.send_message_for_state_change(request, new_batch_msg=True)
+    # Flush the request to get its ID for the arguments of the task
+    db.session.flush()
 
     overwrite_target_index = payload.get('overwrite_target_index', False)
     celery_queue = _get_user_queue(serial=overwrite_target_index)
@@ -706,14 +1103,9 @@ def merge_index_image():
         flask.current_app.config['IIB_BINARY_IMAGE_CONFIG'],
     ]
     safe_args = _get_safe_args(args, payload)
-
-    error_callback = failed_request_callback.s(request.id)
-    try:
-        handle_merge_request.apply_async(
-            args=args, link_error=error_callback, argsrepr=repr(safe_args), queue=celery_queue
-        )
-    except kombu.exceptions.OperationalError:
-        handle_broker_error(request)
+    add_task_to_outbox(handle_merge_request, request, args, celery_queue, safe_args)
+    db.session.commit()
+    messaging.send_message_for_state_change(request, new_batch_msg=True)
 
     flask.current_app.logger.debug('Successfully scheduled request %d', request.id)
     return flask.jsonify(request.to_json()), 201
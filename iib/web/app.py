@@ -126,6 +126,9 @@ def create_app(config_obj=None):  # pragma: no cover
 
     # Validate the config
     validate_api_config(app.config)
+    # Store the usernames as sets since they're checked on every request restricted to them
+    app.extensions['iib_privileged_usernames'] = frozenset(app.config['IIB_PRIVILEGED_USERNAMES'])
+    app.extensions['iib_worker_usernames'] = frozenset(app.config['IIB_WORKER_USERNAMES'])
 
     # Configure logging
     default_handler.setFormatter(
@@ -1,9 +1,89 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from collections import OrderedDict
+import threading
+import time
+
 from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
 
 from iib.web import db
 from iib.web.models import User
 
+_user_cache_lock = threading.Lock()
+
+
+class _UserCache:
+    """
+    A bounded cache of the IDs of the users keyed by their username.
+
+    The entries expire after a time to live and the least recently used entries are evicted once
+    the cache is full.
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Initialize the cache.
+
+        :param int max_size: the maximum number of users in the cache; if ``0``, nothing is cached
+        :param float ttl: the number of seconds after which an entry expires
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """
+        Get the ID of the user from the cache.
+
+        :param str username: the username of the user
+        :return: the ID of the user or ``None`` if it's not cached or it expired
+        :rtype: int
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None:
+                return None
+            user_id, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[username]
+                return None
+            self._entries.move_to_end(username)
+            return user_id
+
+    def set(self, username, user_id):
+        """
+        Add the ID of the user to the cache.
+
+        :param str username: the username of the user
+        :param int user_id: the ID of the user
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _get_user_cache():
+    """
+    Get the user cache of the application in the current process, creating it if needed.
+
+    :return: the user cache
+    :rtype: _UserCache
+    """
+    app = current_app._get_current_object()
+    with _user_cache_lock:
+        cache = app.extensions.get('iib_user_cache')
+        if cache is None:
+            cache = _UserCache(
+                app.config['IIB_USER_CACHE_MAX_SIZE'], app.config['IIB_USER_CACHE_TTL']
+            )
+            app.extensions['iib_user_cache'] = cache
+    return cache
+
 
 def user_loader(username):
     """
@@ -37,7 +117,8 @@ def load_user_from_request(request):
     Load the user that authenticated from the current request.
 
     This is used by the Flask-Login library. If the user does not exist in the database, an entry
-    will be created.
+    will be created. The IDs of the users are cached so that the database is only queried when the
+    user isn't in the cache.
 
     If None is returned, then Flask-Login will set `flask_login.current_user` to an
     `AnonymousUserMixin` object, which has the `is_authenticated` property set to `False`.
@@ -57,8 +138,18 @@ def load_user_from_request(request):
         return
 
     current_app.logger.info(f'The user "{username}" was authenticated successfully by httpd')
+    cache = _get_user_cache()
+    user_id = cache.get(username)
+    if user_id is not None:
+        # The username of a user never changes, so the user is added to the session without
+        # querying it. If the user was already loaded in the session, that object is returned.
+        user = User(id=user_id, username=username)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
     user = User.get_or_create(username)
     if not user.id:
         db.session.commit()
 
+    cache.set(username, user.id)
     return user
@@ -20,11 +20,20 @@ class Config(object):
     IIB_MESSAGING_CA = '/etc/pki/tls/certs/ca-bundle.crt'
     IIB_MESSAGING_CERT = '/etc/iib/messaging.crt'
     IIB_MESSAGING_DURABLE = True
+    IIB_MESSAGING_HEARTBEAT = 60
     IIB_MESSAGING_KEY = '/etc/iib/messaging.key'
+    IIB_MESSAGING_QUEUE_SIZE = 1000
     IIB_MESSAGING_TIMEOUT = 30
     IIB_PRIVILEGED_USERNAMES = []
     IIB_REQUEST_LOGS_DIR = None
     IIB_REQUEST_LOGS_DAYS_TO_LIVE = 3
+    IIB_REQUEST_LOGS_FOLLOW_INTERVAL = 1
+    IIB_REQUEST_LOGS_FOLLOW_TIMEOUT = 300
+    IIB_TASK_DISPATCH_BATCH_SIZE = 100
+    IIB_TASK_DISPATCH_CONFIRM_TIMEOUT = 30
+    IIB_TASK_DISPATCH_INTERVAL = 1
+    IIB_USER_CACHE_MAX_SIZE = 1000
+    IIB_USER_CACHE_TTL = 300
     IIB_USER_TO_QUEUE = {}
     IIB_WORKER_USERNAMES = []
     SQLALCHEMY_TRACK_MODIFICATIONS = False
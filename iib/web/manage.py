@@ -7,6 +7,7 @@ from sqlalchemy.exc import OperationalError
 
 from iib.web import db
 from iib.web.app import create_app
+from iib.web.outbox import run_task_dispatcher
 
 
 @click.group(cls=FlaskGroup, create_app=create_app)
@@ -31,5 +32,14 @@ def wait_for_db():
             break
 
 
+@cli.command(name='dispatch-tasks')
+@click.option(
+    '--once', is_flag=True, help='Exit once the outbox is empty instead of waiting for new tasks.'
+)
+def dispatch_tasks(once):
+    """Send the tasks of the submitted requests to the Celery broker."""
+    run_task_dispatcher(once=once)
+
+
 if __name__ == '__main__':
     cli()
@@ -1,7 +1,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import atexit
 from collections import namedtuple
 import json
 import os
+import queue
+import threading
 import time
 import uuid
 
@@ -126,6 +129,9 @@ class BlockingConnection(proton.utils.BlockingConnection):  # pragma: no cover
 
 Envelope = namedtuple('Envelope', 'address message')
 
+# Protects the creation of the message sender of each application
+_message_sender_lock = threading.Lock()
+
 
 def _get_batch_state_change_envelope(batch, new_batch=False):
     """
@@ -250,9 +256,188 @@ def json_to_envelope(address, content, properties=None):
     return Envelope(address, message)
 
 
+class _MessageSender(object):
+    """
+    Send messages to the broker from a background thread.
+
+    The thread keeps a connection to the broker and a sender link for each address open between
+    messages, so that they don't need to be established for every state change. The connection is
+    reestablished when it fails, and its events, such as heartbeats, are processed while it's idle
+    so that the broker doesn't close it.
+    """
+
+    def __init__(self, app):
+        """
+        Start the background thread.
+
+        :param flask.Flask app: the application to send the messages for
+        """
+        self.app = app
+        self.pid = os.getpid()
+        self.connection = None
+        self.address_to_sender = {}
+        self.queue = queue.Queue(maxsize=app.config['IIB_MESSAGING_QUEUE_SIZE'])
+        self.thread = threading.Thread(target=self._run, name='iib-messaging', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def enqueue(self, envelopes):
+        """
+        Queue the messages to be sent by the background thread without waiting for them to be sent.
+
+        :param list envelopes: a list of ``Envelope`` objects representing the messages to send
+        :return: ``True`` if the messages were queued; ``False`` if the queue is full, in which case
+            the messages are discarded
+        :rtype: bool
+        """
+        try:
+            self.queue.put_nowait(envelopes)
+        except queue.Full:
+            self.app.logger.error(
+                'Discarding %d messages since the queue of messages to send is full', len(envelopes)
+            )
+            return False
+        return True
+
+    def stop(self):
+        """Send the queued messages and stop the background thread."""
+        if not self.thread.is_alive():
+            return
+
+        timeout = self.app.config['IIB_MESSAGING_TIMEOUT']
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            self.app.logger.error('Timed out waiting for the queued messages to be sent')
+            return
+        self.thread.join(timeout=timeout)
+
+    def _run(self):
+        """Send the queued messages until ``None`` is queued."""
+        heartbeat = self.app.config['IIB_MESSAGING_HEARTBEAT']
+        while True:
+            try:
+                envelopes = self.queue.get(timeout=heartbeat / 2)
+            except queue.Empty:
+                self._process_events()
+                continue
+
+            try:
+                if envelopes is None:
+                    self._close_connection()
+                    return
+                self._send(envelopes)
+            finally:
+                self.queue.task_done()
+
+    def _get_connection(self):
+        """
+        Get the connection to the broker, connecting to it if needed.
+
+        :return: the connection
+        :rtype: BlockingConnection
+        """
+        if self.connection is None:
+            conf = self.app.config
+            with self.app.app_context():
+                ssl_domain = _get_ssl_domain()
+            self.connection = BlockingConnection(
+                urls=conf['IIB_MESSAGING_URLS'],
+                timeout=conf['IIB_MESSAGING_TIMEOUT'],
+                ssl_domain=ssl_domain,
+                heartbeat=conf['IIB_MESSAGING_HEARTBEAT'],
+            )
+            self.app.logger.info('Connected to the message broker %s', self.connection.url)
+        return self.connection
+
+    def _close_connection(self):
+        """Close the connection to the broker and discard its sender links."""
+        connection = self.connection
+        self.connection = None
+        self.address_to_sender = {}
+        if connection:
+            try:
+                connection.close()
+            except:  # noqa: E722
+                self.app.logger.debug('Failed to close the connection to the message broker')
+
+    def _process_events(self):
+        """Process the events of the idle connection, such as heartbeats, to keep it open."""
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.container.do_work(0.1)
+        except:  # noqa: E722
+            self.app.logger.warning('The connection to the message broker failed while idle')
+            self._close_connection()
+            return
+
+        if self.connection.disconnected:
+            self.app.logger.info('The message broker closed the idle connection')
+            self._close_connection()
+
+    def _send(self, envelopes):
+        """
+        Send multiple messages in order while reusing the connection and sender links.
+
+        If sending a message fails, the connection is reestablished once and the messages that
+        weren't sent yet are sent again. If that also fails, the exception is logged and the
+        remaining messages are discarded since this is not considered a fatal error.
+
+        :param list envelopes: a list of ``Envelope`` objects representing the messages to send
+        """
+        timeout = self.app.config['IIB_MESSAGING_TIMEOUT']
+        sent = 0
+        for attempt in range(2):
+            try:
+                connection = self._get_connection()
+                for envelope in envelopes[sent:]:
+                    if envelope.address not in self.address_to_sender:
+                        self.address_to_sender[envelope.address] = connection.create_sender(
+                            envelope.address
+                        )
+
+                    self.app.logger.info(
+                        'Sending message %s to %s', envelope.message.id, envelope.address
+                    )
+                    self.address_to_sender[envelope.address].send(envelope.message, timeout=timeout)
+                    sent += 1
+                return
+            except:  # noqa: E722
+                self._close_connection()
+                if attempt:
+                    self.app.logger.exception('Failed to send one or more messages')
+                else:
+                    self.app.logger.warning(
+                        'Failed to send a message, reconnecting to the message broker',
+                        exc_info=True,
+                    )
+
+
+def _get_message_sender():
+    """
+    Get the message sender of the application in the current process, starting it if needed.
+
+    :return: the message sender
+    :rtype: _MessageSender
+    """
+    app = current_app._get_current_object()
+    with _message_sender_lock:
+        sender = app.extensions.get('iib_message_sender')
+        # The background thread doesn't survive a fork, so each process needs its own sender
+        if sender is None or sender.pid != os.getpid():
+            sender = _MessageSender(app)
+            app.extensions['iib_message_sender'] = sender
+    return sender
+
+
 def send_messages(envelopes):
     """
-    Send multiple messages in order while using a single connection and reusing sender links.
+    Send multiple messages in order from a background thread.
+
+    This doesn't wait for the messages to be sent, so the broker doesn't delay the API responses.
+    The messages are sent over a persistent connection while reusing sender links.
 
     If the IIB configuration ``IIB_MESSAGING_URLS`` is not set, the message will not be sent and
     an error will be logged.
@@ -262,35 +447,11 @@ def send_messages(envelopes):
 
     :param list envelopes: a list of ``Envelope`` objects representing the messages to send
     """
-    conf = current_app.config
-    if not conf.get('IIB_MESSAGING_URLS'):
+    if not current_app.config.get('IIB_MESSAGING_URLS'):
         current_app.logger.error('The "IIB_MESSAGING_URLS" must be set to send messages')
         return
 
-    address_to_sender = {}
-    connection = None
-    try:
-        connection = BlockingConnection(
-            urls=conf['IIB_MESSAGING_URLS'],
-            timeout=conf['IIB_MESSAGING_TIMEOUT'],
-            ssl_domain=_get_ssl_domain(),
-        )
-        current_app.logger.info('Connected to the message broker %s', connection.url)
-        for envelope in envelopes:
-            if envelope.address not in address_to_sender:
-                address_to_sender[envelope.address] = connection.create_sender(envelope.address)
-
-            current_app.logger.info(
-                'Sending message %s to %s', envelope.message.id, envelope.address
-            )
-            address_to_sender[envelope.address].send(
-                envelope.message, timeout=conf['IIB_MESSAGING_TIMEOUT']
-            )
-    except:  # noqa: E722
-        current_app.logger.exception('Failed to send one or more messages')
-    finally:
-        if connection:
-            connection.close()
+    _get_message_sender().enqueue(envelopes)
 
 
 def send_message_for_state_change(request, new_batch_msg=False):
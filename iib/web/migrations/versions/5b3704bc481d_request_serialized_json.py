@@ -0,0 +1,26 @@
+"""
+Add the cached JSON of the requests.
+
+Revision ID: 5b3704bc481d
+Revises: 60f89c046096
+Create Date: 2026-10-18 10:12:41.503217
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b3704bc481d'
+down_revision = '60f89c046096'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('request') as batch_op:
+        batch_op.add_column(sa.Column('serialized_json', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('request') as batch_op:
+        batch_op.drop_column('serialized_json')
@@ -0,0 +1,43 @@
+"""
+Add the outbox of the Celery tasks.
+
+The args column stores the arguments of the pending tasks, including the secrets of the requests
+such as cnr_token and overwrite_from_index_token, in plain text until the tasks are sent.
+
+Revision ID: 90503796d7bd
+Revises: 5b3704bc481d
+Create Date: 2026-10-18 11:02:17.840136
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '90503796d7bd'
+down_revision = '5b3704bc481d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'task_outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('request_id', sa.Integer(), nullable=False),
+        sa.Column('task_name', sa.String(), nullable=False),
+        sa.Column('args', sa.Text(), nullable=False),
+        sa.Column('argsrepr', sa.Text(), nullable=True),
+        sa.Column('queue', sa.String(), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['request_id'], ['request.id'],),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    with op.batch_alter_table('task_outbox') as batch_op:
+        batch_op.create_index(batch_op.f('ix_task_outbox_request_id'), ['request_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task_outbox') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_task_outbox_request_id'))
+
+    op.drop_table('task_outbox')
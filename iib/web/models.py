@@ -7,12 +7,21 @@ import json
 from flask import current_app, url_for
 from flask_login import UserMixin, current_user
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import joinedload, load_only, validates
+from sqlalchemy.orm import (
+    joinedload,
+    load_only,
+    make_transient_to_detached,
+    selectin_polymorphic,
+    selectinload,
+    validates,
+)
 from werkzeug.exceptions import Forbidden
 
 from iib.exceptions import ValidationError
 from iib.web import db
+from iib.web.utils import is_privileged_user
 
 
 class BaseEnum(Enum):
@@ -189,6 +198,26 @@ class Image(db.Model):
 
         return image
 
+    @classmethod
+    def get_or_create_many(cls, pull_specifications):
+        """
+        Get the images from the database and create the ones that don't exist in bulk.
+
+        :param iterable pull_specifications: the pull specifications of the images
+        :return: a dictionary with the pull specifications as keys and the Image objects as values;
+            the images that were created are inserted in the current transaction, but not committed
+        :rtype: dict
+        :raise ValidationError: if the pull specification of an image is invalid
+        """
+        pull_specifications = set(pull_specifications)
+        for pull_specification in pull_specifications:
+            if '@' not in pull_specification and ':' not in pull_specification:
+                raise ValidationError(
+                    f'Image {pull_specification} should have a tag or a digest specified.'
+                )
+
+        return _get_or_create_many(cls, cls.pull_specification, pull_specifications)
+
 
 class Operator(db.Model):
     """An operator that has been handled by IIB."""
@@ -216,6 +245,18 @@ class Operator(db.Model):
 
         return operator
 
+    @classmethod
+    def get_or_create_many(cls, names):
+        """
+        Get the operators from the database and create the ones that don't exist in bulk.
+
+        :param iterable names: the names of the operators
+        :return: a dictionary with the names as keys and the Operator objects as values; the
+            operators that were created are inserted in the current transaction, but not committed
+        :rtype: dict
+        """
+        return _get_or_create_many(cls, cls.name, set(names))
+
 
 class RequestRmOperator(db.Model):
     """An association table between rm requests and the operators they contain."""
@@ -269,11 +310,16 @@ class Request(db.Model):
     request_state_id = db.Column(
         db.Integer, db.ForeignKey('request_state.id'), index=True, unique=True
     )
+    # The verbose JSON of the request without the logs once the request is in a final state. This
+    # is deferred so that it's only loaded when it's used.
+    serialized_json = db.deferred(db.Column(db.Text, nullable=True))
     # This maps to a value in RequestTypeMapping
     type = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
-    state = db.relationship('RequestState', foreign_keys=[request_state_id])
+    # The request and its current state reference each other, so the reference to the state is set
+    # with an UPDATE after both rows are inserted
+    state = db.relationship('RequestState', foreign_keys=[request_state_id], post_update=True)
     states = db.relationship(
         'RequestState',
         foreign_keys='RequestState.request_id',
@@ -330,11 +376,9 @@ class Request(db.Model):
 
         request_state = RequestState(state=state_int, state_reason=state_reason)
         self.states.append(request_state)
-        # Send the changes queued up in SQLAlchemy to the database's transaction buffer.
-        # This will generate an ID that can be used below.
-        db.session.add(request_state)
-        db.session.flush()
-        self.request_state_id = request_state.id
+        # The state is inserted on the next flush, so that the states of several new requests can be
+        # inserted together
+        self.state = request_state
 
     def add_architecture(self, arch_name):
         """
@@ -399,14 +443,27 @@ class Request(db.Model):
             rv['state_history'] = states
             latest_state = states[0]
             if current_app.config['IIB_REQUEST_LOGS_DIR']:
-                rv['logs'] = {
-                    'expiration': self.logs_expiration.isoformat() + 'Z',
-                    'url': url_for('.get_build_logs', request_id=self.id, _external=True),
-                }
+                rv['logs'] = self.get_logs_json(self.id, self.state.updated)
         rv.update(latest_state or _state_to_json(self.state))
 
         return rv
 
+    @staticmethod
+    def get_logs_json(request_id, state_updated):
+        """
+        Provide the JSON representation of the logs of a build request.
+
+        :param int request_id: the ID of the request
+        :param datetime.datetime state_updated: when the latest state of the request was set
+        :return: a dictionary representing the JSON of the logs
+        :rtype: dict
+        """
+        logs_lifetime = timedelta(days=current_app.config['IIB_REQUEST_LOGS_DAYS_TO_LIVE'])
+        return {
+            'expiration': (state_updated + logs_lifetime).isoformat() + 'Z',
+            'url': url_for('.get_build_logs', request_id=request_id, _external=True),
+        }
+
     def get_mutable_keys(self):
         """
         Return the set of keys representing the attributes that can be modified.
@@ -489,6 +546,42 @@ class Batch(db.Model):
         if not isinstance(payload.get('annotations', {}), dict):
             raise ValidationError('The value of "annotations" must be a JSON object')
 
+    @staticmethod
+    def get_or_create_images_and_operators(build_requests):
+        """
+        Get or create the images and operators referenced by the build requests in bulk.
+
+        This is used to create the requests of a batch without querying the database for each image
+        and operator. Values which are invalid are skipped, so that they are reported when the build
+        request referencing them is validated.
+
+        :param list build_requests: the JSON payloads of the build requests in the batch
+        :return: a tuple with the dictionary of images keyed by their pull specifications and the
+            dictionary of operators keyed by their names
+        :rtype: tuple(dict, dict)
+        """
+
+        def _is_valid_pull_spec(value):
+            return isinstance(value, str) and ('@' in value or ':' in value)
+
+        pull_specs = set()
+        operator_names = set()
+        for build_request in build_requests:
+            if not isinstance(build_request, dict):
+                continue
+
+            for key in ('binary_image', 'from_bundle_image', 'from_index'):
+                if _is_valid_pull_spec(build_request.get(key)):
+                    pull_specs.add(build_request[key])
+            if isinstance(build_request.get('bundles'), list):
+                pull_specs.update(filter(_is_valid_pull_spec, build_request['bundles']))
+            if isinstance(build_request.get('operators'), list):
+                operator_names.update(
+                    item for item in build_request['operators'] if item and isinstance(item, str)
+                )
+
+        return Image.get_or_create_many(pull_specs), Operator.get_or_create_many(operator_names)
+
     @property
     def state(self):
         """
@@ -502,20 +595,37 @@ class Batch(db.Model):
         :return: the state of the batch
         :rtype: str
         """
-        contains_failure = False
-        for state in self.request_states:
-            # If one of the requests is still in progress, the batch is also
-            if state == 'in_progress':
-                return 'in_progress'
-            elif state == 'failed':
-                contains_failure = True
-
+        request_state_counts = self.request_state_counts
+        # If one of the requests is still in progress, the batch is also
+        if request_state_counts.get('in_progress'):
+            return 'in_progress'
         # At this point, we know the batch is done
-        if contains_failure:
+        elif request_state_counts.get('failed'):
             return 'failed'
         else:
             return 'complete'
 
+    @property
+    def request_state_counts(self):
+        """
+        Get the number of requests in the batch in each state.
+
+        The requests are counted by the database in a single query, so that the requests don't
+        need to be loaded each time the state of the batch is checked.
+
+        :return: a dictionary with the state names as keys and the number of requests in the batch
+            in that state as values; states without any requests are omitted
+        :rtype: dict
+        """
+        rows = (
+            db.session.query(RequestState.state, sqlalchemy.func.count())
+            .join(Request, Request.request_state_id == RequestState.id)
+            .filter(Request.batch_id == self.id)
+            .group_by(RequestState.state)
+            .all()
+        )
+        return {RequestStateMapping(state).name: count for state, count in rows}
+
     @property
     def request_states(self):
         """
@@ -583,37 +693,59 @@ def get_request_query_options(verbose=False):
     """
     Get the query options for a SQLAlchemy query for one or more requests to output as JSON.
 
-    This will add the joins ahead of time on relationships that are accessed in the ``to_json``
-    methods to avoid individual select statements when the relationships are accessed.
+    The query for the requests only selects the columns of the ``request`` table. The columns of
+    the request type tables are then loaded with one ``IN`` query per request type on the page,
+    and the relationships that are accessed in the ``to_json`` methods are loaded with one ``IN``
+    query per relationship. This keeps the number of queries constant regardless of the number of
+    requests, without the wide rows that joining every request type table and every image
+    relationship in a single query would produce.
 
     :param bool verbose: if the request relationships should be loaded for verbose JSON output
     :return: a list of SQLAlchemy query options
     :rtype: list
     """
-    # Tell SQLAlchemy to join on the relationships that are part of the JSON to avoid
-    # additional SQL queries
     query_options = [
-        joinedload(Request.user),
-        joinedload(RequestAdd.binary_image),
-        joinedload(RequestAdd.binary_image_resolved),
-        joinedload(RequestAdd.bundles),
-        joinedload(RequestAdd.from_index),
-        joinedload(RequestAdd.from_index_resolved),
-        joinedload(RequestAdd.index_image),
-        joinedload(RequestRegenerateBundle.bundle_image),
-        joinedload(RequestRegenerateBundle.from_bundle_image),
-        joinedload(RequestRegenerateBundle.from_bundle_image_resolved),
-        joinedload(RequestRm.binary_image),
-        joinedload(RequestRm.binary_image_resolved),
-        joinedload(RequestRm.from_index),
-        joinedload(RequestRm.from_index_resolved),
-        joinedload(RequestRm.index_image),
-        joinedload(RequestRm.operators),
+        selectin_polymorphic(
+            Request, [RequestAdd, RequestMergeIndexImage, RequestRegenerateBundle, RequestRm]
+        ),
+        selectinload(Request.architectures),
+        selectinload(Request.batch),
+        selectinload(Request.user),
     ]
+    image_relationships = (
+        RequestAdd.binary_image,
+        RequestAdd.binary_image_resolved,
+        RequestAdd.from_index,
+        RequestAdd.from_index_resolved,
+        RequestAdd.index_image,
+        RequestMergeIndexImage.binary_image,
+        RequestMergeIndexImage.binary_image_resolved,
+        RequestMergeIndexImage.deprecation_list,
+        RequestMergeIndexImage.index_image,
+        RequestMergeIndexImage.source_from_index,
+        RequestMergeIndexImage.source_from_index_resolved,
+        RequestMergeIndexImage.target_index,
+        RequestMergeIndexImage.target_index_resolved,
+        RequestRegenerateBundle.bundle_image,
+        RequestRegenerateBundle.from_bundle_image,
+        RequestRegenerateBundle.from_bundle_image_resolved,
+        RequestRm.binary_image,
+        RequestRm.binary_image_resolved,
+        RequestRm.from_index,
+        RequestRm.from_index_resolved,
+        RequestRm.index_image,
+    )
+    query_options.extend(selectinload(relationship) for relationship in image_relationships)
+    query_options.extend(
+        [
+            selectinload(RequestAdd.bundles).selectinload(Image.operator),
+            selectinload(RequestRm.operators),
+        ]
+    )
     if verbose:
-        query_options.append(joinedload(Request.states))
+        query_options.append(selectinload(Request.states))
     else:
-        query_options.append(joinedload(Request.state))
+        query_options.append(selectinload(Request.state))
 
     return query_options
 
@@ -683,7 +815,11 @@ class RequestIndexImageMixin:
 
     @staticmethod
     def _from_json(
-        request_kwargs, additional_required_params=None, additional_optional_params=None, batch=None
+        request_kwargs,
+        additional_required_params=None,
+        additional_optional_params=None,
+        batch=None,
+        images=None,
     ):
         """
         Validate and process request agnostic parameters.
@@ -694,6 +830,8 @@ class RequestIndexImageMixin:
         :param dict request_kwargs: copy of args provided in API request
         :param Batch batch: the batch to specify with the request. If one is not specified, one will
             be created automatically.
+        :param dict images: the images already retrieved with ``Image.get_or_create_many`` keyed by
+            their pull specifications; the other images are retrieved when they are needed
         """
         # Validate all required parameters are present
         required_params = set(additional_required_params or [])
@@ -741,8 +879,7 @@ class RequestIndexImageMixin:
         # Verify the user is authorized to use overwrite_from_index
         # current_user.is_authenticated is only ever False when auth is disabled
         if current_user.is_authenticated:
-            privileged_users = current_app.config['IIB_PRIVILEGED_USERNAMES']
-            if overwrite and not overwrite_token and current_user.username not in privileged_users:
+            if overwrite and not overwrite_token and not is_privileged_user(current_user.username):
                 raise Forbidden(
                     'You must be a privileged user to set "overwrite_from_index" without'
                     ' setting "overwrite_from_index_token"'
@@ -760,14 +897,13 @@ class RequestIndexImageMixin:
             raise ValidationError('The "binary_image" value must be a non-empty string')
 
         if binary_image:
-            request_kwargs['binary_image'] = Image.get_or_create(pull_specification=binary_image)
+            request_kwargs['binary_image'] = _get_or_create_list(Image, [binary_image], images)[0]
 
         if 'from_index' in request_kwargs:
-            if not isinstance(request_kwargs['from_index'], str):
+            from_index = request_kwargs['from_index']
+            if not isinstance(from_index, str):
                 raise ValidationError('"from_index" must be a string')
-            request_kwargs['from_index'] = Image.get_or_create(
-                pull_specification=request_kwargs['from_index']
-            )
+            request_kwargs['from_index'] = _get_or_create_list(Image, [from_index], images)[0]
 
         # current_user.is_authenticated is only ever False when auth is disabled
         if current_user.is_authenticated:
@@ -838,12 +974,14 @@ class RequestAdd(Request, RequestIndexImageMixin):
     __mapper_args__ = {'polymorphic_identity': RequestTypeMapping.__members__['add'].value}
 
     @classmethod
-    def from_json(cls, kwargs, batch=None):
+    def from_json(cls, kwargs, batch=None, images=None):
         """
         Handle JSON requests for the Add API endpoint.
 
         :param dict kwargs: the JSON payload of the request.
         :param Batch batch: the batch to specify with the request.
+        :param dict images: the images already retrieved with ``Image.get_or_create_many`` keyed by
+            their pull specifications.
         """
         request_kwargs = deepcopy(kwargs)
 
@@ -883,11 +1021,10 @@ class RequestAdd(Request, RequestIndexImageMixin):
                 'distribution_scope',
             ],
             batch=batch,
+            images=images,
         )
 
-        request_kwargs['bundles'] = [
-            Image.get_or_create(pull_specification=item) for item in bundles
-        ]
+        request_kwargs['bundles'] = _get_or_create_list(Image, bundles, images)
 
         request = cls(**request_kwargs)
         request.add_state('in_progress', 'The request was initiated')
@@ -944,13 +1081,18 @@ class RequestRm(Request, RequestIndexImageMixin):
     __mapper_args__ = {'polymorphic_identity': RequestTypeMapping.__members__['rm'].value}
 
     @classmethod
-    def from_json(cls, kwargs, batch=None):
+    def from_json(cls, kwargs, batch=None, images=None, operators=None):
         """
         Handle JSON requests for the Remove API endpoint.
 
         :param dict kwargs: the JSON payload of the request.
         :param Batch batch: the batch to specify with the request.
+        :param dict images: the images already retrieved with ``Image.get_or_create_many`` keyed by
+            their pull specifications.
+        :param dict operators: the operators already retrieved with ``Operator.get_or_create_many``
+            keyed by their names.
         """
+        operators_by_name = operators
         request_kwargs = deepcopy(kwargs)
 
         operators = request_kwargs.get('operators', [])
@@ -962,10 +1104,13 @@ class RequestRm(Request, RequestIndexImageMixin):
             raise ValidationError(f'"operators" should be a non-empty array of strings')
 
         cls._from_json(
-            request_kwargs, additional_required_params=['operators', 'from_index'], batch=batch
+            request_kwargs,
+            additional_required_params=['operators', 'from_index'],
+            batch=batch,
+            images=images,
         )
 
-        request_kwargs['operators'] = [Operator.get_or_create(name=item) for item in operators]
+        request_kwargs['operators'] = _get_or_create_list(Operator, operators, operators_by_name)
 
         request = cls(**request_kwargs)
         request.add_state('in_progress', 'The request was initiated')
@@ -1022,13 +1167,15 @@ class RequestRegenerateBundle(Request):
     }
 
     @classmethod
-    def from_json(cls, kwargs, batch=None):
+    def from_json(cls, kwargs, batch=None, images=None):
         """
         Handle JSON requests for the Regenerate Bundle API endpoint.
 
         :param dict kwargs: the JSON payload of the request.
         :param Batch batch: the batch to specify with the request. If one is not specified, one will
             be created automatically.
+        :param dict images: the images already retrieved with ``Image.get_or_create_many`` keyed by
+            their pull specifications.
         """
         batch = batch or Batch()
         request_kwargs = deepcopy(kwargs)
@@ -1047,9 +1194,9 @@ class RequestRegenerateBundle(Request):
         if not isinstance(from_bundle_image, str):
             raise ValidationError('"from_bundle_image" must be a string')
 
-        request_kwargs['from_bundle_image'] = Image.get_or_create(
-            pull_specification=from_bundle_image
-        )
+        request_kwargs['from_bundle_image'] = _get_or_create_list(
+            Image, [from_bundle_image], images
+        )[0]
 
         # current_user.is_authenticated is only ever False when auth is disabled
         if current_user.is_authenticated:
@@ -1149,22 +1296,18 @@ class RequestMergeIndexImage(Request):
                 'The "deprecation_list" value should be an empty array or an array of strings'
             )
 
-        request_kwargs['deprecation_list'] = [
-            Image.get_or_create(pull_specification=item) for item in deprecation_list
-        ]
+        request_kwargs['deprecation_list'] = _get_or_create_list(Image, deprecation_list)
 
         source_from_index = request_kwargs.pop('source_from_index', None)
         if not (isinstance(source_from_index, str) and source_from_index):
             raise ValidationError('The "source_from_index" value must be a string')
-        request_kwargs['source_from_index'] = Image.get_or_create(
-            pull_specification=source_from_index
-        )
+        request_kwargs['source_from_index'] = _get_or_create_list(Image, [source_from_index])[0]
 
         target_index = request_kwargs.pop('target_index', None)
         if target_index:
             if not isinstance(target_index, str):
                 raise ValidationError('The "target_index" value must be a string')
-            request_kwargs['target_index'] = Image.get_or_create(pull_specification=target_index)
+            request_kwargs['target_index'] = _get_or_create_list(Image, [target_index])[0]
 
         # Verify that `overwrite_target_index` is the correct type
         overwrite = request_kwargs.pop('overwrite_target_index', False)
@@ -1195,7 +1338,7 @@ class RequestMergeIndexImage(Request):
             raise ValidationError('The "binary_image" value must be a non-empty string')
 
         if binary_image:
-            request_kwargs['binary_image'] = Image.get_or_create(pull_specification=binary_image)
+            request_kwargs['binary_image'] = _get_or_create_list(Image, [binary_image])[0]
 
         distribution_scope = request_kwargs.pop('distribution_scope', None)
         if distribution_scope:
@@ -1290,6 +1433,50 @@ class RequestState(db.Model):
         )
 
 
+class TaskOutbox(db.Model):
+    """
+    A Celery task of a request waiting to be sent to the broker.
+
+    The task is committed in the same transaction as the request, and it's then sent to the broker
+    by the task dispatcher. This way, the submission of a request doesn't depend on the broker.
+
+    The arguments of the task include the secrets of the request, such as ``cnr_token`` and
+    ``overwrite_from_index_token``, in plain text since the worker needs them. The task is deleted
+    once the broker confirms it, so the secrets are only stored while the task is pending.
+    """
+
+    __tablename__ = 'task_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), index=True, nullable=False)
+    task_name = db.Column(db.String, nullable=False)
+    _args = db.Column('args', db.Text, nullable=False)
+    argsrepr = db.Column(db.Text, nullable=True)
+    queue = db.Column(db.String, nullable=True)
+    created = db.Column(db.DateTime(), nullable=False, default=sqlalchemy.func.now())
+
+    request = db.relationship('Request')
+
+    @property
+    def args(self):
+        """Return the Python representation of the JSON arguments of the task."""
+        return json.loads(self._args)
+
+    @args.setter
+    def args(self, args):
+        """
+        Set the args column to the input arguments as a JSON string.
+
+        :param list args: the positional arguments of the task
+        """
+        self._args = json.dumps(args)
+
+    def __repr__(self):
+        return '<TaskOutbox id={} task_name="{}" request_id={}>'.format(
+            self.id, self.task_name, self.request_id
+        )
+
+
 class User(db.Model, UserMixin):
     """Represents an external user that owns an IIB request."""
 
@@ -1352,3 +1539,130 @@ def validate_request_params(request_params, required_params, optional_params):
             and not request_params[param]
         ):
             del request_params[param]
+
+
+def _get_or_create_many(model, column, values):
+    """
+    Get the rows of the model by the values of a unique column and create the missing ones in bulk.
+
+    The missing rows are inserted while ignoring the rows that were inserted concurrently by another
+    transaction, so that concurrent requests referencing the same new rows don't fail on the unique
+    constraint. On PostgreSQL, this uses ``INSERT ... ON CONFLICT DO NOTHING RETURNING`` so that
+    the inserted rows don't need to be queried afterwards. On SQLite, this uses
+    ``INSERT OR IGNORE`` and the inserted rows are then queried.
+
+    :param db.Model model: the model of the rows
+    :param sqlalchemy.Column column: the unique column of the model to match the values on
+    :param set values: the values of the unique column
+    :return: a dictionary with the values as keys and the objects of the model as values
+    :rtype: dict
+    """
+
+    def _chunks(values):
+        values = sorted(values)
+        # Keep the number of parameters of each statement below the default limit of SQLite
+        for start in range(0, len(values), 500):
+            end = start + 500
+            yield values[start:end]
+
+    def _query(values):
+        rv = {}
+        for chunk in _chunks(values):
+            for obj in model.query.filter(column.in_(chunk)):
+                rv[getattr(obj, column.key)] = obj
+        return rv
+
+    rv = _query(values)
+    missing = values - rv.keys()
+    if not missing:
+        return rv
+
+    table = model.__table__
+    mapper = sqlalchemy.inspect(model)
+    dialect = db.session.get_bind().dialect.name
+    for chunk in _chunks(missing):
+        rows = [{column.key: value} for value in chunk]
+        if dialect == 'postgresql':
+            result = db.session.execute(
+                postgresql.insert(table)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[column])
+                .returning(*table.columns)
+            )
+            for row in result:
+                obj = model(**{mapper.get_property_by_column(c).key: row[c] for c in table.columns})
+                # Add the object to the session as if it was queried, since it's already inserted
+                make_transient_to_detached(obj)
+                db.session.add(obj)
+                rv[getattr(obj, column.key)] = obj
+        elif dialect == 'sqlite':
+            db.session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+        else:
+            db.session.execute(table.insert(), rows)
+
+    # Query the rows which were inserted but not returned, including the rows which were inserted
+    # concurrently by another transaction
+    rv.update(_query(values - rv.keys()))
+    return rv
+
+
+def _get_or_create_list(model, values, objects=None):
+    """
+    Get or create the objects of the model by the values of their unique column in bulk.
+
+    :param db.Model model: the model of the objects, which must implement ``get_or_create_many``
+    :param list values: the values of the unique column of the objects
+    :param dict objects: the objects which were already retrieved keyed by the values of their
+        unique column; only the objects which aren't in it are retrieved
+    :return: the objects in the same order as the values
+    :rtype: list
+    :raise ValidationError: if one of the values is invalid
+    """
+    objects = objects or {}
+    missing = set(values) - objects.keys()
+    if missing:
+        objects = {**objects, **model.get_or_create_many(missing)}
+    return [objects[value] for value in values]
+
+
+def reserve_primary_keys(objects):
+    """
+    Assign the primary keys of the new objects from the sequences of their tables in advance.
+
+    When the primary keys of new objects are set, SQLAlchemy inserts the objects of a table with a
+    single executemany statement instead of one statement per object to get its primary key. This
+    is only supported on PostgreSQL, so the objects are left unchanged on other databases.
+
+    :param iterable objects: the new objects which will be inserted on the next flush
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+
+    objects_by_mapper = {}
+    # Assign the primary keys in the order the objects were added to the session, which is the
+    # order they would have been inserted in otherwise
+    for obj in sorted(objects, key=lambda obj: sqlalchemy.inspect(obj).insert_order or 0):
+        mapper = sqlalchemy.inspect(obj).mapper.base_mapper
+        if len(mapper.primary_key) != 1:
+            continue
+        key = mapper.get_property_by_column(mapper.primary_key[0]).key
+        if getattr(obj, key) is None:
+            objects_by_mapper.setdefault(mapper, []).append(obj)
+
+    for mapper, mapper_objects in objects_by_mapper.items():
+        column = mapper.primary_key[0]
+        key = mapper.get_property_by_column(column).key
+        result = db.session.execute(
+            sqlalchemy.text(
+                'SELECT nextval(pg_get_serial_sequence(:table, :column)) '
+                'FROM generate_series(1, :count)'
+            ),
+            {'table': column.table.name, 'column': column.name, 'count': len(mapper_objects)},
+        )
+        ids = [row[0] for row in result]
+        # The table doesn't have a sequence, so the database must generate its primary keys
+        if None in ids:
+            continue
+
+        for obj, id_ in zip(mapper_objects, sorted(ids)):
+            setattr(obj, key, id_)
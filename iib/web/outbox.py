@@ -0,0 +1,243 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import socket
+import time
+
+from flask import current_app
+import kombu.exceptions
+
+from iib.web import db, messaging
+from iib.web.models import RequestStateMapping, TaskOutbox
+from iib.workers.tasks.celery import app as celery_app
+from iib.workers.tasks.general import failed_request_callback
+
+__all__ = ['add_task_to_outbox', 'dispatch_tasks', 'run_task_dispatcher']
+
+
+def add_task_to_outbox(task, request, args, queue=None, safe_args=None):
+    """
+    Add the Celery task of the request to the outbox without committing it.
+
+    The task is sent to the broker by the task dispatcher once it's committed with the request.
+    Note that the arguments are stored as is until the task is sent, including secrets such as
+    ``cnr_token``, so only ``safe_args`` should ever be logged.
+
+    :param celery.app.task.Task task: the task to schedule
+    :param Request request: the request the task processes
+    :param list args: the positional arguments of the task
+    :param str queue: the name of the Celery queue to send the task to; if ``None``, the default
+        queue is used
+    :param list safe_args: the arguments of the task with the secrets redacted to log in the
+        worker instead of ``args``
+    :return: the task in the outbox
+    :rtype: TaskOutbox
+    """
+    task_outbox = TaskOutbox(
+        request=request,
+        task_name=task.name,
+        args=args,
+        argsrepr=repr(safe_args) if safe_args is not None else None,
+        queue=queue,
+    )
+    db.session.add(task_outbox)
+    return task_outbox
+
+
+def _fail_request(task_outbox):
+    """
+    Set the request of the task that can't be scheduled as failed and remove the task.
+
+    :param TaskOutbox task_outbox: the task that can't be scheduled
+    """
+    request = task_outbox.request
+    db.session.delete(task_outbox)
+    if request.state.state_name not in RequestStateMapping.get_final_states():
+        request.add_state('failed', 'The scheduling of the request failed')
+    db.session.commit()
+    messaging.send_message_for_state_change(request)
+
+
+class _PublisherConfirms:
+    """
+    Collect the publisher confirms of the messages published on a channel.
+
+    Publisher confirms are a RabbitMQ extension, so when the transport doesn't support them, the
+    messages are considered confirmed once they're published.
+    """
+
+    def __init__(self, channel):
+        """
+        Enable the publisher confirms on the channel.
+
+        The channel must be new, since the delivery tags of the messages are assumed to start at 1.
+
+        :param kombu.transport.virtual.Channel channel: the channel the messages are published on
+        """
+        self.channel = channel
+        self.enabled = hasattr(channel, 'confirm_select')
+        self.acked = set()
+        self.nacked = set()
+        if self.enabled:
+            channel.events['basic_ack'].add(self._on_ack)
+            channel.events['basic_nack'].add(self._on_nack)
+            channel.confirm_select()
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._add_confirms(self.acked, delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self._add_confirms(self.nacked, delivery_tag, multiple)
+
+    def _add_confirms(self, confirms, delivery_tag, multiple):
+        # If multiple is set, all the messages up to the delivery tag are confirmed at once
+        delivery_tags = range(1, delivery_tag + 1) if multiple else (delivery_tag,)
+        confirms.update(
+            tag for tag in delivery_tags if tag not in self.acked and tag not in self.nacked
+        )
+
+    def wait(self, connection, count, timeout):
+        """
+        Wait for the broker to confirm the published messages.
+
+        :param kombu.Connection connection: the connection of the channel
+        :param int count: the number of messages that were published on the channel
+        :param float timeout: the maximum number of seconds to wait for the confirms
+        :return: the delivery tags of the messages the broker acknowledged, which start at 1 in
+            the order the messages were published
+        :rtype: set
+        """
+        if not self.enabled:
+            return set(range(1, count + 1))
+
+        deadline = time.monotonic() + timeout
+        while len(self.acked) + len(self.nacked) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                break
+
+        return self.acked
+
+
+def dispatch_tasks(limit):
+    """
+    Send the tasks in the outbox to the broker in the order they were added.
+
+    The tasks are published on a single channel from the connection pool, and the publisher
+    confirms of all the tasks are collected once they're published instead of after each task.
+    The tasks the broker confirmed are removed from the outbox in the same transaction. The tasks
+    that weren't confirmed, because the broker rejected them, didn't confirm them in time or is
+    unavailable, are kept in the outbox to be sent on the next call. Since the transaction is
+    committed after the tasks are sent, a task may be sent more than once.
+
+    The tasks are locked while they're sent, so several dispatchers can run concurrently on
+    databases that support skipping locked rows, such as PostgreSQL.
+
+    :param int limit: the maximum number of tasks to send
+    :return: the number of tasks that were sent
+    :rtype: int
+    """
+    tasks = (
+        TaskOutbox.query.order_by(TaskOutbox.id)
+        .with_for_update(skip_locked=True)
+        .limit(limit)
+        .all()
+    )
+    if not tasks:
+        db.session.commit()
+        return 0
+
+    published = []
+    acked = set()
+    failed_task = None
+    try:
+        with celery_app.connection_or_acquire() as connection:
+            # A new channel is used so that the delivery tags of the publisher confirms start at 1
+            channel = connection.channel()
+            try:
+                confirms = _PublisherConfirms(channel)
+                producer = celery_app.amqp.Producer(channel)
+                for task_outbox in tasks:
+                    try:
+                        # Retrying would publish the remaining tasks on another channel without
+                        # publisher confirms, so the tasks are sent again from the outbox instead
+                        celery_app.send_task(
+                            task_outbox.task_name,
+                            args=task_outbox.args,
+                            argsrepr=task_outbox.argsrepr,
+                            link_error=failed_request_callback.s(task_outbox.request_id),
+                            producer=producer,
+                            queue=task_outbox.queue,
+                            retry=False,
+                        )
+                    except kombu.exceptions.OperationalError:
+                        raise
+                    except Exception:
+                        # The task itself is invalid, so it's never going to be sent
+                        current_app.logger.exception(
+                            'The scheduling of the build request with ID %d failed',
+                            task_outbox.request_id,
+                        )
+                        failed_task = task_outbox
+                        break
+                    published.append(task_outbox)
+
+                acked = confirms.wait(
+                    connection,
+                    len(published),
+                    current_app.config['IIB_TASK_DISPATCH_CONFIRM_TIMEOUT'],
+                )
+            finally:
+                channel.close()
+    except Exception:
+        # The connection to the broker can fail at any point, including while waiting for the
+        # publisher confirms, in which case the tasks that weren't confirmed are sent again later
+        current_app.logger.exception(
+            'Failed to send the tasks to the broker, %d tasks will be sent later',
+            len(tasks) - len(acked),
+        )
+    else:
+        unconfirmed = len(published) - len(acked)
+        if unconfirmed:
+            current_app.logger.warning(
+                'The broker did not confirm %d tasks, they will be sent later', unconfirmed
+            )
+
+    dispatched = 0
+    for delivery_tag, task_outbox in enumerate(published, start=1):
+        if delivery_tag in acked:
+            current_app.logger.debug(
+                'Sent the task %s of the request %d to the broker',
+                task_outbox.task_name,
+                task_outbox.request_id,
+            )
+            db.session.delete(task_outbox)
+            dispatched += 1
+
+    db.session.commit()
+    if failed_task:
+        _fail_request(failed_task)
+
+    if dispatched:
+        current_app.logger.info('Sent %d tasks to the broker', dispatched)
+    return dispatched
+
+
+def run_task_dispatcher(once=False):
+    """
+    Send the tasks in the outbox to the broker as they're added.
+
+    :param bool once: if ``True``, return once the outbox is empty or the broker is unavailable
+    """
+    conf = current_app.config
+    batch_size = conf['IIB_TASK_DISPATCH_BATCH_SIZE']
+    while True:
+        dispatched = dispatch_tasks(batch_size)
+        # Send the next batch of tasks right away if the outbox may not be empty
+        if dispatched == batch_size:
+            continue
+        if once:
+            return
+        time.sleep(conf['IIB_TASK_DISPATCH_INTERVAL'])
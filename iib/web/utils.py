@@ -1,5 +1,90 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
-from flask import request, url_for
+import math
+import zlib
+
+from flask import current_app, request, url_for
+
+
+class IDPagination(object):
+    """A page of a query paginated by seeking on the ID of the items instead of using an offset."""
+
+    def __init__(self, items, per_page, total=None, has_next=False, has_prev=False):
+        """
+        Initialize the page.
+
+        :param list items: the items on the page ordered by their descending ID
+        :param int per_page: the maximum number of items on a page
+        :param int total: the total number of items or ``None`` if they weren't counted
+        :param bool has_next: if ``True``, there are items after this page
+        :param bool has_prev: if ``True``, there are items before this page
+        """
+        self.items = items
+        self.per_page = per_page
+        self.total = total
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def pages(self):
+        """
+        Get the total number of pages.
+
+        :return: the total number of pages or ``None`` if the items weren't counted
+        :rtype: int
+        """
+        if self.total is None:
+            return None
+        return max(math.ceil(self.total / self.per_page), 1)
+
+
+def paginate_by_id(query, id_column, per_page, after_id=None, before_id=None, count=True):
+    """
+    Paginate the query by seeking on the ID of the items.
+
+    Unlike ``flask_sqlalchemy.BaseQuery.paginate``, the cost of getting a page doesn't depend on
+    how deep the page is since the index on the ID is used to find the first item on the page.
+    The items are ordered by their descending ID.
+
+    :param flask_sqlalchemy.BaseQuery query: the query to paginate
+    :param sqlalchemy.Column id_column: the unique column of the ``id`` attribute of the items
+    :param int per_page: the maximum number of items on a page
+    :param int after_id: if set, the page has the items with an ID lower than this
+    :param int before_id: if set, the page has the items with an ID greater than this
+    :param bool count: if ``False``, the total number of items isn't counted, which is expensive
+        on large tables
+    :return: the page
+    :rtype: IDPagination
+    """
+    total = query.order_by(None).count() if count else None
+    if before_id is not None:
+        # Get the items closest to the cursor and then put them back in the descending order
+        rows = query.filter(id_column > before_id).order_by(id_column.asc()).limit(per_page + 1)
+        rows = rows.all()
+        items = list(reversed(rows[:per_page]))
+        has_prev = len(rows) > per_page
+        has_next = bool(items) and _exists(query.filter(id_column < items[-1].id))
+    else:
+        if after_id is not None:
+            rows = query.filter(id_column < after_id)
+        else:
+            rows = query
+        rows = rows.order_by(id_column.desc()).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_next = len(rows) > per_page
+        has_prev = bool(items) and _exists(query.filter(id_column > items[0].id))
+
+    return IDPagination(items, per_page, total, has_next, has_prev)
+
+
+def _exists(query):
+    """
+    Determine if the query returns any rows.
+
+    :param flask_sqlalchemy.BaseQuery query: the query
+    :return: ``True`` if the query returns any rows
+    :rtype: bool
+    """
+    return query.session.query(query.exists()).scalar()
 
 
 def pagination_metadata(pagination_query, **kwargs):
@@ -8,10 +93,14 @@ def pagination_metadata(pagination_query, **kwargs):
 
     This must be run as part of a Flask request.
 
-    :param flask_sqlalchemy.Pagination pagination_query: the paginated query
+    :param pagination_query: the paginated query
+    :type pagination_query: flask_sqlalchemy.Pagination or IDPagination
     :param dict kwargs: the query parameters to add to the URLs
     :return: a dictionary containing metadata about the paginated query
     """
+    if isinstance(pagination_query, IDPagination):
+        return _id_pagination_metadata(pagination_query, **kwargs)
+
     pagination_data = {
         'first': url_for(
             request.endpoint, page=1, per_page=pagination_query.per_page, _external=True, **kwargs
@@ -51,6 +140,49 @@ def pagination_metadata(pagination_query, **kwargs):
     return pagination_data
 
 
+def _id_pagination_metadata(pagination_query, **kwargs):
+    """
+    Return a dictionary containing metadata about the query paginated by ID.
+
+    The next and previous links use the IDs of the last and first items on the page as cursors.
+
+    :param IDPagination pagination_query: the paginated query
+    :param dict kwargs: the query parameters to add to the URLs
+    :return: a dictionary containing metadata about the paginated query
+    """
+    per_page = pagination_query.per_page
+    pagination_data = {
+        'first': url_for(request.endpoint, per_page=per_page, _external=True, **kwargs),
+        # The oldest items are the ones with an ID greater than 0 which is lower than all IDs
+        'last': url_for(request.endpoint, before_id=0, per_page=per_page, _external=True, **kwargs),
+        'next': None,
+        'page': None,
+        'pages': pagination_query.pages,
+        'per_page': per_page,
+        'previous': None,
+        'total': pagination_query.total,
+    }
+
+    if pagination_query.has_prev:
+        pagination_data['previous'] = url_for(
+            request.endpoint,
+            before_id=pagination_query.items[0].id,
+            per_page=per_page,
+            _external=True,
+            **kwargs,
+        )
+    if pagination_query.has_next:
+        pagination_data['next'] = url_for(
+            request.endpoint,
+            after_id=pagination_query.items[-1].id,
+            per_page=per_page,
+            _external=True,
+            **kwargs,
+        )
+
+    return pagination_data
+
+
 def str_to_bool(item):
     """
     Convert a string to a boolean.
@@ -63,3 +195,64 @@ def str_to_bool(item):
         return item.lower() in ('true', '1')
     else:
         return False
+
+
+def iter_file_chunks(path, start, length, chunk_size=64 * 1024):
+    """
+    Read a part of a file in chunks.
+
+    The file is only opened once the first chunk is requested, so nothing is left open if the
+    response body is never sent, such as for ``HEAD`` requests.
+
+    :param str path: the path to the file
+    :param int start: the position of the first byte to read
+    :param int length: the maximum number of bytes to read
+    :param int chunk_size: the maximum size of each chunk
+    :return: a generator of the chunks as bytes
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def gzip_chunks(chunks):
+    """
+    Compress the chunks in the gzip format as they are read.
+
+    :param iterable chunks: the chunks as bytes
+    :return: a generator of the compressed chunks
+    """
+    # Adding 16 to the window size makes zlib write the gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def is_privileged_user(username):
+    """
+    Determine if the user can perform privileged actions.
+
+    :param str username: the username of the user
+    :return: ``True`` if the user is in ``IIB_PRIVILEGED_USERNAMES``
+    :rtype: bool
+    """
+    return username in current_app.extensions['iib_privileged_usernames']
+
+
+def is_worker_user(username):
+    """
+    Determine if the user is an IIB worker.
+
+    :param str username: the username of the user
+    :return: ``True`` if the user is in ``IIB_WORKER_USERNAMES``
+    :rtype: bool
+    """
+    return username in current_app.extensions['iib_worker_usernames']
@@ -1,6 +1,8 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from contextlib import contextmanager
 import json
 import logging
+import threading
 
 import requests
 from requests.packages.urllib3.util.retry import Retry
@@ -10,6 +12,13 @@ from iib.exceptions import IIBError
 
 log = logging.getLogger(__name__)
 
+# The states after which the worker no longer updates the request
+TERMINAL_STATES = ('complete', 'failed')
+
+# The active update buffers keyed by the ID of the request they buffer the updates of
+_buffers = {}
+_buffers_lock = threading.Lock()
+
 
 def get_requests_session(auth=False):
     """
@@ -33,6 +42,47 @@ def get_requests_session(auth=False):
     return session
 
 
+class ThreadLocalSession(object):
+    """
+    A requests session that can be shared between threads.
+
+    ``requests.Session`` is not guaranteed to be thread-safe, so the attributes are looked up on a
+    separate session created for every thread that uses it.
+    """
+
+    def __init__(self, auth=False):
+        """
+        Initialize the thread-local session.
+
+        :param bool auth: configure authentication on the sessions
+        """
+        self._auth = auth
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """
+        Get the requests session of the current thread.
+
+        :return: the requests session
+        :rtype: requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = get_requests_session(auth=self._auth)
+            self._local.session = session
+        return session
+
+    def __getattr__(self, name):
+        """
+        Get the attribute of the requests session of the current thread.
+
+        :param str name: the name of the attribute
+        :return: the attribute
+        """
+        return getattr(self.session, name)
+
+
 def get_request(request_id):
     """
     Get the IIB build request from the REST API.
@@ -116,9 +166,34 @@ def update_request(request_id, payload, exc_msg=None):
     """
     Update the IIB build request.
 
+    If the updates of the request are buffered with ``buffer_request_updates``, the update is
+    added to the buffer and sent later.
+
     :param int request_id: the ID of the IIB request
     :param dict payload: the payload to send to the PATCH API endpoint
     :param str exc_msg: an optional custom exception that can be a template
+    :return: the updated request or ``None`` if the update was buffered
+    :rtype: dict or None
+    :raises IIBError: if the request to the IIB API fails
+    """
+    with _buffers_lock:
+        buffer = _buffers.get(request_id)
+    if buffer:
+        buffer.add(payload, exc_msg)
+        return None
+
+    return _patch_request(request_id, payload, exc_msg)
+
+
+def _patch_request(request_id, payload, exc_msg=None, url_suffix=''):
+    """
+    Send the PATCH request to the IIB API.
+
+    :param int request_id: the ID of the IIB request
+    :param payload: the payload to send to the PATCH API endpoint
+    :type payload: dict or list
+    :param str exc_msg: an optional custom exception that can be a template
+    :param str url_suffix: the path to append to the URL of the request
     :return: the updated request
     :rtype: dict
     :raises IIBError: if the request to the IIB API fails
@@ -127,7 +202,7 @@ def update_request(request_id, payload, exc_msg=None):
     from iib.workers.config import get_worker_config
 
     config = get_worker_config()
-    request_url = f'{config.iib_api_url.rstrip("/")}/builds/{request_id}'
+    request_url = f'{config.iib_api_url.rstrip("/")}/builds/{request_id}{url_suffix}'
     log.info('Patching the request %d with %r', request_id, payload)
 
     try:
@@ -145,7 +220,8 @@ def update_request(request_id, payload, exc_msg=None):
             rv.text,
         )
         if exc_msg:
-            _exc_msg = exc_msg.format(**payload)
+            # The exception message of a batch of updates is formatted with the last update
+            _exc_msg = exc_msg.format(**(payload[-1] if isinstance(payload, list) else payload))
         else:
             _exc_msg = f'The worker failed to update the request {request_id}'
         raise IIBError(_exc_msg)
@@ -153,5 +229,169 @@ def update_request(request_id, payload, exc_msg=None):
     return rv.json()
 
 
+class RequestUpdateBuffer(object):
+    """
+    Buffer the updates of a request so that several of them are sent in a single API call.
+
+    Consecutive updates are merged into a single update unless they both set the state, in which
+    case both state transitions are kept and sent together using the batch update API endpoint.
+    The buffer is flushed ``iib_api_update_flush_interval`` seconds after the first buffered
+    update, when ``flush`` is called at the end of a phase, and always before a terminal state is
+    set.
+    """
+
+    def __init__(self, request_id, flush_interval):
+        """
+        Initialize the buffer.
+
+        :param int request_id: the ID of the IIB request
+        :param int flush_interval: the maximum number of seconds to keep an update buffered
+        """
+        self.request_id = request_id
+        self.flush_interval = flush_interval
+        # Each item is a tuple of the payload and the optional exception message template
+        self._updates = []
+        self._lock = threading.RLock()
+        self._timer = None
+        self._error = None
+
+    def add(self, payload, exc_msg=None):
+        """
+        Add the update to the buffer.
+
+        :param dict payload: the payload to send to the PATCH API endpoint
+        :param str exc_msg: an optional custom exception that can be a template
+        :raises IIBError: if flushing the buffer fails
+        """
+        with self._lock:
+            if self._updates and not ('state' in payload and 'state' in self._updates[-1][0]):
+                last_payload, last_exc_msg = self._updates[-1]
+                self._updates[-1] = ({**last_payload, **payload}, exc_msg or last_exc_msg)
+            else:
+                self._updates.append((dict(payload), exc_msg))
+
+            terminal = payload.get('state') in TERMINAL_STATES
+            if not terminal and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+        # The buffer is flushed without holding the lock since flushing waits for the timer thread
+        if terminal:
+            self.flush()
+
+    def _flush_on_timer(self):
+        """Flush the buffer from the timer thread and store the error to raise it later."""
+        # The lock is held until the error is stored so that the next flush always raises it
+        with self._lock:
+            try:
+                self.flush()
+            except Exception as e:
+                self._error = e
+
+    def flush(self):
+        """
+        Send the buffered updates to the IIB API.
+
+        If sending the updates fails, they are kept in the buffer to be sent on the next flush.
+
+        :raises IIBError: if the request to the IIB API fails, including a failure of a previous
+            flush triggered by the timer
+        """
+        with self._lock:
+            timer = self._timer
+            self._timer = None
+            if timer:
+                timer.cancel()
+
+        try:
+            self._send()
+        finally:
+            # Wait for the timer thread in case it already started flushing so that it doesn't
+            # outlive the buffer
+            if timer and timer is not threading.current_thread():
+                timer.join()
+
+    def _send(self):
+        """
+        Send the buffered updates to the IIB API and remove them from the buffer once they're sent.
+
+        :raises IIBError: if the request to the IIB API fails, including a failure of a previous
+            flush triggered by the timer
+        """
+        with self._lock:
+            error = self._error
+            self._error = None
+            if error:
+                raise error
+            updates = self._updates
+            if not updates:
+                return
+
+            if len(updates) == 1:
+                payload, exc_msg = updates[0]
+                _patch_request(self.request_id, payload, exc_msg)
+            else:
+                payloads = [payload for payload, _ in updates]
+                _patch_request(self.request_id, payloads, updates[-1][1], url_suffix='/updates')
+            self._updates = []
+
+
+@contextmanager
+def buffer_request_updates(request_id):
+    """
+    Buffer the updates of the request made with ``update_request`` and ``set_request_state``.
+
+    The buffered updates are flushed when the context manager exits. If
+    ``iib_api_update_flush_interval`` is ``0``, the updates are not buffered.
+
+    :param int request_id: the ID of the IIB request
+    :raises IIBError: if flushing the updates fails
+    """
+    # Prevent a circular import
+    from iib.workers.config import get_worker_config
+
+    flush_interval = get_worker_config().iib_api_update_flush_interval
+    with _buffers_lock:
+        if not flush_interval or request_id in _buffers:
+            buffer = None
+        else:
+            buffer = _buffers[request_id] = RequestUpdateBuffer(request_id, flush_interval)
+
+    if not buffer:
+        yield
+        return
+
+    try:
+        yield
+    except Exception:
+        # Don't hide the original error if the updates also fail to be sent
+        try:
+            buffer.flush()
+        except Exception:
+            log.exception('Failed to send the buffered updates of the request %d', request_id)
+        raise
+    else:
+        buffer.flush()
+    finally:
+        with _buffers_lock:
+            del _buffers[request_id]
+
+
+def flush_request_updates(request_id):
+    """
+    Send the buffered updates of the request to the IIB API.
+
+    This should be called at the end of a phase whose updates should be visible right away.
+
+    :param int request_id: the ID of the IIB request
+    :raises IIBError: if the request to the IIB API fails
+    """
+    with _buffers_lock:
+        buffer = _buffers.get(request_id)
+    if buffer:
+        buffer.flush()
+
+
 requests_auth_session = get_requests_session(auth=True)
 requests_session = get_requests_session()
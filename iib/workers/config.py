@@ -12,26 +12,44 @@ class Config(object):
     # When publishing a message, don't continuously retry or else the HTTP connection times out
     broker_transport_options = {'max_retries': 10}
     iib_api_timeout = 30
+    iib_api_update_flush_interval = 2
+    iib_build_concurrency = 4
     iib_docker_config_template = os.path.join(
         os.path.expanduser('~'), '.docker', 'config.json.template'
     )
+    iib_greenwave_concurrency = 5
+    iib_greenwave_decision_cache_ttl = 60
+    iib_greenwave_timeout = 30
     iib_greenwave_url = None
-    iib_grpc_init_wait_time = 3
-    iib_grpc_max_port_tries = 100
+    iib_grpc_init_wait_time = 30
     iib_grpc_max_tries = 5
-    iib_grpc_start_port = 50051
     iib_image_push_template = '{registry}/iib-build:{request_id}'
+    # 20 GiB
+    iib_image_storage_max_size = 20 * 1024 ** 3
+    iib_index_db_cache_dir = None
+    # 5 GiB
+    iib_index_db_cache_max_size = 5 * 1024 ** 3
     iib_index_image_output_registry = None
+    iib_index_registry_pool_size = 4
+    iib_legacy_export_concurrency = 4
     iib_log_level = 'INFO'
+    iib_omps_timeout = 120
     iib_organization_customizations = {}
+    iib_registry_client_timeout = 30
     iib_request_logs_dir = None
     iib_request_logs_format = (
         '%(asctime)s %(name)s %(levelname)s %(module)s.%(funcName)s %(message)s'
     )
     iib_request_logs_level = 'DEBUG'
     iib_required_labels = {}
+    iib_resolve_concurrency = 5
+    iib_skopeo_cache_dir = None
+    iib_skopeo_cache_max_entries = 2048
+    iib_skopeo_cache_max_files = 10000
+    iib_skopeo_cache_tag_ttl = 30
     iib_skopeo_timeout = '300s'
     iib_total_attempts = 5
+    iib_use_registry_client = False
     include = [
         'iib.workers.tasks.build',
         'iib.workers.tasks.build_merge_index_image',
@@ -183,14 +201,42 @@ def validate_celery_config(conf, **kwargs):
                 'must be a string'
             )
 
-    iib_request_logs_dir = conf.get('iib_request_logs_dir')
-    if iib_request_logs_dir:
-        if not os.path.isdir(iib_request_logs_dir):
-            raise ConfigError(
-                f'iib_request_logs_dir, {iib_request_logs_dir}, must exist and be a directory'
-            )
-        if not os.access(iib_request_logs_dir, os.W_OK):
-            raise ConfigError(f'iib_request_logs_dir, {iib_request_logs_dir}, is not writable!')
+    for directory_key in ('iib_index_db_cache_dir', 'iib_request_logs_dir', 'iib_skopeo_cache_dir'):
+        directory = conf.get(directory_key)
+        if not directory:
+            continue
+
+        if not os.path.isdir(directory):
+            raise ConfigError(f'{directory_key}, {directory}, must exist and be a directory')
+        if not os.access(directory, os.W_OK):
+            raise ConfigError(f'{directory_key}, {directory}, is not writable!')
+
+    for key in (
+        'iib_build_concurrency',
+        'iib_greenwave_concurrency',
+        'iib_legacy_export_concurrency',
+        'iib_resolve_concurrency',
+    ):
+        value = conf.get(key, 1)
+        if not isinstance(value, int) or value < 1:
+            raise ConfigError(f'{key} must be a positive integer')
+
+    for key in (
+        'iib_api_update_flush_interval',
+        'iib_greenwave_decision_cache_ttl',
+        'iib_greenwave_timeout',
+        'iib_image_storage_max_size',
+        'iib_index_db_cache_max_size',
+        'iib_index_registry_pool_size',
+        'iib_omps_timeout',
+        'iib_registry_client_timeout',
+        'iib_skopeo_cache_max_entries',
+        'iib_skopeo_cache_max_files',
+        'iib_skopeo_cache_tag_ttl',
+    ):
+        value = conf.get(key, 0)
+        if not isinstance(value, int) or value < 0:
+            raise ConfigError(f'{key} must be a non-negative integer')
 
 
 def get_worker_config():
@@ -1,26 +1,37 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import json
 import logging
+import threading
+import time
 
 import requests
 
 from iib.exceptions import IIBError
+from iib.workers.api_utils import ThreadLocalSession
 from iib.workers.config import get_worker_config
 from iib.workers.tasks.utils import get_image_labels
 
 log = logging.getLogger(__name__)
 
+# The Greenwave decisions keyed by the tuple of the Koji build NVR, decision context, product
+# version, and subject type. The values are tuples of the expiration time and the decision.
+_decision_cache = {}
+_decision_cache_lock = threading.Lock()
 
-def gate_bundles(bundles, greenwave_config):
+
+def gate_bundles(bundles, greenwave_config, image_metadata=None):
     """
     Check if all bundle images have passed gating tests in the CVP pipeline.
 
     This function queries Greenwave to check if the policies are satisfied for each bundle image.
+    Up to ``iib_greenwave_concurrency`` bundles are gated concurrently.
 
     :param list bundles: a list of strings representing the pull specifications of the bundles to
         be gated.
     :param dict greenwave_config: the dict of config required to query Greenwave to gate bundles.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :raises IIBError: if any of the bundles fail the gating checks or IIB fails to get a
         response from Greenwave.
     """
@@ -28,65 +39,129 @@ def gate_bundles(bundles, greenwave_config):
     _validate_greenwave_params_and_config(conf, greenwave_config)
 
     log.info('Gating on bundles: %s', ', '.join(bundles))
-    gating_unsatisfied_bundles = []
-    testcases = []
-    for bundle in bundles:
-        koji_build_nvr = _get_koji_build_nvr(bundle)
-        log.debug('Querying Greenwave for decision on %s', koji_build_nvr)
-        payload = deepcopy(greenwave_config)
-        payload['subject_identifier'] = koji_build_nvr
-        log.debug(
-            'Querying Greenwave with decision_context: %s, product_version: %s, '
-            'subject_identifier: %s and subject_type: %s',
-            payload["decision_context"],
-            payload["product_version"],
-            payload["subject_identifier"],
-            payload["subject_type"],
-        )
+    concurrency = min(conf.get('iib_greenwave_concurrency', 1), len(bundles))
+    if concurrency <= 1:
+        decisions = [
+            _get_gating_decision(bundle, greenwave_config, image_metadata) for bundle in bundles
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(_get_gating_decision, bundle, greenwave_config, image_metadata)
+                for bundle in bundles
+            ]
+            try:
+                # Collect the decisions in the input order so that if multiple bundles fail to be
+                # gated, the error of the first one in the input is always the one raised
+                decisions = [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
-        request_url = f'{conf["iib_greenwave_url"].rstrip("/")}/decision'
-        resp = requests.post(request_url, json=payload)
-        try:
-            data = resp.json()
-        except json.JSONDecodeError:
-            log.error('Error encountered in decoding JSON %s', resp.text)
-            data = {}
-
-        if not resp.ok:
-            error_msg = data.get('message') or resp.text
-            log.error('Request to Greenwave failed: %s', error_msg)
-            raise IIBError(f'Gating check failed for {bundle}: {error_msg}')
-
-        try:
-            if not data['policies_satisfied']:
-                log.info('Gating decision for %s: %s', bundle, data)
-                gating_unsatisfied_bundles.append(bundle)
-                testcases = [item['testcase'] for item in data.get('unsatisfied_requirements', [])]
-
-        except KeyError:
-            log.error('Missing key "policies_satisfied" for %s: %s', bundle, data)
-            raise IIBError(f'Key "policies_satisfied" missing in Greenwave response for {bundle}')
+    gating_unsatisfied_bundles = []
+    for bundle, data in zip(bundles, decisions):
+        if not data['policies_satisfied']:
+            log.info('Gating decision for %s: %s', bundle, data)
+            testcases = [item['testcase'] for item in data.get('unsatisfied_requirements', [])]
+            gating_unsatisfied_bundles.append(f'{bundle} (test cases: {", ".join(testcases)})')
 
     if gating_unsatisfied_bundles:
         error_msg = (
             f'Unsatisfied Greenwave policy for {", ".join(gating_unsatisfied_bundles)} '
             f'with decision_context: {greenwave_config["decision_context"]}, '
-            f'product_version: {greenwave_config["product_version"]}, '
-            f'subject_type: {greenwave_config["subject_type"]} '
-            f'and test cases: {", ".join(testcases)}'
+            f'product_version: {greenwave_config["product_version"]} '
+            f'and subject_type: {greenwave_config["subject_type"]}'
         )
         raise IIBError(error_msg)
 
 
-def _get_koji_build_nvr(bundle):
+def _get_gating_decision(bundle, greenwave_config, image_metadata=None):
+    """
+    Get the Greenwave decision of the bundle image.
+
+    Decisions are cached for ``iib_greenwave_decision_cache_ttl`` seconds so that the same bundle
+    isn't gated repeatedly when it's part of several requests submitted at the same time.
+
+    :param str bundle: the pull specification of the bundle image to be gated.
+    :param dict greenwave_config: the dict of config required to query Greenwave to gate bundles.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
+    :return: the Greenwave decision, which is guaranteed to have the ``policies_satisfied`` key.
+    :rtype: dict
+    :raises IIBError: if IIB fails to get a valid decision from Greenwave.
+    """
+    conf = get_worker_config()
+    koji_build_nvr = _get_koji_build_nvr(bundle, image_metadata)
+    cache_key = (
+        koji_build_nvr,
+        greenwave_config['decision_context'],
+        greenwave_config['product_version'],
+        greenwave_config['subject_type'],
+    )
+    with _decision_cache_lock:
+        cached = _decision_cache.get(cache_key)
+    if cached and cached[0] > time.time():
+        log.debug('Using the cached Greenwave decision for %s', koji_build_nvr)
+        return cached[1]
+
+    log.debug('Querying Greenwave for decision on %s', koji_build_nvr)
+    payload = deepcopy(greenwave_config)
+    payload['subject_identifier'] = koji_build_nvr
+    log.debug(
+        'Querying Greenwave with decision_context: %s, product_version: %s, '
+        'subject_identifier: %s and subject_type: %s',
+        payload["decision_context"],
+        payload["product_version"],
+        payload["subject_identifier"],
+        payload["subject_type"],
+    )
+
+    request_url = f'{conf["iib_greenwave_url"].rstrip("/")}/decision'
+    try:
+        resp = requests_session.post(
+            request_url, json=payload, timeout=conf.get('iib_greenwave_timeout', 30)
+        )
+    except requests.RequestException:
+        log.exception('The connection to Greenwave failed for %s', bundle)
+        raise IIBError(f'Gating check failed for {bundle}: the connection to Greenwave failed')
+
+    try:
+        data = resp.json()
+    except json.JSONDecodeError:
+        log.error('Error encountered in decoding JSON %s', resp.text)
+        data = {}
+
+    if not resp.ok:
+        error_msg = data.get('message') or resp.text
+        log.error('Request to Greenwave failed: %s', error_msg)
+        raise IIBError(f'Gating check failed for {bundle}: {error_msg}')
+
+    if 'policies_satisfied' not in data:
+        log.error('Missing key "policies_satisfied" for %s: %s', bundle, data)
+        raise IIBError(f'Key "policies_satisfied" missing in Greenwave response for {bundle}')
+
+    ttl = conf.get('iib_greenwave_decision_cache_ttl', 0)
+    if ttl:
+        now = time.time()
+        with _decision_cache_lock:
+            # Remove the expired decisions so that the cache doesn't grow indefinitely
+            for key in [key for key, value in _decision_cache.items() if value[0] <= now]:
+                del _decision_cache[key]
+            _decision_cache[cache_key] = (now + ttl, data)
+
+    return data
+
+
+def _get_koji_build_nvr(bundle, image_metadata=None):
     """
     Get the Koji build NVR of the bundle from its labels.
 
     :param str bundle: the pull specification of the bundle image to be gated.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: the Koji build NVR of the bundle image.
     :rtype: str
     """
-    labels = get_image_labels(bundle)
+    labels = get_image_labels(bundle, image_metadata)
     return '{}-{}-{}'.format(labels['com.redhat.component'], labels['version'], labels['release'])
 
 
@@ -101,3 +176,6 @@ def _validate_greenwave_params_and_config(conf, greenwave_config):
     if not conf.get('iib_greenwave_url'):
         log.error('iib_greenwave_url not set in the Celery config')
         raise IIBError('IIB is not configured to handle gating of bundles')
+
+
+requests_session = ThreadLocalSession()
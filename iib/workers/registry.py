@@ -0,0 +1,603 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+
+from operator_manifest.operator import ImageName
+import requests
+
+from iib.exceptions import IIBError
+from iib.workers.api_utils import ThreadLocalSession
+from iib.workers.config import get_worker_config
+
+log = logging.getLogger(__name__)
+
+MEDIA_TYPE_MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+MEDIA_TYPE_MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MEDIA_TYPE_MANIFEST_V1_SIGNED = 'application/vnd.docker.distribution.manifest.v1+prettyjws'
+MEDIA_TYPE_MANIFEST_V1 = 'application/vnd.docker.distribution.manifest.v1+json'
+MEDIA_TYPE_OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+MEDIA_TYPE_OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+# The same manifest types that skopeo accepts, in the order of preference
+MANIFEST_ACCEPT = ', '.join(
+    (
+        MEDIA_TYPE_MANIFEST_LIST_V2,
+        MEDIA_TYPE_MANIFEST_V2,
+        MEDIA_TYPE_OCI_INDEX,
+        MEDIA_TYPE_OCI_MANIFEST,
+        MEDIA_TYPE_MANIFEST_V1_SIGNED,
+        MEDIA_TYPE_MANIFEST_V1,
+    )
+)
+# Docker Hub is special in that the registry hostname differs from the one in pull specifications
+# and in the Docker configuration
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+DOCKER_HUB_AUTH_KEYS = ('docker.io', 'index.docker.io', 'https://index.docker.io/v1/')
+
+
+class RegistryClient(object):
+    """
+    A minimal Docker Registry HTTP API V2 and OCI distribution client.
+
+    Unlike calling ``skopeo`` for every operation, this client reuses the HTTP connections and the
+    bearer tokens between calls. The credentials are read from ``~/.docker/config.json`` every time
+    a new token is requested so that the credentials set by ``set_registry_token`` are honored.
+    """
+
+    def __init__(self, scheme='https'):
+        """
+        Initialize the registry client.
+
+        :param str scheme: the URL scheme to use when connecting to the registries
+        """
+        self.scheme = scheme
+        self._session = ThreadLocalSession()
+        self._tokens = {}
+        self._tokens_lock = threading.Lock()
+
+    def get_manifest(self, pull_spec):
+        """
+        Get the raw manifest of the container image.
+
+        This is the equivalent of ``skopeo inspect --raw``.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the manifest exactly as returned by the registry
+        :rtype: str
+        :raises IIBError: if the manifest can't be retrieved
+        """
+        return self._get_manifest_response(pull_spec).content.decode('utf-8')
+
+    def get_manifest_digest(self, pull_spec):
+        """
+        Get the digest of the manifest of the container image as computed by the registry.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the digest of the manifest
+        :rtype: str
+        :raises IIBError: if the manifest can't be retrieved or the registry doesn't provide the
+            digest
+        """
+        rv = self._get_manifest_response(pull_spec, method='HEAD')
+        digest = rv.headers.get('Docker-Content-Digest')
+        if not digest:
+            raise IIBError(f'The registry did not return the digest of {pull_spec}')
+        return digest
+
+    def get_config(self, pull_spec, arch='amd64'):
+        """
+        Get the config of the container image.
+
+        This is the equivalent of ``skopeo inspect --config``. If the pull specification points to
+        a manifest list, the config of the Linux image of the input architecture is returned.
+
+        :param str pull_spec: the pull specification of the container image
+        :param str arch: the architecture of the image to use when the pull specification points to
+            a manifest list
+        :return: the image config or ``None`` if the image uses a schema 1 manifest, which doesn't
+            reference a config
+        :rtype: str or None
+        :raises IIBError: if the config can't be retrieved
+        """
+        manifest = self._get_image_manifest(pull_spec, arch)
+        if manifest.get('schemaVersion') != 2 or 'config' not in manifest:
+            log.debug('The manifest of %s does not reference a config', pull_spec)
+            return None
+
+        return self.get_blob(pull_spec, manifest['config']['digest']).decode('utf-8')
+
+    def copy_files(self, pull_spec, src_path, dest_path, arch='amd64'):
+        """
+        Copy a file from the container image into the given destination path.
+
+        This is the equivalent of ``podman cp`` from a container created from the image, but only
+        the layer blobs are downloaded. The layers are read from the top layer to the base layer,
+        so only the first occurrence of a file is written and files removed by whiteouts in upper
+        layers are skipped. Once the path is a file that was copied or it's hidden by the upper
+        layers, the lower layers aren't downloaded.
+
+        Hard links are copied as regular files when their target is copied from the same layer.
+        Special files, such as devices, are skipped.
+
+        :param str pull_spec: the pull specification of the container image
+        :param str src_path: the full path within the container image to copy from; this may be a
+            directory
+        :param str dest_path: the full path on the local host to copy into; if it's an existing
+            directory, the file is copied inside of it
+        :param str arch: the architecture of the image to use when the pull specification points to
+            a manifest list
+        :raises IIBError: if the image uses a schema 1 manifest, the path doesn't exist in the
+            image, the layers can't be retrieved, or a hard link's target isn't copied
+        """
+        manifest = self._get_image_manifest(pull_spec, arch)
+        if manifest.get('schemaVersion') != 2 or 'layers' not in manifest:
+            raise IIBError(f'The manifest of {pull_spec} does not reference any layers')
+
+        src_path = src_path.strip('/')
+        if os.path.isdir(dest_path):
+            dest_path = os.path.join(dest_path, os.path.basename(src_path))
+
+        log.debug('Copying %s from the layers of %s to %s', src_path, pull_spec, dest_path)
+        extractor = _LayerExtractor(src_path, dest_path)
+        for layer in reversed(manifest['layers']):
+            rv = self.get_blob(pull_spec, layer['digest'], stream=True)
+            try:
+                extractor.extract_layer(rv.raw)
+            except (tarfile.TarError, OSError):
+                log.exception('Failed to extract the layer %s of %s', layer['digest'], pull_spec)
+                raise IIBError(f'Failed to extract the layer {layer["digest"]} of {pull_spec}')
+            finally:
+                rv.close()
+
+            if extractor.complete:
+                break
+
+        if not extractor.found:
+            raise IIBError(f'The path /{src_path} does not exist in {pull_spec}')
+
+    def get_blob(self, pull_spec, digest, stream=False):
+        """
+        Get a blob from the repository of the container image.
+
+        :param str pull_spec: the pull specification of an image in the repository of the blob
+        :param str digest: the digest of the blob
+        :param bool stream: if ``True``, the response is returned so that the caller can stream
+            the content; the caller is responsible for closing it
+        :return: the content of the blob or the response if ``stream`` is ``True``
+        :rtype: bytes or requests.Response
+        :raises IIBError: if the blob can't be retrieved
+        """
+        image = ImageName.parse(pull_spec)
+        url = self._get_url(image, f'blobs/{digest}')
+        rv = self._request(image, 'GET', url, pull_spec, stream=stream)
+        if stream:
+            return rv
+        return rv.content
+
+    def _get_image_manifest(self, pull_spec, arch):
+        """
+        Get the image manifest, resolving manifest lists to the image of the input architecture.
+
+        :param str pull_spec: the pull specification of the container image
+        :param str arch: the architecture of the image to use when the pull specification points to
+            a manifest list
+        :return: the image manifest
+        :rtype: dict
+        :raises IIBError: if the manifest can't be retrieved
+        """
+        manifest = json.loads(self.get_manifest(pull_spec))
+        media_type = manifest.get('mediaType')
+        if media_type in (MEDIA_TYPE_MANIFEST_LIST_V2, MEDIA_TYPE_OCI_INDEX) or (
+            not media_type and 'manifests' in manifest
+        ):
+            digest = self._get_platform_manifest_digest(pull_spec, manifest, arch)
+            image_name = ImageName.parse(pull_spec).to_str(tag=False)
+            manifest = json.loads(self.get_manifest(f'{image_name}@{digest}'))
+
+        return manifest
+
+    def _get_manifest_response(self, pull_spec, method='GET'):
+        """
+        Request the manifest of the container image.
+
+        :param str pull_spec: the pull specification of the container image
+        :param str method: the HTTP method to use
+        :return: the response
+        :rtype: requests.Response
+        :raises IIBError: if the request fails
+        """
+        image = ImageName.parse(pull_spec)
+        url = self._get_url(image, f'manifests/{image.tag}')
+        return self._request(image, method, url, pull_spec, headers={'Accept': MANIFEST_ACCEPT})
+
+    def _get_platform_manifest_digest(self, pull_spec, manifest_list, arch):
+        """
+        Get the digest of the Linux manifest of the input architecture from the manifest list.
+
+        :param str pull_spec: the pull specification of the manifest list
+        :param dict manifest_list: the manifest list
+        :param str arch: the architecture to look for
+        :return: the digest of the manifest
+        :rtype: str
+        :raises IIBError: if the manifest list doesn't contain the architecture
+        """
+        for manifest in manifest_list.get('manifests', []):
+            platform = manifest.get('platform', {})
+            if platform.get('architecture') == arch and platform.get('os', 'linux') == 'linux':
+                return manifest['digest']
+
+        raise IIBError(f'The manifest list {pull_spec} does not contain a {arch} image')
+
+    def _get_url(self, image, path):
+        """
+        Get the URL of the registry API endpoint for the image repository.
+
+        :param ImageName image: the parsed pull specification
+        :param str path: the path relative to the repository
+        :return: the URL
+        :rtype: str
+        """
+        return f'{self.scheme}://{_get_registry_host(image)}/v2/{_get_repository(image)}/{path}'
+
+    def _request(self, image, method, url, pull_spec, headers=None, stream=False):
+        """
+        Send an authenticated request to the registry.
+
+        If the registry responds with HTTP 401, the authentication challenge is handled and the
+        request is sent again.
+
+        :param ImageName image: the parsed pull specification
+        :param str method: the HTTP method to use
+        :param str url: the URL to send the request to
+        :param str pull_spec: the pull specification, used in error messages
+        :param dict headers: any additional headers to send
+        :param bool stream: if ``True``, the content of the response is not read immediately
+        :return: the response
+        :rtype: requests.Response
+        :raises IIBError: if the request fails
+        """
+        timeout = get_worker_config().iib_registry_client_timeout
+        scope = f'repository:{_get_repository(image)}:pull'
+        registry = _get_registry_host(image)
+        credentials = _get_credentials(image.registry)
+        headers = dict(headers or {})
+        exc_msg = (
+            f'Failed to inspect docker://{pull_spec}. Make sure it exists and is accessible to IIB.'
+        )
+
+        try:
+            token_key = (registry, scope, credentials)
+            auth_header = self._get_cached_auth_header(token_key)
+            if auth_header:
+                headers['Authorization'] = auth_header
+
+            rv = self._session.request(method, url, headers=headers, stream=stream, timeout=timeout)
+            if rv.status_code == 401:
+                rv.close()
+                challenge = rv.headers.get('WWW-Authenticate', '')
+                auth_header = self._authenticate(token_key, challenge, timeout)
+                headers['Authorization'] = auth_header
+                rv = self._session.request(
+                    method, url, headers=headers, stream=stream, timeout=timeout
+                )
+        except requests.RequestException:
+            log.exception('The connection to the registry failed when requesting %s', url)
+            raise IIBError(exc_msg)
+
+        if not rv.ok:
+            log.error(
+                'The registry returned HTTP %d for %s %s: %s',
+                rv.status_code,
+                method,
+                url,
+                rv.text if not stream else '',
+            )
+            rv.close()
+            raise IIBError(exc_msg)
+
+        return rv
+
+    def _get_cached_auth_header(self, token_key):
+        """
+        Get the cached Authorization header value if it hasn't expired.
+
+        :param tuple token_key: the tuple of the registry, scope, and credentials
+        :return: the Authorization header value or ``None``
+        :rtype: str or None
+        """
+        with self._tokens_lock:
+            cached = self._tokens.get(token_key)
+            if cached and cached[1] > time.time():
+                return cached[0]
+            return None
+
+    def _authenticate(self, token_key, challenge, timeout):
+        """
+        Handle the authentication challenge from the registry.
+
+        :param tuple token_key: the tuple of the registry, scope, and credentials
+        :param str challenge: the value of the ``WWW-Authenticate`` header
+        :param int timeout: the timeout of the token request
+        :return: the Authorization header value to use
+        :rtype: str
+        :raises IIBError: if the challenge is unsupported or the token can't be retrieved
+        """
+        registry, scope, credentials = token_key
+        scheme, _, params_str = challenge.partition(' ')
+        scheme = scheme.lower()
+        if scheme == 'basic':
+            if not credentials:
+                raise IIBError(f'The registry {registry} requires credentials but none are set')
+            auth_header = f'Basic {credentials}'
+            # The credentials don't expire, so cache them for as long as the process runs
+            expires = float('inf')
+        elif scheme == 'bearer':
+            params = dict(re.findall(r'(\w+)="([^"]*)"', params_str))
+            if 'realm' not in params:
+                raise IIBError(
+                    f'The registry {registry} returned an invalid authentication challenge'
+                )
+
+            query = {'scope': params.get('scope', scope)}
+            if params.get('service'):
+                query['service'] = params['service']
+            headers = {}
+            if credentials:
+                headers['Authorization'] = f'Basic {credentials}'
+
+            log.debug('Requesting a token for %s from %s', query['scope'], params['realm'])
+            rv = self._session.get(params['realm'], params=query, headers=headers, timeout=timeout)
+            if not rv.ok:
+                log.error(
+                    'Failed to get a token from %s with HTTP %d: %s',
+                    params['realm'],
+                    rv.status_code,
+                    rv.text,
+                )
+                raise IIBError(f'Failed to authenticate to the registry {registry}')
+
+            data = rv.json()
+            token = data.get('token') or data.get('access_token')
+            if not token:
+                raise IIBError(f'The registry {registry} did not return a token')
+            auth_header = f'Bearer {token}'
+            # Expire the token a bit early to account for the time the requests take
+            expires = time.time() + int(data.get('expires_in') or 60) - 10
+        else:
+            raise IIBError(
+                f'The registry {registry} requested an unsupported authentication scheme'
+            )
+
+        with self._tokens_lock:
+            self._tokens[token_key] = (auth_header, expires)
+
+        return auth_header
+
+
+class _LayerExtractor(object):
+    """
+    Extract a path from the layers of a container image.
+
+    The layers must be passed from the top layer to the base layer.
+    """
+
+    def __init__(self, src_path, dest_path):
+        """
+        Initialize the extractor.
+
+        :param str src_path: the path within the container image without the leading slash
+        :param str dest_path: the path on the local host to write ``src_path`` to
+        """
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.found = False
+        # The paths already provided by an upper layer
+        self._seen = set()
+        # The paths removed by a whiteout in an upper layer
+        self._removed = set()
+        # The directories whose contents in lower layers were hidden by an upper layer
+        self._opaque = set()
+        # The paths of the extracted files which aren't directories, so nothing can be below them
+        self._non_dirs = set()
+
+    @property
+    def complete(self):
+        """
+        Determine if the lower layers can't change the extracted path.
+
+        :return: ``True`` if the path was extracted as a file or it's hidden by the upper layers
+        :rtype: bool
+        """
+        return (
+            self.src_path in self._non_dirs
+            or self.src_path in self._opaque
+            or self._is_hidden(self.src_path)
+        )
+
+    def _get_dest_path(self, path):
+        """
+        Get the local path of the path within the container image.
+
+        :param str path: the normalized path within the container image
+        :return: the local path or ``None`` if the path isn't requested
+        :rtype: str or None
+        """
+        if path == self.src_path:
+            return self.dest_path
+        if path.startswith(f'{self.src_path}/'):
+            return os.path.join(self.dest_path, os.path.relpath(path, self.src_path))
+        return None
+
+    def _is_hidden(self, path):
+        """
+        Determine if the path was removed or hidden by an upper layer.
+
+        :param str path: the normalized path within the container image
+        :return: ``True`` if the path is hidden
+        :rtype: bool
+        """
+        if path in self._removed:
+            return True
+
+        parent = path
+        while parent:
+            parent = parent.rpartition('/')[0]
+            if parent in self._removed or parent in self._opaque or parent in self._non_dirs:
+                return True
+        return False
+
+    def extract_layer(self, fileobj):
+        """
+        Extract the requested path from the layer.
+
+        :param fileobj: the file-like object of the layer blob, which is optionally compressed
+        :raises tarfile.TarError: if the layer is not a valid tar archive
+        :raises IIBError: if the target of a hard link to extract isn't extracted from the layer
+        """
+        removed = set()
+        opaque = set()
+        seen = set()
+        # The local paths of the regular files extracted from this layer, which is where the
+        # targets of the hard links in the layer are
+        extracted = {}
+        with tarfile.open(fileobj=fileobj, mode='r|*') as layer:
+            for member in layer:
+                path = os.path.normpath(member.name).lstrip('/')
+                if path in ('.', '..') or path.startswith('../') or self._is_hidden(path):
+                    continue
+
+                parent, _, name = path.rpartition('/')
+                if name == '.wh..wh..opq':
+                    opaque.add(parent)
+                    continue
+                if name.startswith('.wh.'):
+                    removed.add(f'{parent}/{name[4:]}' if parent else name[4:])
+                    continue
+
+                dest = self._get_dest_path(path)
+                if dest is None or path in self._seen:
+                    continue
+
+                seen.add(path)
+                self.found = True
+                if member.isdir():
+                    os.makedirs(dest, exist_ok=True)
+                    continue
+
+                self._non_dirs.add(path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                # The same path may appear multiple times in a layer, in which case the last wins
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                if member.issym():
+                    os.symlink(member.linkname, dest)
+                elif member.isfile():
+                    with open(dest, 'wb') as f:
+                        shutil.copyfileobj(layer.extractfile(member), f)
+                    os.chmod(dest, member.mode & 0o777)
+                    extracted[path] = dest
+                elif member.islnk():
+                    target = os.path.normpath(member.linkname).lstrip('/')
+                    if target not in extracted:
+                        raise IIBError(
+                            f'The hard link /{path} can\'t be copied since its target /{target} '
+                            'is not copied from the same layer'
+                        )
+                    shutil.copyfile(extracted[target], dest)
+                    os.chmod(dest, member.mode & 0o777)
+                    extracted[path] = dest
+                else:
+                    log.warning('Skipping the unsupported file %s in the container image', path)
+
+        # Whiteouts only apply to the lower layers
+        self._seen |= seen
+        self._removed |= removed
+        self._opaque |= opaque
+
+
+def _get_registry_host(image):
+    """
+    Get the hostname of the registry API of the image.
+
+    :param ImageName image: the parsed pull specification
+    :return: the registry hostname
+    :rtype: str
+    """
+    if not image.registry or image.registry in DOCKER_HUB_AUTH_KEYS:
+        return DOCKER_HUB_REGISTRY
+    return image.registry
+
+
+def _get_repository(image):
+    """
+    Get the repository of the image.
+
+    :param ImageName image: the parsed pull specification
+    :return: the repository
+    :rtype: str
+    """
+    repository = image.to_str(registry=False, tag=False)
+    if _get_registry_host(image) == DOCKER_HUB_REGISTRY and '/' not in repository:
+        repository = f'library/{repository}'
+    return repository
+
+
+def _get_credentials(registry):
+    """
+    Get the base64 encoded credentials for the registry from the Docker configuration.
+
+    The configuration is read on every call since ``set_registry_token`` may have replaced it.
+
+    :param str registry: the registry as it appears in the pull specification
+    :return: the base64 encoded ``username:password`` or ``None`` if none are set
+    :rtype: str or None
+    """
+    docker_config_path = os.path.join(os.path.expanduser('~'), '.docker', 'config.json')
+    try:
+        with open(docker_config_path, 'r') as f:
+            auths = json.load(f).get('auths', {})
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        log.warning('Failed to read the Docker configuration at %s', docker_config_path)
+        return None
+
+    if not registry or registry in DOCKER_HUB_AUTH_KEYS:
+        keys = DOCKER_HUB_AUTH_KEYS
+    else:
+        keys = (registry, f'https://{registry}', f'http://{registry}')
+
+    for key in keys:
+        auth = auths.get(key, {})
+        if auth.get('auth'):
+            return auth['auth']
+        if auth.get('username') and auth.get('password'):
+            credentials = f'{auth["username"]}:{auth["password"]}'
+            return base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+
+    return None
+
+
+_registry_client = None
+_registry_client_lock = threading.Lock()
+
+
+def get_registry_client():
+    """
+    Get the registry client shared by the worker process.
+
+    :return: the registry client
+    :rtype: RegistryClient
+    """
+    global _registry_client
+
+    with _registry_client_lock:
+        if _registry_client is None:
+            _registry_client = RegistryClient()
+        return _registry_client
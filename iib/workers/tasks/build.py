@@ -1,22 +1,28 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from collections import OrderedDict
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import hashlib
 import json
 import logging
 import os
 import re
-import subprocess
-import time
+import sqlite3
 import tempfile
 import textwrap
+import threading
 
 from operator_manifest.operator import ImageName, OperatorManifest
 import ruamel.yaml
 
-from iib.exceptions import IIBError, AddressAlreadyInUse
-from iib.workers.api_utils import set_request_state, update_request
+from iib.exceptions import IIBError
+from iib.workers.api_utils import flush_request_updates, set_request_state, update_request
 from iib.workers.config import get_worker_config
 from iib.workers.tasks.celery import app
+from iib.workers.tasks.image_storage import cleanup_images, LOCAL_BUILD_REPOSITORY, mark_images_used
+from iib.workers.tasks.index_db_cache import cache_index_db, get_cached_index_db
+from iib.workers.tasks.index_registry import serve_index_registry
 from iib.workers.greenwave import gate_bundles
+from iib.workers.registry import get_registry_client
 from iib.workers.tasks.legacy import (
     export_legacy_packages,
     get_legacy_support_packages,
@@ -24,8 +30,10 @@ from iib.workers.tasks.legacy import (
 )
 from iib.workers.tasks.utils import (
     get_image_labels,
+    ImageMetadata,
     podman_pull,
     request_logger,
+    request_updates_buffered,
     reset_docker_config,
     retry,
     run_cmd,
@@ -82,23 +90,79 @@ def _build_image(dockerfile_dir, dockerfile_name, request_id, arch):
     )
 
 
+def _build_and_push_images(dockerfile_dir, dockerfile_name, request_id, arches):
+    """
+    Build and push the container image for all the specified architectures.
+
+    Each architecture is built and then pushed independently of the others, so the push of an
+    architecture starts as soon as its build finishes. Up to ``iib_build_concurrency``
+    architectures are processed concurrently. If any architecture fails, the architectures that
+    haven't started yet are cancelled and no further images are pushed.
+
+    :param str dockerfile_dir: the path to the directory containing the data used for
+        building the container image
+    :param str dockerfile_name: the name of the Dockerfile in the dockerfile_dir to
+        be used when building the container image
+    :param int request_id: the ID of the IIB build request
+    :param iter arches: the architectures to build the container image for
+    :raises IIBError: if the build or push of any architecture fails
+    """
+    # Building is the longest phase, so make sure the latest state is visible while it runs
+    flush_request_updates(request_id)
+
+    sorted_arches = sorted(arches)
+    concurrency = min(get_worker_config()['iib_build_concurrency'], len(sorted_arches))
+    if concurrency <= 1:
+        for arch in sorted_arches:
+            _build_image(dockerfile_dir, dockerfile_name, request_id, arch)
+            _push_image(request_id, arch)
+        return
+
+    cancelled = threading.Event()
+
+    def _build_and_push_image(arch):
+        if cancelled.is_set():
+            return
+        _build_image(dockerfile_dir, dockerfile_name, request_id, arch)
+        # Don't push the image if another architecture failed while this one was building
+        if cancelled.is_set():
+            log.info('Not pushing the container image for arch %s since the request failed', arch)
+            return
+        _push_image(request_id, arch)
+
+    log.info(
+        'Building and pushing the container images for the arches %s', ', '.join(sorted_arches)
+    )
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(_build_and_push_image, arch) for arch in sorted_arches]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        if any(future.exception() for future in done):
+            cancelled.set()
+            for future in not_done:
+                future.cancel()
+
+    # Raise the error of the first failed architecture in sorted order so that it's deterministic
+    for future in futures:
+        if not future.cancelled() and future.exception():
+            raise future.exception()
+
+
 def _cleanup():
     """
-    Remove all existing container images on the host.
+    Remove the stale container images on the host.
 
-    This will ensure that the host will not run out of disk space due to stale data, and that
-    all images referenced using floating tags will be up to date on the host.
+    This removes the images built by previous requests and the least recently used pulled images
+    when the images exceed ``iib_image_storage_max_size``, so that the host will not run out of disk
+    space due to stale data. The other pulled images are kept so that their layers don't need to be
+    pulled again.
 
     Additionally, this function will reset the Docker ``config.json`` to
     ``iib_docker_config_template``.
 
     :raises IIBError: if the command to remove the container images fails
     """
-    log.info('Removing all existing container images')
-    run_cmd(
-        ['podman', 'rmi', '--all', '--force'],
-        exc_msg='Failed to remove the existing container images',
-    )
+    log.info('Removing the stale container images')
+    cleanup_images()
     reset_docker_config()
 
 
@@ -253,26 +317,33 @@ def _get_local_pull_spec(request_id, arch):
     :return: the pull specification of the index image for this request.
     :rtype: str
     """
-    return f'iib-build:{request_id}-{arch}'
+    return f'{LOCAL_BUILD_REPOSITORY}:{request_id}-{arch}'
 
 
-def _get_image_arches(pull_spec):
+def _get_image_arches(pull_spec, image_metadata=None):
     """
     Get the architectures this image was built for.
 
     :param str pull_spec: the pull specification to a v2 manifest list
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: a set of architectures of the container images contained in the manifest list
     :rtype: set
     :raises IIBError: if the pull specification is not a v2 manifest list
     """
     log.debug('Get the available arches for %s', pull_spec)
-    skopeo_raw = skopeo_inspect(f'docker://{pull_spec}', '--raw')
+    if image_metadata:
+        skopeo_raw = image_metadata.get_manifest(pull_spec)
+    else:
+        skopeo_raw = skopeo_inspect(f'docker://{pull_spec}', '--raw')
     arches = set()
     if skopeo_raw.get('mediaType') == 'application/vnd.docker.distribution.manifest.list.v2+json':
         for manifest in skopeo_raw['manifests']:
             arches.add(manifest['platform']['architecture'])
     elif skopeo_raw.get('mediaType') == 'application/vnd.docker.distribution.manifest.v2+json':
-        skopeo_out = skopeo_inspect(f'docker://{pull_spec}', '--config')
+        if image_metadata:
+            skopeo_out = image_metadata.get_config(pull_spec)
+        else:
+            skopeo_out = skopeo_inspect(f'docker://{pull_spec}', '--config')
         arches.add(skopeo_out['architecture'])
     else:
         raise IIBError(
@@ -296,7 +367,7 @@ def get_rebuilt_image_pull_spec(request_id):
     )
 
 
-def _get_resolved_bundles(bundles):
+def _get_resolved_bundles(bundles, image_metadata=None):
     """
     Get the pull specification of the bundle images using their digests.
 
@@ -304,51 +375,102 @@ def _get_resolved_bundles(bundles):
     If so, simply use the digest of the first item in the manifest list.
     If not a manifest list, it must be a v2s2 image manifest and should be used as it is.
 
+    The bundles are resolved concurrently based on ``iib_resolve_concurrency``.
+
     :param list bundles: the list of bundle images to be resolved.
-    :return: the list of bundle images resolved to their digests.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
+    :return: the list of bundle images resolved to their digests, without duplicates and in the
+        same order as the input bundles.
     :rtype: list
     :raises IIBError: if unable to resolve a bundle image.
     """
     log.info('Resolving bundles %s', ', '.join(bundles))
-    resolved_bundles = set()
-    for bundle_pull_spec in bundles:
-        skopeo_raw = skopeo_inspect(f'docker://{bundle_pull_spec}', '--raw')
-        if (
-            skopeo_raw.get('mediaType')
-            == 'application/vnd.docker.distribution.manifest.list.v2+json'
-        ):
-            # Get the digest of the first item in the manifest list
-            digest = skopeo_raw['manifests'][0]['digest']
-            name = _get_container_image_name(bundle_pull_spec)
-            resolved_bundles.add(f'{name}@{digest}')
-        elif (
-            skopeo_raw.get('mediaType') == 'application/vnd.docker.distribution.manifest.v2+json'
-            and skopeo_raw.get('schemaVersion') == 2
-        ):
-            resolved_bundles.add(_get_resolved_image(bundle_pull_spec))
-        else:
-            error_msg = (
-                f'The pull specification of {bundle_pull_spec} is neither '
-                f'a v2 manifest list nor a v2s2 manifest. Type {skopeo_raw.get("mediaType")}'
-                f' and schema version {skopeo_raw.get("schemaVersion")} is not supported by IIB.'
-            )
-            raise IIBError(error_msg)
+    # Remove duplicates while preserving the order so that the output is deterministic
+    unique_bundles = list(OrderedDict.fromkeys(bundles))
+    concurrency = min(get_worker_config().iib_resolve_concurrency, len(unique_bundles))
+    if concurrency <= 1:
+        resolved_bundles = [
+            _get_resolved_bundle(bundle, image_metadata) for bundle in unique_bundles
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [
+                executor.submit(_get_resolved_bundle, bundle, image_metadata)
+                for bundle in unique_bundles
+            ]
+            try:
+                # Collect the results in the input order so that if multiple bundles fail to
+                # resolve, the error of the first one in the input is always the one raised
+                resolved_bundles = [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
 
-    return list(resolved_bundles)
+    return list(OrderedDict.fromkeys(resolved_bundles))
+
+
+def _get_resolved_bundle(bundle_pull_spec, image_metadata=None):
+    """
+    Get the pull specification of the bundle image using its digest.
+
+    See ``_get_resolved_bundles`` for details.
+
+    :param str bundle_pull_spec: the pull specification of the bundle image to resolve
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
+    :return: the bundle image resolved to its digest
+    :rtype: str
+    :raises IIBError: if unable to resolve the bundle image.
+    """
+    if image_metadata:
+        skopeo_raw = image_metadata.get_manifest(bundle_pull_spec)
+    else:
+        skopeo_raw = skopeo_inspect(f'docker://{bundle_pull_spec}', '--raw')
+    if skopeo_raw.get('mediaType') == 'application/vnd.docker.distribution.manifest.list.v2+json':
+        # Get the digest of the first item in the manifest list
+        digest = skopeo_raw['manifests'][0]['digest']
+        name = _get_container_image_name(bundle_pull_spec)
+        resolved_bundle = f'{name}@{digest}'
+        if image_metadata:
+            # The labels of a bundle don't depend on the architecture, so the labels of the first
+            # item in the manifest list are used for the unresolved pull specification too
+            image_metadata.set_resolved(bundle_pull_spec, resolved_bundle)
+        return resolved_bundle
+    elif (
+        skopeo_raw.get('mediaType') == 'application/vnd.docker.distribution.manifest.v2+json'
+        and skopeo_raw.get('schemaVersion') == 2
+    ):
+        return _get_resolved_image(bundle_pull_spec, image_metadata=image_metadata)
+
+    error_msg = (
+        f'The pull specification of {bundle_pull_spec} is neither '
+        f'a v2 manifest list nor a v2s2 manifest. Type {skopeo_raw.get("mediaType")}'
+        f' and schema version {skopeo_raw.get("schemaVersion")} is not supported by IIB.'
+    )
+    raise IIBError(error_msg)
 
 
-def _get_resolved_image(pull_spec):
+def _get_resolved_image(pull_spec, use_cache=True, image_metadata=None):
     """
     Get the pull specification of the container image using its digest.
 
     :param str pull_spec: the pull specification of the container image to resolve
+    :param bool use_cache: if ``False``, a cached manifest of a floating tag will not be used
+    :param ImageMetadata image_metadata: the metadata of the images used by the request; this
+        should not be set if ``use_cache`` is ``False``
     :return: the resolved pull specification
     :rtype: str
     """
     log.debug('Resolving %s', pull_spec)
     name = _get_container_image_name(pull_spec)
-    skopeo_output = skopeo_inspect(f'docker://{pull_spec}', '--raw', return_json=False)
-    if json.loads(skopeo_output).get('schemaVersion') == 2:
+    if image_metadata:
+        skopeo_output = image_metadata.get_raw_manifest(pull_spec)
+    else:
+        skopeo_output = skopeo_inspect(
+            f'docker://{pull_spec}', '--raw', return_json=False, use_cache=use_cache
+        )
+    is_schema_2 = json.loads(skopeo_output).get('schemaVersion') == 2
+    if is_schema_2:
         raw_digest = hashlib.sha256(skopeo_output.encode('utf-8')).hexdigest()
         digest = f'sha256:{raw_digest}'
     else:
@@ -357,9 +479,17 @@ def _get_resolved_image(pull_spec):
         # skopeo's own logic for determining the digest in this case. In the future, we
         # may want to use skopeo in all cases, but this will have significant performance
         # issues until https://github.com/containers/skopeo/issues/785
-        digest = skopeo_inspect(f'docker://{pull_spec}')['Digest']
+        if get_worker_config().iib_use_registry_client:
+            digest = get_registry_client().get_manifest_digest(pull_spec)
+        else:
+            digest = skopeo_inspect(f'docker://{pull_spec}')['Digest']
     pull_spec_resolved = f'{name}@{digest}'
     log.debug('%s resolved to %s', pull_spec, pull_spec_resolved)
+    if image_metadata:
+        # The digest of a schema 2 manifest is computed from the raw manifest, so it's identical
+        image_metadata.set_resolved(
+            pull_spec, pull_spec_resolved, skopeo_output if is_schema_2 else None
+        )
     return pull_spec_resolved
 
 
@@ -367,123 +497,121 @@ def _get_index_database(from_index, base_dir):
     """
     Get database file from the specified index image and save it locally.
 
+    If ``iib_index_db_cache_dir`` is set, the database file is cached based on the digest of the
+    index image.
+
     :param str from_index: index image to get database file from.
     :param str base_dir: base directory to which the database file should be saved.
     :return: path to the copied database file.
     :rtype: str
     :raises IIBError: if any podman command fails.
     """
+    digest = None
+    if get_worker_config()['iib_index_db_cache_dir']:
+        # Use the resolved pull specification so that the cache key is guaranteed to match the
+        # content even if the tag is moved in the meantime
+        from_index = _get_resolved_image(from_index)
+        digest = from_index.split('@', 1)[1]
+
     db_path = get_image_label(from_index, 'operators.operatorframework.io.index.database.v1')
     if not db_path:
         raise IIBError('Index image doesn\'t have the label specifying its database location.')
-    _copy_files_from_image(from_index, db_path, base_dir)
     local_path = os.path.join(base_dir, os.path.basename(db_path))
+    if digest and get_cached_index_db(digest, local_path):
+        return local_path
+
+    _copy_files_from_image(from_index, db_path, base_dir)
+    if digest:
+        cache_index_db(digest, local_path)
     return local_path
 
 
-def _serve_index_registry(db_path):
+def _get_present_bundles(from_index, base_dir):
     """
-    Locally start OPM registry service, which can be communicated with using gRPC queries.
+    Get the bundles already present in the index image.
 
-    Due to IIB's paralellism, the service can run multiple times, which could lead to port
-    binding conflicts. Resolution of port conflicts is handled in this function as well.
+    The bundles are read directly from the index database. If that fails, for example because the
+    database uses an older schema, the bundles are retrieved from the index registry service
+    instead.
 
-    :param str db_path: path to index database containing the registry data.
-    :return: tuple containing port number of the running service and the running Popen object.
-    :rtype: (int, Popen)
-    :raises IIBError: if all tried ports are in use, or the command failed for another reason.
+    :param str from_index: index image to inspect.
+    :param str base_dir: base directory to create temporary files in.
+    :return: an iterable of the present bundles with the same keys as provided by the grpc query.
+        It must be consumed before ``base_dir`` is removed.
+    :rtype: iter
+    :raises IIBError: if any of the commands fail.
     """
-    conf = get_worker_config()
-    port_start = conf['iib_grpc_start_port']
-    port_end = port_start + conf['iib_grpc_max_port_tries']
+    db_path = _get_index_database(from_index, base_dir)
+    try:
+        return _get_present_bundles_from_db(db_path)
+    except sqlite3.Error:
+        log.warning(
+            'Failed to read the bundles from the index database %s. Falling back to the index '
+            'registry service.',
+            db_path,
+            exc_info=True,
+        )
 
-    for port in range(port_start, port_end):
-        try:
-            return (
-                port,
-                _serve_index_registry_at_port(
-                    db_path, port, conf['iib_grpc_max_tries'], conf['iib_grpc_init_wait_time']
-                ),
-            )
-        except AddressAlreadyInUse:
-            log.info('Port %d is in use, trying another.', port)
+    return _get_present_bundles_from_grpc(db_path)
 
-    err_msg = f'No free port has been found after {conf.get("iib_grpc_max_port_tries")} attempts.'
-    log.error(err_msg)
-    raise IIBError(err_msg)
 
+def _get_present_bundles_from_db(db_path):
+    """
+    Get a generator of the bundles present in the index database by querying it directly.
 
-@retry(attempts=2, wait_on=IIBError, logger=log)
-def _serve_index_registry_at_port(db_path, port, max_tries, wait_time):
-    """
-    Start an image registry service at a specified port.
-
-    :param str db_path: path to index database containing the registry data.
-    :param str int port: port to start the service on.
-    :param max_tries: how many times to try to start the service before giving up.
-    :param wait_time: time to wait before checking if the service is initialized.
-    :return: object of the running Popen process.
-    :rtype: Popen
-    :raises IIBError: if the process has failed to initialize too many times, or an unexpected
-        error occured.
-    :raises AddressAlreadyInUse: if the specified port is already being used by another service.
-    """
-    cmd = ['opm', 'registry', 'serve', '-p', str(port), '-d', db_path, '-t', '/dev/null']
-    for attempt in range(max_tries):
-        rpc_proc = subprocess.Popen(
-            cmd,
-            cwd=os.path.dirname(db_path),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-        )
-        start_time = time.time()
-        while time.time() - start_time < wait_time:
-            time.sleep(1)
-            ret = rpc_proc.poll()
-            # process has terminated
-            if ret is not None:
-                stderr = rpc_proc.stderr.read()
-                if 'address already in use' in stderr:
-                    raise AddressAlreadyInUse(f'Port {port} is already used by a different service')
-                raise IIBError(f'Command "{" ".join(cmd)}" has failed with error "{stderr}"')
-
-            # query the service to see if it has started
-            try:
-                output = run_cmd(
-                    ['grpcurl', '-plaintext', f'localhost:{port}', 'list', 'api.Registry']
-                )
-            except IIBError:
-                output = ''
+    The query is run before this function returns so that any error with the database is raised
+    immediately rather than when the generator is consumed.
 
-            if 'api.Registry.ListBundles' in output:
-                log.debug('Started the command "%s"', ' '.join(cmd))
-                log.info('Index registry service has been initialized.')
-                return rpc_proc
+    :param str db_path: the path to the index database.
+    :return: a generator of dictionaries with the keys ``bundlePath``, ``channelName``,
+        ``csvName``, ``packageName``, and ``version``, one for every channel the bundle is in. This
+        mirrors the output of the ``ListBundles`` gRPC API.
+    :rtype: generator
+    :raises sqlite3.Error: if the database can't be queried.
+    """
+    # Open the database read-only so that a missing file isn't silently created
+    connection = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        cursor = connection.execute(
+            'SELECT DISTINCT operatorbundle.name, operatorbundle.bundlepath, '
+            'channel_entry.package_name, channel_entry.channel_name, operatorbundle.version '
+            'FROM channel_entry INNER JOIN operatorbundle '
+            'ON operatorbundle.name = channel_entry.operatorbundle_name'
+        )
+    except sqlite3.Error:
+        connection.close()
+        raise
 
-        rpc_proc.kill()
+    def _bundles():
+        try:
+            for csv_name, bundle_path, package_name, channel_name, version in cursor:
+                yield {
+                    'bundlePath': bundle_path or '',
+                    'channelName': channel_name,
+                    'csvName': csv_name,
+                    'packageName': package_name,
+                    'version': version or '',
+                }
+        finally:
+            connection.close()
 
-    raise IIBError(f'Index registry has not been initialized after {max_tries} tries')
+    return _bundles()
 
 
-def _get_present_bundles(from_index, base_dir):
+def _get_present_bundles_from_grpc(db_path):
     """
-    Get a list of bundles already present in the index image.
+    Get a list of bundles present in the index database using the index registry service.
 
-    :param str from_index: index image to inspect.
-    :param str base_dir: base directory to create temporary files in.
+    :param str db_path: the path to the index database.
     :return: list of present bundles as provided by the grpc query.
     :rtype: list
     :raises IIBError: if any of the commands fail.
     """
-    db_path = _get_index_database(from_index, base_dir)
-    port, rpc_proc = _serve_index_registry(db_path)
-
-    bundles = run_cmd(
-        ['grpcurl', '-plaintext', f'localhost:{port}', 'api.Registry/ListBundles'],
-        exc_msg='Failed to get bundle data from index image',
-    )
-    rpc_proc.kill()
+    with serve_index_registry(db_path) as port:
+        bundles = run_cmd(
+            ['grpcurl', '-plaintext', f'localhost:{port}', 'api.Registry/ListBundles'],
+            exc_msg='Failed to get bundle data from index image',
+        )
 
     # If no data is returned there are not bundles present
     if not bundles:
@@ -498,7 +626,7 @@ def _get_missing_bundles(present_bundles, bundles):
     """
     Filter out bundles to only those not present in the index image.
 
-    :param list present_bundles: list of bundles present in the index image, as provided by opm.
+    :param iter present_bundles: bundles present in the index image, as provided by opm.
     :param list bundles: resolved bundles requested to be added to the index image.
     :return: list of bundles not present in the index image.
     :rtype: list
@@ -684,7 +812,9 @@ def _overwrite_from_index(
             temp_dir.cleanup()
 
 
-def get_index_image_info(overwrite_from_index_token, from_index=None, default_ocp_version='v4.5'):
+def get_index_image_info(
+    overwrite_from_index_token, from_index=None, default_ocp_version='v4.5', image_metadata=None
+):
     """
     Get arches, resolved pull specification and ocp_version for the index image.
 
@@ -693,6 +823,7 @@ def get_index_image_info(overwrite_from_index_token, from_index=None, default_oc
         ``overwrite_from_index``. The format of the token must be in the format "user:password".
     :param str from_index: the pull specification of the index image to be resolved.
     :param str default_ocp_version: default ocp_version to use if index image pull_spec is absent.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: dictionary of resolved index image pull spec, set of arches, default ocp_version and
         resolved_distribution_scope
     :rtype: dict
@@ -707,13 +838,18 @@ def get_index_image_info(overwrite_from_index_token, from_index=None, default_oc
         return result
 
     with set_registry_token(overwrite_from_index_token, from_index):
-        from_index_resolved = _get_resolved_image(from_index)
-        result['arches'] = _get_image_arches(from_index_resolved)
+        from_index_resolved = _get_resolved_image(from_index, image_metadata=image_metadata)
+        result['arches'] = _get_image_arches(from_index_resolved, image_metadata)
         result['ocp_version'] = (
-            get_image_label(from_index_resolved, 'com.redhat.index.delivery.version') or 'v4.5'
+            get_image_label(
+                from_index_resolved, 'com.redhat.index.delivery.version', image_metadata
+            )
+            or 'v4.5'
         )
         result['resolved_distribution_scope'] = (
-            get_image_label(from_index_resolved, 'com.redhat.index.delivery.distribution_scope')
+            get_image_label(
+                from_index_resolved, 'com.redhat.index.delivery.distribution_scope', image_metadata,
+            )
             or 'prod'
         )
         result['resolved_from_index'] = from_index_resolved
@@ -754,6 +890,7 @@ def _prepare_request_for_build(
     source_from_index=None,
     target_index=None,
     binary_image_config=None,
+    image_metadata=None,
 ):
     """
     Prepare the request for the index image build.
@@ -784,6 +921,7 @@ def _prepare_request_for_build(
         whose new data will be added to the merged index image.
     :param dict binary_image_config: the dict of config required to identify the appropriate
         ``binary_image`` to use.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: a dictionary with the keys: arches, binary_image_resolved, from_index_resolved, and
         ocp_version.
     :rtype: dict
@@ -801,17 +939,26 @@ def _prepare_request_for_build(
         arches = set()
 
     from_index_info = get_index_image_info(
-        overwrite_from_index_token, from_index=from_index, default_ocp_version='v4.5'
+        overwrite_from_index_token,
+        from_index=from_index,
+        default_ocp_version='v4.5',
+        image_metadata=image_metadata,
     )
     arches = arches | from_index_info['arches']
 
     source_from_index_info = get_index_image_info(
-        overwrite_from_index_token, from_index=source_from_index, default_ocp_version='v4.5'
+        overwrite_from_index_token,
+        from_index=source_from_index,
+        default_ocp_version='v4.5',
+        image_metadata=image_metadata,
     )
     arches = arches | source_from_index_info['arches']
 
     target_index_info = get_index_image_info(
-        overwrite_from_index_token, from_index=target_index, default_ocp_version='v4.6'
+        overwrite_from_index_token,
+        from_index=target_index,
+        default_ocp_version='v4.6',
+        image_metadata=image_metadata,
     )
     arches = arches | target_index_info['arches']
 
@@ -841,8 +988,8 @@ def _prepare_request_for_build(
             binary_image_ocp_version, distribution_scope, binary_image_config
         )
 
-    binary_image_resolved = _get_resolved_image(binary_image)
-    binary_image_arches = _get_image_arches(binary_image_resolved)
+    binary_image_resolved = _get_resolved_image(binary_image, image_metadata=image_metadata)
+    binary_image_arches = _get_image_arches(binary_image_resolved, image_metadata)
 
     if not arches.issubset(binary_image_arches):
         raise IIBError(
@@ -851,9 +998,22 @@ def _prepare_request_for_build(
             )
         )
 
+    # The images pulled for this request are the most likely to be needed by the next requests
+    mark_images_used(
+        binary_image_resolved,
+        from_index,
+        from_index_info['resolved_from_index'],
+        source_from_index,
+        source_from_index_info['resolved_from_index'],
+        target_index,
+        target_index_info['resolved_from_index'],
+    )
+
     bundle_mapping = {}
     for bundle in bundles:
-        operator = get_image_label(bundle, 'operators.operatorframework.io.bundle.package.v1')
+        operator = get_image_label(
+            bundle, 'operators.operatorframework.io.bundle.package.v1', image_metadata
+        )
         if operator:
             bundle_mapping.setdefault(operator, []).append(bundle)
 
@@ -931,7 +1091,7 @@ def _push_image(request_id, arch):
     )
 
     log.debug(f'Verifying that {destination} was pushed as a v2 manifest due to RHBZ#1810768')
-    skopeo_raw = skopeo_inspect(destination, '--raw')
+    skopeo_raw = skopeo_inspect(destination, '--raw', use_cache=False)
     if skopeo_raw['schemaVersion'] != 2:
         log.warning(
             'The manifest for %s ended up using schema version 1 due to RHBZ#1810768. Manually '
@@ -984,7 +1144,8 @@ def _verify_index_image(
     :raises IIBError: if the index image has changed since IIB build started.
     """
     with set_registry_token(overwrite_from_index_token, unresolved_from_index):
-        resolved_post_build_from_index = _get_resolved_image(unresolved_from_index)
+        # Bypass the cache since the whole point is to detect if the tag was moved
+        resolved_post_build_from_index = _get_resolved_image(unresolved_from_index, use_cache=False)
 
     if resolved_post_build_from_index != resolved_prebuild_from_index:
         raise IIBError(
@@ -993,12 +1154,13 @@ def _verify_index_image(
         )
 
 
-def _verify_labels(bundles):
+def _verify_labels(bundles, image_metadata=None):
     """
     Verify that the required labels are set on the input bundles.
 
     :param list bundles: a list of strings representing the pull specifications of the bundles to
         add to the index image being built.
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :raises IIBError: if one of the bundles does not have the correct label value.
     """
     conf = get_worker_config()
@@ -1006,26 +1168,29 @@ def _verify_labels(bundles):
         return
 
     for bundle in bundles:
-        labels = get_image_labels(bundle)
+        labels = get_image_labels(bundle, image_metadata)
         for label, value in conf['iib_required_labels'].items():
             if labels.get(label) != value:
                 raise IIBError(f'The bundle {bundle} does not have the label {label}={value}')
 
 
-def get_image_label(pull_spec, label):
+def get_image_label(pull_spec, label, image_metadata=None):
     """
     Get a specific label from the container image.
 
+    :param str pull_spec: the pull specification of the container image
     :param str label: the label to get
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: the label on the container image or None
     :rtype: str
     """
     log.debug('Getting the label of %s from %s', label, pull_spec)
-    return get_image_labels(pull_spec).get(label)
+    return get_image_labels(pull_spec, image_metadata).get(label)
 
 
 @app.task
 @request_logger
+@request_updates_buffered
 def handle_add_request(
     bundles,
     request_id,
@@ -1073,15 +1238,17 @@ def handle_add_request(
         ``cnr_token`` or ``organization`` is not specified.
     """
     _cleanup()
+    # The metadata of the images is fetched once and shared by all the steps of the request
+    image_metadata = ImageMetadata()
     # Resolve bundles to their digests
     set_request_state(request_id, 'in_progress', 'Resolving the bundles')
-    resolved_bundles = _get_resolved_bundles(bundles)
+    resolved_bundles = _get_resolved_bundles(bundles, image_metadata)
 
-    _verify_labels(resolved_bundles)
+    _verify_labels(resolved_bundles, image_metadata)
 
     # Check if Gating passes for all the bundles
     if greenwave_config:
-        gate_bundles(resolved_bundles, greenwave_config)
+        gate_bundles(resolved_bundles, greenwave_config, image_metadata)
 
     prebuild_info = _prepare_request_for_build(
         request_id,
@@ -1092,11 +1259,16 @@ def handle_add_request(
         bundles,
         distribution_scope,
         binary_image_config=binary_image_config,
+        image_metadata=image_metadata,
     )
 
     log.info('Checking if interacting with the legacy app registry is required')
     legacy_support_packages = get_legacy_support_packages(
-        resolved_bundles, request_id, prebuild_info['ocp_version'], force_backport=force_backport
+        resolved_bundles,
+        request_id,
+        prebuild_info['ocp_version'],
+        force_backport=force_backport,
+        image_metadata=image_metadata,
     )
     if legacy_support_packages:
         validate_legacy_params_and_config(
@@ -1150,9 +1322,7 @@ def handle_add_request(
         )
 
         arches = prebuild_info['arches']
-        for arch in sorted(arches):
-            _build_image(temp_dir, 'index.Dockerfile', request_id, arch)
-            _push_image(request_id, arch)
+        _build_and_push_images(temp_dir, 'index.Dockerfile', request_id, arches)
 
     set_request_state(request_id, 'in_progress', 'Creating the manifest list')
     output_pull_spec = _create_and_push_manifest_list(request_id, arches)
@@ -1177,6 +1347,7 @@ def handle_add_request(
 
 @app.task
 @request_logger
+@request_updates_buffered
 def handle_rm_request(
     operators,
     request_id,
@@ -1220,6 +1391,7 @@ def handle_rm_request(
         add_arches,
         distribution_scope=distribution_scope,
         binary_image_config=binary_image_config,
+        image_metadata=ImageMetadata(),
     )
     _update_index_image_build_state(request_id, prebuild_info)
 
@@ -1247,9 +1419,7 @@ def handle_rm_request(
         )
 
         arches = prebuild_info['arches']
-        for arch in sorted(arches):
-            _build_image(temp_dir, 'index.Dockerfile', request_id, arch)
-            _push_image(request_id, arch)
+        _build_and_push_images(temp_dir, 'index.Dockerfile', request_id, arches)
 
     set_request_state(request_id, 'in_progress', 'Creating the manifest list')
     output_pull_spec = _create_and_push_manifest_list(request_id, arches)
@@ -1270,6 +1440,7 @@ def handle_rm_request(
 
 @app.task
 @request_logger
+@request_updates_buffered
 def handle_regenerate_bundle_request(from_bundle_image, organization, request_id):
     """
     Coordinate the work needed to regenerate the operator bundle image.
@@ -1282,15 +1453,19 @@ def handle_regenerate_bundle_request(from_bundle_image, organization, request_id
     _cleanup()
 
     set_request_state(request_id, 'in_progress', 'Resolving from_bundle_image')
-    from_bundle_image_resolved = _get_resolved_image(from_bundle_image)
-    arches = _get_image_arches(from_bundle_image_resolved)
+    image_metadata = ImageMetadata()
+    from_bundle_image_resolved = _get_resolved_image(
+        from_bundle_image, image_metadata=image_metadata
+    )
+    arches = _get_image_arches(from_bundle_image_resolved, image_metadata)
     if not arches:
         raise IIBError(
             f'No arches were found in the resolved from_bundle_image {from_bundle_image_resolved}'
         )
 
     pinned_by_iib = yaml.load(
-        get_image_label(from_bundle_image_resolved, 'com.redhat.iib.pinned') or 'false'
+        get_image_label(from_bundle_image_resolved, 'com.redhat.iib.pinned', image_metadata)
+        or 'false'
     )
 
     arches_str = ', '.join(sorted(arches))
@@ -1304,8 +1479,11 @@ def handle_regenerate_bundle_request(from_bundle_image, organization, request_id
     exc_msg = 'Failed setting the resolved "from_bundle_image" on the request'
     update_request(request_id, payload, exc_msg=exc_msg)
 
-    # Pull the from_bundle_image to ensure steps later on don't fail due to registry timeouts
-    podman_pull(from_bundle_image_resolved)
+    mark_images_used(from_bundle_image_resolved)
+    conf = get_worker_config()
+    if not conf['iib_use_registry_client']:
+        # Pull the from_bundle_image to ensure steps later on don't fail due to registry timeouts
+        podman_pull(from_bundle_image_resolved)
 
     with tempfile.TemporaryDirectory(prefix='iib-') as temp_dir:
         manifests_path = os.path.join(temp_dir, 'manifests')
@@ -1329,14 +1507,11 @@ def handle_regenerate_bundle_request(from_bundle_image, organization, request_id
             for name, value in new_labels.items():
                 dockerfile.write(f'LABEL {name}={value}\n')
 
-        for arch in sorted(arches):
-            _build_image(temp_dir, 'Dockerfile', request_id, arch)
-            _push_image(request_id, arch)
+        _build_and_push_images(temp_dir, 'Dockerfile', request_id, arches)
 
     set_request_state(request_id, 'in_progress', 'Creating the manifest list')
     output_pull_spec = _create_and_push_manifest_list(request_id, arches)
 
-    conf = get_worker_config()
     if conf['iib_index_image_output_registry']:
         old_output_pull_spec = output_pull_spec
         output_pull_spec = output_pull_spec.replace(
@@ -1367,6 +1542,12 @@ def _copy_files_from_image(image, src_path, dest_path):
     :param str src_path: the full path within the container image to copy from.
     :param str dest_path: the full path on the local host to copy into.
     """
+    if get_worker_config()['iib_use_registry_client']:
+        # Read the files directly from the layer blobs to avoid pulling the image and creating a
+        # container from it
+        get_registry_client().copy_files(image, src_path, dest_path)
+        return
+
     # One way to copy a file from the image is to create a container from its filesystem
     # so the contents can be read. To create a container, podman always requires that a
     # command for the container is set. In this method, however, the command is not needed
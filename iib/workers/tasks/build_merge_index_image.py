@@ -6,6 +6,7 @@ from iib.exceptions import IIBError
 from iib.workers.api_utils import set_request_state
 from iib.workers.tasks.build import (
     _add_label_to_index,
+    _build_and_push_images,
     _build_image,
     _cleanup,
     _create_and_push_manifest_list,
@@ -19,7 +20,13 @@ from iib.workers.tasks.build import (
     _update_index_image_pull_spec,
 )
 from iib.workers.tasks.celery import app
-from iib.workers.tasks.utils import request_logger, run_cmd, set_registry_token
+from iib.workers.tasks.utils import (
+    ImageMetadata,
+    request_logger,
+    request_updates_buffered,
+    run_cmd,
+    set_registry_token,
+)
 
 
 __all__ = ['handle_merge_request']
@@ -178,6 +185,7 @@ def _deprecate_bundles(
 
 @app.task
 @request_logger
+@request_updates_buffered
 def handle_merge_request(
     source_from_index,
     deprecation_list,
@@ -218,18 +226,20 @@ def handle_merge_request(
         target_index=target_index,
         distribution_scope=distribution_scope,
         binary_image_config=binary_image_config,
+        image_metadata=ImageMetadata(),
     )
     _update_index_image_build_state(request_id, prebuild_info)
 
     with tempfile.TemporaryDirectory(prefix='iib-') as temp_dir:
         set_request_state(request_id, 'in_progress', 'Getting bundles present in the index images')
         log.info('Getting bundles present in the source index image')
-        source_index_bundles = _get_present_bundles(source_from_index, temp_dir)
+        # The bundles are iterated over multiple times, so they can't be left as a generator
+        source_index_bundles = list(_get_present_bundles(source_from_index, temp_dir))
 
         target_index_bundles = []
         if target_index:
             log.info('Getting bundles present in the target index image')
-            target_index_bundles = _get_present_bundles(target_index, temp_dir)
+            target_index_bundles = list(_get_present_bundles(target_index, temp_dir))
 
         arches = list(prebuild_info['arches'])
         arch = 'amd64' if 'amd64' in arches else arches[0]
@@ -266,9 +276,7 @@ def handle_merge_request(
                 overwrite_target_index_token,
             )
 
-        for arch in sorted(prebuild_info['arches']):
-            _build_image(temp_dir, 'index.Dockerfile', request_id, arch)
-            _push_image(request_id, arch)
+        _build_and_push_images(temp_dir, 'index.Dockerfile', request_id, prebuild_info['arches'])
 
     output_pull_spec = _create_and_push_manifest_list(request_id, prebuild_info['arches'])
     _update_index_image_pull_spec(
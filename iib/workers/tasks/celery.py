@@ -1,9 +1,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import celery
-from celery.signals import celeryd_init
+from celery.signals import celeryd_init, worker_process_shutdown
 
 from iib.workers.config import configure_celery, validate_celery_config
+from iib.workers.tasks.index_registry import stop_index_registry_servers
 
 app = celery.Celery()
 configure_celery(app)
 celeryd_init.connect(validate_celery_config)
+worker_process_shutdown.connect(stop_index_registry_servers)
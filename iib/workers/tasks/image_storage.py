@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+import logging
+import threading
+import time
+
+from iib.exceptions import IIBError
+from iib.workers.config import get_worker_config
+from iib.workers.tasks.utils import run_cmd
+
+log = logging.getLogger(__name__)
+
+# The repository of the images IIB builds locally before pushing them
+LOCAL_BUILD_REPOSITORY = 'iib-build'
+
+# The last time the pulled images were used by a request keyed by their pull specification
+_last_used = {}
+_last_used_lock = threading.Lock()
+
+
+def mark_images_used(*pull_specs):
+    """
+    Record that the images are used by the current request.
+
+    The images which were used the least recently are the first ones to be removed when the local
+    images exceed ``iib_image_storage_max_size``.
+
+    :param str pull_specs: the pull specifications of the images; ``None`` values are ignored
+    """
+    now = time.time()
+    with _last_used_lock:
+        for pull_spec in pull_specs:
+            if pull_spec:
+                _last_used[pull_spec] = now
+
+
+def _list_images():
+    """
+    List the local container images.
+
+    :return: the list of images as dictionaries with lowercase keys since the case of the keys
+        differs between podman versions
+    :rtype: list
+    :raises IIBError: if listing the images fails
+    """
+    output = run_cmd(
+        ['podman', 'images', '--format', 'json'], exc_msg='Failed to list the container images'
+    )
+    return [{key.lower(): value for key, value in image.items()} for image in json.loads(output)]
+
+
+def _get_image_names(image):
+    """
+    Get all the names of the local image, including its repository digests.
+
+    :param dict image: the image as returned by ``_list_images``
+    :return: the set of names
+    :rtype: set
+    """
+    return set(image.get('names') or []) | set(image.get('repodigests') or [])
+
+
+def _is_built_image(name):
+    """
+    Determine if the image name refers to an image built by IIB.
+
+    :param str name: the name of the image, such as ``localhost/iib-build:1-amd64``
+    :return: ``True`` if the image was built by IIB
+    :rtype: bool
+    """
+    repository = name.rsplit(':', 1)[0]
+    return repository in (LOCAL_BUILD_REPOSITORY, f'localhost/{LOCAL_BUILD_REPOSITORY}')
+
+
+def _get_last_used(image):
+    """
+    Get the last time the image was used.
+
+    If this worker hasn't used the image, such as after the worker restarts, the creation time of
+    the image is used as the best approximation.
+
+    :param dict image: the image as returned by ``_list_images``
+    :return: the time in seconds since the epoch
+    :rtype: float
+    """
+    last_used = [_last_used[name] for name in _get_image_names(image) if name in _last_used]
+    if last_used:
+        return max(last_used)
+
+    created = image.get('created')
+    # Older versions of podman return a formatted date, in which case it's treated as unknown
+    if isinstance(created, (int, float)):
+        return created
+    return 0
+
+
+def _remove_images(images, force):
+    """
+    Remove the local images.
+
+    :param list images: the IDs or names of the images to remove
+    :param bool force: if ``True``, the images are removed even if they are used by containers
+    :raises IIBError: if the removal fails
+    """
+    cmd = ['podman', 'rmi']
+    if force:
+        cmd.append('--force')
+    run_cmd(cmd + list(images), exc_msg='Failed to remove the existing container images')
+
+
+def cleanup_images():
+    """
+    Remove the stale local container images.
+
+    All the images built by IIB, which are tagged in the ``iib-build`` repository by the request
+    that built them, are removed since they are only needed until they are pushed. The
+    pulled images, such as the binary images whose layers are the base of every index image, are
+    kept so that they don't need to be pulled again by the next request. Once the total size of the
+    pulled images exceeds ``iib_image_storage_max_size``, the least recently used images are
+    removed until the total size is within the limit.
+
+    :raises IIBError: if the removal of the images built by IIB fails
+    """
+    built_image_ids = []
+    pulled_images = []
+    for image in _list_images():
+        if any(_is_built_image(name) for name in image.get('names') or []):
+            built_image_ids.append(image['id'])
+        else:
+            pulled_images.append(image)
+
+    if built_image_ids:
+        log.info('Removing the %d container images built by IIB', len(built_image_ids))
+        _remove_images(built_image_ids, force=True)
+
+    max_size = get_worker_config()['iib_image_storage_max_size']
+    # The sizes of images sharing layers are counted more than once, so the total is an upper bound
+    total_size = sum(image.get('size') or 0 for image in pulled_images)
+    if total_size <= max_size:
+        log.debug('The local container images use %d bytes, no eviction is needed', total_size)
+        return
+
+    with _last_used_lock:
+        pulled_images.sort(key=_get_last_used)
+
+    for image in pulled_images:
+        if total_size <= max_size:
+            break
+        log.info(
+            'Removing the least recently used container image %s',
+            ', '.join(sorted(_get_image_names(image))) or image['id'],
+        )
+        try:
+            _remove_images([image['id']], force=False)
+        except IIBError:
+            # The image may be used by a container of a request being processed by another worker
+            log.warning('Failed to remove the container image %s', image['id'])
+            continue
+        total_size -= image.get('size') or 0
+        with _last_used_lock:
+            for name in _get_image_names(image):
+                _last_used.pop(name, None)
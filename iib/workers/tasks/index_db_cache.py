@@ -0,0 +1,135 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+from contextlib import contextmanager
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+from iib.workers.config import get_worker_config
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def _lock_cache(cache_dir, exclusive):
+    """
+    Lock the cache directory so that it can be safely shared by multiple worker processes.
+
+    :param str cache_dir: the path to the cache directory
+    :param bool exclusive: if ``True``, an exclusive lock is acquired for modifying the cache;
+        otherwise, a shared lock is acquired for reading it
+    """
+    with open(os.path.join(cache_dir, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_cache_path(cache_dir, digest):
+    """
+    Get the path of the cached index database.
+
+    :param str cache_dir: the path to the cache directory
+    :param str digest: the digest of the index image, such as ``sha256:1234``
+    :return: the path of the cached index database
+    :rtype: str
+    """
+    return os.path.join(cache_dir, f'{digest.replace(":", "-")}.db')
+
+
+def get_cached_index_db(digest, dest_path):
+    """
+    Copy the cached index database of the index image to the destination path.
+
+    :param str digest: the digest of the resolved index image
+    :param str dest_path: the path to copy the index database to
+    :return: ``True`` if the index database was in the cache; ``False`` otherwise
+    :rtype: bool
+    """
+    cache_dir = get_worker_config()['iib_index_db_cache_dir']
+    if not cache_dir:
+        return False
+
+    cache_path = _get_cache_path(cache_dir, digest)
+    with _lock_cache(cache_dir, exclusive=False):
+        try:
+            shutil.copyfile(cache_path, dest_path)
+        except FileNotFoundError:
+            log.debug('The index database of %s is not cached', digest)
+            return False
+
+        # Mark the entry as recently used since the eviction is based on the modification time
+        try:
+            os.utime(cache_path)
+        except OSError:
+            log.warning('Failed to update the modification time of %s', cache_path)
+
+    log.info('Using the cached index database of %s', digest)
+    return True
+
+
+def cache_index_db(digest, db_path):
+    """
+    Add the index database of the index image to the cache.
+
+    The least recently used index databases are evicted when the total size of the cache exceeds
+    ``iib_index_db_cache_max_size``. Failing to cache the index database is not considered fatal.
+
+    :param str digest: the digest of the resolved index image
+    :param str db_path: the path to the index database to cache
+    """
+    conf = get_worker_config()
+    cache_dir = conf['iib_index_db_cache_dir']
+    if not cache_dir:
+        return
+
+    max_size = conf['iib_index_db_cache_max_size']
+    if os.path.getsize(db_path) > max_size:
+        log.warning('The index database of %s is too large to be cached', digest)
+        return
+
+    cache_path = _get_cache_path(cache_dir, digest)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.', suffix='.tmp')
+    os.close(fd)
+    try:
+        # Copy the file before acquiring the lock so that readers are blocked for as little time
+        # as possible. Renaming it is atomic, so readers never see a partially written entry.
+        shutil.copyfile(db_path, temp_path)
+        with _lock_cache(cache_dir, exclusive=True):
+            os.replace(temp_path, cache_path)
+            _evict_index_dbs(cache_dir, max_size)
+    except OSError:
+        log.exception('Failed to cache the index database of %s', digest)
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+    else:
+        log.debug('Cached the index database of %s at %s', digest, cache_path)
+
+
+def _evict_index_dbs(cache_dir, max_size):
+    """
+    Remove the least recently used index databases until the cache is within the size limit.
+
+    The caller must hold the exclusive lock on the cache directory.
+
+    :param str cache_dir: the path to the cache directory
+    :param int max_size: the maximum total size in bytes of the cached index databases
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.db') and entry.is_file():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        log.debug('Evicting the cached index database %s', path)
+        os.remove(path)
+        total_size -= size
@@ -0,0 +1,313 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import atexit
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+from iib.exceptions import IIBError
+from iib.workers.config import get_worker_config
+
+log = logging.getLogger(__name__)
+
+# The running index registry services keyed by the digest of the index database they serve. The
+# least recently used services are at the beginning.
+_servers = OrderedDict()
+# The events set once the services being started for a digest are started or failed to start
+_starting = {}
+_servers_lock = threading.Lock()
+# The ports assigned to the services of this process, including the ones still starting
+_ports = set()
+_ports_lock = threading.Lock()
+
+
+class _IndexRegistryServer(object):
+    """An ``opm registry serve`` process serving a private copy of an index database."""
+
+    def __init__(self, db_path, port):
+        """
+        Start the ``opm registry serve`` process.
+
+        :param str db_path: the path to the index database to serve; the server takes ownership
+            of the directory containing it
+        :param int port: the port to serve the gRPC API on
+        """
+        self.db_path = db_path
+        self.port = port
+        self.users = 0
+        self.cmd = ['opm', 'registry', 'serve', '-p', str(port), '-d', db_path, '-t', '/dev/null']
+        self.exited = False
+        self._ready = threading.Event()
+        self._stderr = deque(maxlen=50)
+        log.debug('Running the command "%s"', ' '.join(self.cmd))
+        self.process = subprocess.Popen(
+            self.cmd,
+            cwd=os.path.dirname(db_path),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        # The reader thread must keep consuming stderr for as long as the process runs so that
+        # opm never blocks on a full pipe
+        self._reader = threading.Thread(target=self._read_stderr, daemon=True)
+        self._reader.start()
+
+    def _read_stderr(self):
+        """Read the stderr of the process and signal when the service is ready or has exited."""
+        for line in self.process.stderr:
+            self._stderr.append(line)
+            # opm logs this after it starts listening on the port
+            if 'serving registry' in line:
+                self._ready.set()
+
+        self.exited = True
+        self._ready.set()
+
+    @property
+    def stderr(self):
+        """
+        Get the last lines the process wrote to stderr.
+
+        :return: the last lines of stderr
+        :rtype: str
+        """
+        return ''.join(self._stderr)
+
+    def is_running(self):
+        """
+        Determine if the process is still running.
+
+        :return: ``True`` if the process is running
+        :rtype: bool
+        """
+        return not self.exited and self.process.poll() is None
+
+    def wait_until_ready(self, timeout):
+        """
+        Wait until the service is ready to serve requests.
+
+        :param float timeout: the maximum number of seconds to wait
+        :return: ``True`` if the service is ready; ``False`` if the process exited or the timeout
+            was reached
+        :rtype: bool
+        """
+        self._ready.wait(timeout)
+        if self.exited:
+            # Make sure all of stderr has been read so that the error is complete
+            self._reader.join(timeout=1)
+            return False
+        return self._ready.is_set()
+
+    def stop(self):
+        """Stop the process and remove the copy of the index database."""
+        if self.process.poll() is None:
+            log.debug('Stopping the index registry service on port %d', self.port)
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(os.path.dirname(self.db_path), ignore_errors=True)
+        with _ports_lock:
+            _ports.discard(self.port)
+
+
+def _get_free_port():
+    """
+    Get a free port assigned by the operating system which isn't used by another service.
+
+    The port is only free when it's returned, so another process may still bind it before the
+    service does. The ports of the services of this process are tracked so that services started
+    concurrently never get the same port.
+
+    :return: the port number
+    :rtype: int
+    """
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        with _ports_lock:
+            if port not in _ports:
+                _ports.add(port)
+                return port
+
+
+def _get_file_digest(path):
+    """
+    Get the sha256 digest of the file.
+
+    :param str path: the path to the file
+    :return: the hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _start_server(db_path):
+    """
+    Start an index registry service on a private copy of the index database.
+
+    :param str db_path: the path to the index database to serve
+    :return: the running server
+    :rtype: _IndexRegistryServer
+    :raises IIBError: if the service fails to start
+    """
+    conf = get_worker_config()
+    max_tries = conf['iib_grpc_max_tries']
+    for _ in range(max_tries):
+        # Copy the database since the original is removed when the request finishes but the
+        # service may be reused by later requests
+        server_dir = tempfile.mkdtemp(prefix='iib-index-registry-')
+        server_db_path = os.path.join(server_dir, os.path.basename(db_path))
+        shutil.copyfile(db_path, server_db_path)
+
+        port = _get_free_port()
+        server = _IndexRegistryServer(server_db_path, port)
+        if server.wait_until_ready(conf['iib_grpc_init_wait_time']):
+            log.info('Index registry service has been initialized on port %d.', port)
+            return server
+
+        # Check if the process exited on its own before stopping it
+        exited = server.exited
+        server.stop()
+        stderr = server.stderr
+        if 'address already in use' in stderr:
+            log.info('Port %d is in use, trying another.', port)
+        elif exited:
+            raise IIBError(f'Command "{" ".join(server.cmd)}" has failed with error "{stderr}"')
+        else:
+            log.warning(
+                'The index registry service was not initialized after %s seconds',
+                conf['iib_grpc_init_wait_time'],
+            )
+
+    raise IIBError(f'Index registry has not been initialized after {max_tries} tries')
+
+
+def _pop_idle_servers():
+    """
+    Remove the least recently used idle servers exceeding ``iib_index_registry_pool_size``.
+
+    The caller must hold ``_servers_lock`` and stop the returned servers once it releases it.
+
+    :return: the servers to stop
+    :rtype: list
+    """
+    pool_size = get_worker_config()['iib_index_registry_pool_size']
+    idle_digests = [digest for digest, server in _servers.items() if not server.users]
+    evicted = []
+    for digest in idle_digests[: max(len(idle_digests) - pool_size, 0)]:
+        server = _servers.pop(digest)
+        log.debug('Evicting the idle index registry service on port %d', server.port)
+        evicted.append(server)
+    return evicted
+
+
+def _acquire_server(digest, db_path):
+    """
+    Get the server of the index database from the pool, starting it if needed.
+
+    The server is started without holding ``_servers_lock`` so that the other requests aren't
+    blocked while it starts. The requests for the same index database wait for it instead of
+    starting their own server.
+
+    :param str digest: the digest of the index database
+    :param str db_path: the path to the index database to serve
+    :return: the running server with the caller counted as one of its users
+    :rtype: _IndexRegistryServer
+    :raises IIBError: if the service fails to start
+    """
+    while True:
+        exited_server = None
+        with _servers_lock:
+            server = _servers.get(digest)
+            if server and not server.is_running():
+                log.warning(
+                    'The index registry service on port %d has exited: %s',
+                    server.port,
+                    server.stderr,
+                )
+                del _servers[digest]
+                exited_server = server
+                server = None
+
+            if server:
+                log.info('Reusing the index registry service on port %d', server.port)
+                _servers.move_to_end(digest)
+                server.users += 1
+                return server
+
+            starting = _starting.get(digest)
+            if starting is None:
+                # Reserve the slot of the digest so that the other requests wait for this server
+                starting = _starting[digest] = threading.Event()
+                break
+
+        if exited_server:
+            exited_server.stop()
+        # Wait for the server started by another request and then try to reuse it
+        starting.wait()
+
+    if exited_server:
+        exited_server.stop()
+    try:
+        server = _start_server(db_path)
+        with _servers_lock:
+            _servers[digest] = server
+            server.users += 1
+    finally:
+        with _servers_lock:
+            del _starting[digest]
+        starting.set()
+
+    return server
+
+
+@contextmanager
+def serve_index_registry(db_path):
+    """
+    Get an index registry service which serves the index database.
+
+    The services are kept in a pool keyed by the digest of the index database, so the same service
+    is reused for any request reading an identical index database. Up to
+    ``iib_index_registry_pool_size`` idle services are kept running.
+
+    :param str db_path: the path to the index database to serve
+    :return: a context manager which yields the port the service is listening on
+    :rtype: contextlib._GeneratorContextManager
+    :raises IIBError: if the service fails to start
+    """
+    digest = _get_file_digest(db_path)
+    server = _acquire_server(digest, db_path)
+    try:
+        yield server.port
+    finally:
+        with _servers_lock:
+            server.users -= 1
+            if _servers.get(digest) is server:
+                _servers.move_to_end(digest)
+            evicted = _pop_idle_servers()
+        for evicted_server in evicted:
+            evicted_server.stop()
+
+
+@atexit.register
+def stop_index_registry_servers(**kwargs):
+    """
+    Stop all the index registry services in the pool.
+
+    This runs when the interpreter exits and when a Celery worker process shuts down, since the
+    prefork worker processes exit without running the ``atexit`` handlers.
+    """
+    with _servers_lock:
+        while _servers:
+            _, server = _servers.popitem()
+            server.stop()
@@ -1,18 +1,24 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # This file can be deleted once OMPS is retired
+from concurrent.futures import ThreadPoolExecutor
+import io
 import json
 import logging
 import os
-import shutil
 import tempfile
+import zipfile
 
 import requests
 import ruamel.yaml
 
 from iib.exceptions import IIBError
-from iib.workers.api_utils import set_request_state, set_omps_operator_version
+from iib.workers.api_utils import (
+    ThreadLocalSession,
+    set_request_state,
+    set_omps_operator_version,
+)
 from iib.workers.config import get_worker_config
-from iib.workers.tasks.utils import get_image_labels, retry, run_cmd
+from iib.workers.tasks.utils import get_image_labels, podman_pull, retry, run_cmd
 
 log = logging.getLogger(__name__)
 
@@ -21,6 +27,9 @@ def export_legacy_packages(packages, request_id, rebuilt_index_image, cnr_token,
     """
     Export packages to be backported and push them via OMPS.
 
+    The rebuilt index image is pulled once so that every export uses the local copy. The packages
+    are then exported, zipped, and pushed concurrently based on ``iib_legacy_export_concurrency``.
+
     :param set packages: a set of strings representing the names of the packages to be exported.
     :param int request_id: the ID of the IIB build request.
     :param str rebuilt_index_image: the pull specification of the index image rebuilt by IIB.
@@ -30,20 +39,57 @@ def export_legacy_packages(packages, request_id, rebuilt_index_image, cnr_token,
         backported packages should be pushed to.
     :raises IIBError: if the export of packages fails.
     """
-    operator_versions = dict()
+    # Sort the packages so that the error raised when multiple packages fail is deterministic
+    sorted_packages = sorted(packages)
+    podman_pull(rebuilt_index_image)
     with tempfile.TemporaryDirectory(prefix='iib-') as temp_dir:
-        for package in packages:
-            _opm_index_export(rebuilt_index_image, package, temp_dir)
-            package_dir = os.path.join(temp_dir, package, package)
-            _verify_package_info(package_dir, rebuilt_index_image)
-            _zip_package(package_dir)
-            omps_response = _push_package_manifest(package_dir, cnr_token, organization)
-            operator_versions[package] = omps_response.get('version')
-
+        concurrency = min(get_worker_config()['iib_legacy_export_concurrency'], len(packages))
+        export_args = (rebuilt_index_image, temp_dir, cnr_token, organization)
+        if concurrency <= 1:
+            versions = [
+                _export_legacy_package(package, *export_args) for package in sorted_packages
+            ]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    executor.submit(_export_legacy_package, package, *export_args)
+                    for package in sorted_packages
+                ]
+                try:
+                    versions = [future.result() for future in futures]
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+    operator_versions = dict(zip(sorted_packages, versions))
     set_omps_operator_version(request_id, operator_versions)
     set_request_state(request_id, 'in_progress', 'Back ported packages successfully pushed to OMPS')
 
 
+def _export_legacy_package(package, rebuilt_index_image, temp_dir, cnr_token, organization):
+    """
+    Export a package to be backported and push it via OMPS.
+
+    :param str package: the name of the package to be exported.
+    :param str rebuilt_index_image: the pull specification of the index image rebuilt by IIB.
+    :param str temp_dir: path to the temporary directory where the package will be exported to.
+    :param str cnr_token: the token required to push backported packages to the legacy
+        app registry via OMPS.
+    :param str organization: the organization name in the legacy app registry to which the
+        backported packages should be pushed to.
+    :return: the version of the package in the legacy app registry
+    :rtype: str
+    :raises IIBError: if the export or push of the package fails.
+    """
+    _opm_index_export(rebuilt_index_image, package, temp_dir)
+    package_dir = os.path.join(temp_dir, package, package)
+    _verify_package_info(package_dir, rebuilt_index_image)
+    package_zip = _zip_package(package_dir)
+    omps_response = _push_package_manifest(package_zip, cnr_token, organization)
+    return omps_response.get('version')
+
+
 def _get_base_dir_and_pkg_name(package_dir):
     """
     Get the base directory and the package name from package directory.
@@ -55,7 +101,9 @@ def _get_base_dir_and_pkg_name(package_dir):
     return os.path.dirname(package_dir), os.path.basename(package_dir)
 
 
-def get_legacy_support_packages(bundles, request_id, ocp_version, force_backport=False):
+def get_legacy_support_packages(
+    bundles, request_id, ocp_version, force_backport=False, image_metadata=None
+):
     """
     Get the packages that must be pushed to the legacy application registry.
 
@@ -64,6 +112,7 @@ def get_legacy_support_packages(bundles, request_id, ocp_version, force_backport
     :param int request_id: the ID of the IIB build request.
     :param str ocp_version: the OCP version that the index is intended for.
     :param bool force_backport: if True, backport legacy support is forced for every package
+    :param ImageMetadata image_metadata: the metadata of the images used by the request
     :return: a set of packages that require legacy support
     :rtype: set
     """
@@ -74,7 +123,7 @@ def get_legacy_support_packages(bundles, request_id, ocp_version, force_backport
     if force_backport:
         set_request_state(request_id, 'in_progress', 'Backport legacy support will be forced')
     for bundle in bundles:
-        labels = get_image_labels(bundle)
+        labels = get_image_labels(bundle, image_metadata)
         if force_backport or ruamel.yaml.safe_load(
             labels.get('com.redhat.delivery.backport', 'false')
         ):
@@ -114,11 +163,11 @@ def _opm_index_export(rebuilt_index_image, package, temp_dir):
     )
 
 
-def _push_package_manifest(package_dir, cnr_token, organization):
+def _push_package_manifest(package_zip, cnr_token, organization):
     """
-    Push ``manifests.zip`` file created for an exported package to OMPS.
+    Push the ``manifests.zip`` file created for an exported package to OMPS.
 
-    :param str package_dir: path to the exported package directory.
+    :param io.BytesIO package_zip: the in-memory ``manifests.zip`` file of the exported package.
     :param str cnr_token: the token required to push backported packages to the legacy
         app registry via OMPS.
     :param str organization: the organization name in the legacy app registry to which
@@ -128,27 +177,34 @@ def _push_package_manifest(package_dir, cnr_token, organization):
     :raises IIBError: if the push fails
     """
     conf = get_worker_config()
-    base_dir, _ = _get_base_dir_and_pkg_name(package_dir)
-    with open(f'{base_dir}/manifests.zip', 'rb') as fobj:
-        files = {'file': (fobj.name, fobj)}
-        log.info('Files are %s', files)
-        resp = requests.post(
+    files = {'file': ('manifests.zip', package_zip, 'application/zip')}
+    log.info('Files are %s', files)
+    try:
+        resp = requests_session.post(
             f'{conf["iib_omps_url"]}{organization}/zipfile',
             headers={'Authorization': cnr_token},
             files=files,
+            timeout=conf['iib_omps_timeout'],
+        )
+    except requests.RequestException:
+        log.exception('The connection to OMPS failed')
+        raise IIBError(
+            f'Push to {organization} in the legacy app registry was unsucessful: '
+            'the connection to OMPS failed'
         )
-        if not resp.ok:
-            log.error('Request to OMPS failed: %s', resp.text)
-            try:
-                error_msg = resp.json().get('message', 'An unknown error occured')
-            except json.JSONDecodeError:
-                error_msg = resp.text
-            raise IIBError(
-                f'Push to {organization} in the legacy app registry was unsucessful: {error_msg}'
-            )
 
-        log.info('OMPS response: %s', resp.text)
-        return resp.json()
+    if not resp.ok:
+        log.error('Request to OMPS failed: %s', resp.text)
+        try:
+            error_msg = resp.json().get('message', 'An unknown error occured')
+        except json.JSONDecodeError:
+            error_msg = resp.text
+        raise IIBError(
+            f'Push to {organization} in the legacy app registry was unsucessful: {error_msg}'
+        )
+
+    log.info('OMPS response: %s', resp.text)
+    return resp.json()
 
 
 def validate_legacy_params_and_config(packages, bundles, cnr_token, organization):
@@ -195,14 +251,27 @@ def _verify_package_info(package_dir, from_index):
 
 def _zip_package(package_dir):
     """
-    Zip content of exported package to a ``manifests.zip`` file.
+    Zip content of exported package to an in-memory ``manifests.zip`` file.
 
     :param str package_dir: path to the exported package directory
+    :return: the ``manifests.zip`` file positioned at the beginning
+    :rtype: io.BytesIO
     :raises IIBError: if unable to zip the exported package
     """
-    base_dir, package_name = _get_base_dir_and_pkg_name(package_dir)
+    _, package_name = _get_base_dir_and_pkg_name(package_dir)
+    package_zip = io.BytesIO()
     try:
-        shutil.make_archive(f'{base_dir}/manifests', 'zip', package_dir)
+        with zipfile.ZipFile(package_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for root, dirs, files in os.walk(package_dir):
+                for name in sorted(dirs) + sorted(files):
+                    path = os.path.join(root, name)
+                    zip_file.write(path, os.path.relpath(path, package_dir))
     except Exception:
         log.exception('Unable to zip exported package: %s', package_name)
         raise IIBError(f'Unable to zip exported package for {package_name}')
+
+    package_zip.seek(0)
+    return package_zip
+
+
+requests_session = ThreadLocalSession()
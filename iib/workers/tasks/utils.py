@@ -1,36 +1,170 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import base64
-from contextlib import contextmanager
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
 import functools
+import hashlib
 import inspect
 import json
 import logging
 import os
 import re
 import subprocess
+import tempfile
+import threading
+import time
 
 from operator_manifest.operator import ImageName
 
 from iib.exceptions import IIBError
+from iib.workers.api_utils import buffer_request_updates
 from iib.workers.config import get_worker_config
+from iib.workers.registry import get_registry_client
 
 log = logging.getLogger(__name__)
 
+# An in-process LRU cache of ``skopeo inspect`` outputs. See ``_get_skopeo_cache_key``.
+_skopeo_inspect_cache = OrderedDict()
+_skopeo_inspect_cache_lock = threading.Lock()
 
-def get_image_labels(pull_spec):
+
+class ImageMetadata(object):
+    """
+    The metadata of the container images used by a single request.
+
+    The raw manifest and the config of each image are fetched at most once, so the label,
+    architecture, and digest queries made while processing the request share a single registry
+    fetch per image. An instance must not outlive the request since floating tags may be moved.
+    """
+
+    def __init__(self):
+        """Initialize the metadata without fetching anything."""
+        self._lock = threading.Lock()
+        # The raw manifests and configs keyed by the pull specification without the transport
+        self._raw_manifests = {}
+        self._configs = {}
+        # The pull specifications resolved by the request, which share the config of the image
+        # they were resolved to
+        self._resolved = {}
+
+    @staticmethod
+    def _strip_transport(pull_spec):
+        """
+        Remove the ``docker://`` transport from the pull specification.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the pull specification without the transport
+        :rtype: str
+        """
+        return re.sub(r'^docker://', '', pull_spec)
+
+    def _get(self, cache, pull_spec, fetch):
+        """
+        Get the metadata from the cache or fetch it if it's not there yet.
+
+        The lock isn't held while fetching so that images are fetched concurrently. If two threads
+        fetch the same image, the first result is kept.
+
+        :param dict cache: the cache of the metadata
+        :param str pull_spec: the pull specification without the transport
+        :param function fetch: the function which fetches the metadata of the pull specification
+        :return: the metadata
+        """
+        with self._lock:
+            if pull_spec in cache:
+                return cache[pull_spec]
+        value = fetch(pull_spec)
+        with self._lock:
+            return cache.setdefault(pull_spec, value)
+
+    def get_raw_manifest(self, pull_spec):
+        """
+        Get the raw manifest of the container image.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the raw manifest as returned by the registry
+        :rtype: str
+        """
+        return self._get(
+            self._raw_manifests,
+            self._strip_transport(pull_spec),
+            lambda key: skopeo_inspect(f'docker://{key}', '--raw', return_json=False),
+        )
+
+    def get_manifest(self, pull_spec):
+        """
+        Get the manifest of the container image.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the manifest
+        :rtype: dict
+        """
+        return json.loads(self.get_raw_manifest(pull_spec))
+
+    def get_config(self, pull_spec):
+        """
+        Get the config of the container image.
+
+        :param str pull_spec: the pull specification of the container image
+        :return: the config
+        :rtype: dict
+        """
+        pull_spec = self._strip_transport(pull_spec)
+        with self._lock:
+            pull_spec = self._resolved.get(pull_spec, pull_spec)
+        return self._get(
+            self._configs, pull_spec, lambda key: skopeo_inspect(f'docker://{key}', '--config')
+        )
+
+    def set_resolved(self, pull_spec, resolved_pull_spec, raw_manifest=None):
+        """
+        Record that the pull specification was resolved to another pull specification.
+
+        The config of the resolved pull specification is then used for both of them.
+
+        :param str pull_spec: the pull specification of the container image
+        :param str resolved_pull_spec: the pull specification using a digest
+        :param str raw_manifest: the raw manifest of the resolved pull specification if it's
+            already known
+        """
+        pull_spec = self._strip_transport(pull_spec)
+        resolved_pull_spec = self._strip_transport(resolved_pull_spec)
+        with self._lock:
+            if pull_spec != resolved_pull_spec:
+                self._resolved[pull_spec] = resolved_pull_spec
+            if raw_manifest is not None:
+                self._raw_manifests.setdefault(resolved_pull_spec, raw_manifest)
+
+
+def get_image_config(pull_spec, image_metadata=None):
+    """
+    Get the config of the image.
+
+    :param str pull_spec: the pull specification of the image
+    :param ImageMetadata image_metadata: the metadata of the images used by the request; if
+        ``None``, the config is fetched from the registry
+    :return: the config
+    :rtype: dict
+    """
+    if image_metadata:
+        return image_metadata.get_config(pull_spec)
+    if not pull_spec.startswith('docker://'):
+        pull_spec = f'docker://{pull_spec}'
+    return skopeo_inspect(pull_spec, '--config')
+
+
+def get_image_labels(pull_spec, image_metadata=None):
     """
     Get the labels from the image.
 
-    :param list<str> labels: the labels to get
+    :param str pull_spec: the pull specification of the image
+    :param ImageMetadata image_metadata: the metadata of the images used by the request; if
+        ``None``, the labels are fetched from the registry
     :return: the dictionary of the labels on the image
     :rtype: dict
     """
-    if pull_spec.startswith('docker://'):
-        full_pull_spec = pull_spec
-    else:
-        full_pull_spec = f'docker://{pull_spec}'
-    log.debug('Getting the labels from %s', full_pull_spec)
-    return skopeo_inspect(full_pull_spec, '--config').get('config', {}).get('Labels', {})
+    log.debug('Getting the labels from %s', pull_spec)
+    return get_image_config(pull_spec, image_metadata).get('config', {}).get('Labels', {})
 
 
 def retry(
@@ -147,12 +281,19 @@ def set_registry_token(token, container_image):
 
 
 @retry(wait_on=IIBError, logger=log)
-def skopeo_inspect(*args, return_json=True):
+def skopeo_inspect(*args, return_json=True, use_cache=True):
     """
     Wrap the ``skopeo inspect`` command.
 
+    The output of ``skopeo inspect docker://<image> --raw`` and
+    ``skopeo inspect docker://<image> --config`` is cached. See ``_get_skopeo_cache_key`` for
+    details. If ``iib_use_registry_client`` is set, these are retrieved directly from the registry
+    instead of running ``skopeo``.
+
     :param args: any arguments to pass to ``skopeo inspect``
     :param bool return_json: if ``True``, the output will be parsed as JSON and returned
+    :param bool use_cache: if ``False``, the cache will not be read from. This is useful when
+        the latest value of a floating tag is required. The result is still stored in the cache.
     :return: a dictionary of the JSON output from the skopeo inspect command
     :rtype: dict
     :raises IIBError: if the command fails
@@ -163,15 +304,252 @@ def skopeo_inspect(*args, return_json=True):
             exc_msg = f'Failed to inspect {arg}. Make sure it exists and is accessible to IIB.'
             break
 
-    skopeo_timeout = get_worker_config().iib_skopeo_timeout
-    cmd = ['skopeo', '--command-timeout', skopeo_timeout, 'inspect'] + list(args)
-    output = run_cmd(cmd, exc_msg=exc_msg)
+    cache_key, is_digest = _get_skopeo_cache_key(args)
+    output = None
+    if cache_key and use_cache:
+        output = _get_cached_skopeo_output(cache_key, is_digest)
+
+    if output is None:
+        conf = get_worker_config()
+        if cache_key and conf.iib_use_registry_client:
+            output = _registry_client_inspect(*args)
+        else:
+            cmd = ['skopeo', '--command-timeout', conf.iib_skopeo_timeout, 'inspect'] + list(args)
+            output = run_cmd(cmd, exc_msg=exc_msg)
+
+        if cache_key:
+            _set_cached_skopeo_output(cache_key, is_digest, output)
+
     if return_json:
         return json.loads(output)
 
     return output
 
 
+def _registry_client_inspect(image, mode):
+    """
+    Get the equivalent of the ``skopeo inspect`` output using the built-in registry client.
+
+    :param str image: the ``docker://`` pull specification of the container image
+    :param str mode: either ``--raw`` or ``--config``
+    :return: the raw manifest or the image config
+    :rtype: str
+    :raises IIBError: if the request to the registry fails
+    """
+    pull_spec = image.replace('docker://', '', 1)
+    client = get_registry_client()
+    if mode == '--raw':
+        return client.get_manifest(pull_spec)
+
+    config = client.get_config(pull_spec)
+    if config is not None:
+        return config
+
+    # The registry client doesn't support converting schema 1 manifests to an image config, so let
+    # skopeo handle this case
+    log.debug('Falling back to skopeo to get the config of %s', image)
+    skopeo_timeout = get_worker_config().iib_skopeo_timeout
+    cmd = ['skopeo', '--command-timeout', skopeo_timeout, 'inspect', image, mode]
+    return run_cmd(
+        cmd, exc_msg=f'Failed to inspect {image}. Make sure it exists and is accessible to IIB.'
+    )
+
+
+def _get_skopeo_cache_key(args):
+    """
+    Get the cache key for the ``skopeo inspect`` arguments.
+
+    Only the ``--raw`` and ``--config`` modes on a single ``docker://`` image are cached. If the
+    image is referenced by a ``sha256`` digest, the content is immutable, so the key is based on
+    the digest alone. Otherwise, the key is based on the full pull specification and the entry
+    expires after ``iib_skopeo_cache_tag_ttl`` seconds.
+
+    :param tuple args: the arguments passed to ``skopeo inspect``
+    :return: a tuple of the cache key and whether it is based on a digest; the cache key is
+        ``None`` if the arguments are not cacheable
+    :rtype: tuple(str, bool)
+    """
+    if len(args) != 2:
+        return None, False
+
+    image, mode = args
+    if not image.startswith('docker://') or mode not in ('--raw', '--config'):
+        return None, False
+
+    if '@sha256:' in image:
+        digest = image.split('@', 1)[1]
+        return f'{digest} {mode}', True
+
+    return f'{image} {mode}', False
+
+
+def _get_skopeo_cache_path(cache_key, is_digest):
+    """
+    Get the path of the on-disk cache entry for the cache key.
+
+    The file name is prefixed with the kind of the cache key so that the expired entries can be
+    found without reading them.
+
+    :param str cache_key: the cache key from ``_get_skopeo_cache_key``
+    :param bool is_digest: whether the cache key is based on a digest
+    :return: the path of the cache entry or ``None`` if ``iib_skopeo_cache_dir`` is not set
+    :rtype: str or None
+    """
+    cache_dir = get_worker_config().iib_skopeo_cache_dir
+    if not cache_dir:
+        return None
+
+    file_name = hashlib.sha256(cache_key.encode('utf-8')).hexdigest()
+    prefix = 'digest' if is_digest else 'tag'
+    return os.path.join(cache_dir, f'{prefix}-{file_name}.json')
+
+
+def _get_cached_skopeo_output(cache_key, is_digest):
+    """
+    Get the cached ``skopeo inspect`` output from the in-process or on-disk cache.
+
+    :param str cache_key: the cache key from ``_get_skopeo_cache_key``
+    :param bool is_digest: if ``False``, the entry expires after ``iib_skopeo_cache_tag_ttl``
+        seconds
+    :return: the cached output or ``None`` if there is no valid entry
+    :rtype: str or None
+    """
+    conf = get_worker_config()
+    if is_digest:
+        min_created = 0
+    else:
+        min_created = time.time() - conf.iib_skopeo_cache_tag_ttl
+
+    with _skopeo_inspect_cache_lock:
+        entry = _skopeo_inspect_cache.get(cache_key)
+        if entry and entry['created'] >= min_created:
+            _skopeo_inspect_cache.move_to_end(cache_key)
+            log.debug('Using the cached skopeo inspect output for %s', cache_key)
+            return entry['output']
+
+    cache_path = _get_skopeo_cache_path(cache_key, is_digest)
+    if not cache_path:
+        return None
+
+    try:
+        with open(cache_path, 'r') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        log.warning('Ignoring the unreadable skopeo inspect cache entry at %s', cache_path)
+        return None
+
+    if entry.get('key') != cache_key or entry.get('created', 0) < min_created:
+        return None
+
+    log.debug('Using the skopeo inspect output for %s cached at %s', cache_key, cache_path)
+    _add_skopeo_output_to_memory(cache_key, entry)
+    return entry['output']
+
+
+def _set_cached_skopeo_output(cache_key, is_digest, output):
+    """
+    Store the ``skopeo inspect`` output in the in-process and on-disk cache.
+
+    Failing to write the on-disk cache entry is not considered fatal.
+
+    :param str cache_key: the cache key from ``_get_skopeo_cache_key``
+    :param bool is_digest: whether the cache key is based on a digest
+    :param str output: the output of the ``skopeo inspect`` command
+    """
+    entry = {'created': time.time(), 'key': cache_key, 'output': output}
+    _add_skopeo_output_to_memory(cache_key, entry)
+
+    cache_path = _get_skopeo_cache_path(cache_key, is_digest)
+    if not cache_path:
+        return
+
+    # Write to a temporary file first and then rename it so that other worker processes reading
+    # the same cache directory never see a partially written entry
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(temp_path)
+            raise
+    except OSError:
+        log.warning('Failed to write the skopeo inspect cache entry at %s', cache_path)
+        return
+
+    _prune_skopeo_cache_dir(cache_dir)
+
+
+def _prune_skopeo_cache_dir(cache_dir):
+    """
+    Remove the expired entries and the oldest entries exceeding the limit from the on-disk cache.
+
+    The entries of images referenced by a tag expire after ``iib_skopeo_cache_tag_ttl`` seconds.
+    Then, the oldest entries are removed until there are at most ``iib_skopeo_cache_max_files``
+    entries. Since several worker processes may prune the cache directory concurrently, the
+    entries which were already removed are ignored.
+
+    :param str cache_dir: the path to the cache directory
+    """
+    conf = get_worker_config()
+    min_tag_mtime = time.time() - conf.iib_skopeo_cache_tag_ttl
+    entries = []
+    try:
+        for entry in os.scandir(cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith('tag-') and mtime < min_tag_mtime:
+                _remove_skopeo_cache_file(entry.path)
+            else:
+                entries.append((mtime, entry.path))
+    except OSError:
+        log.warning('Failed to list the skopeo inspect cache entries in %s', cache_dir)
+        return
+
+    entries.sort()
+    for _, path in entries[: max(len(entries) - conf.iib_skopeo_cache_max_files, 0)]:
+        _remove_skopeo_cache_file(path)
+
+
+def _remove_skopeo_cache_file(path):
+    """
+    Remove the on-disk cache entry, ignoring any errors.
+
+    :param str path: the path of the cache entry
+    """
+    log.debug('Removing the skopeo inspect cache entry at %s', path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        log.warning('Failed to remove the skopeo inspect cache entry at %s', path)
+
+
+def _add_skopeo_output_to_memory(cache_key, entry):
+    """
+    Add the entry to the in-process cache and evict the least recently used entries.
+
+    :param str cache_key: the cache key from ``_get_skopeo_cache_key``
+    :param dict entry: the cache entry with the keys ``created`` and ``output``
+    """
+    max_entries = get_worker_config().iib_skopeo_cache_max_entries
+    with _skopeo_inspect_cache_lock:
+        _skopeo_inspect_cache[cache_key] = entry
+        _skopeo_inspect_cache.move_to_end(cache_key)
+        while len(_skopeo_inspect_cache) > max_entries:
+            _skopeo_inspect_cache.popitem(last=False)
+
+
 @retry(wait_on=IIBError, logger=log)
 def podman_pull(*args):
     """
@@ -268,6 +646,31 @@ def request_logger(func):
     return wrapper
 
 
+def request_updates_buffered(func):
+    """
+    Buffer the updates of the current request sent to the IIB API.
+
+    The updates are merged and sent in batches as described in ``RequestUpdateBuffer``. Any
+    buffered updates are sent before the decorated function returns or raises an exception.
+
+    :param function func: the function to be decorated. The function must take the ``request_id``
+        parameter.
+    :return: the decorated function
+    :rtype: function
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        request_id = _get_function_arg_value('request_id', func, args, kwargs)
+        if not request_id:
+            raise IIBError(f'Unable to get "request_id" from {func.__name__}')
+
+        with buffer_request_updates(request_id):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
 def _get_function_arg_value(arg_name, func, args, kwargs):
     """Return the value of the given argument name."""
     original_func = func
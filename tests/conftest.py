@@ -1,8 +1,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from contextlib import contextmanager
 import os
 
 import flask_migrate
 import pytest
+import sqlalchemy
 
 from iib.web import models
 from iib.web.app import create_app, db as _db
@@ -56,6 +58,31 @@ def db(app, tmpdir):
     return _db
 
 
+@pytest.fixture()
+def capture_statements(db):
+    """
+    Return a context manager that captures the SQL statements executed in its block.
+
+    The context manager yields the list that the ``(statement, executemany)`` tuples of the
+    executed statements are appended to.
+    """
+
+    @contextmanager
+    def _capture_statements():
+        statements = []
+
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, executemany))
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', _before_cursor_execute)
+
+    return _capture_statements
+
+
 @pytest.fixture()
 def client(app):
     """Return Flask application client for the pytest session."""
@@ -1,4 +1,6 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import collections
+import gzip
 import json
 from unittest import mock
 
@@ -6,7 +8,7 @@ import pytest
 from sqlalchemy.exc import DisconnectionError
 
 from iib.web.api_v1 import _get_unique_bundles
-from iib.web.models import Image, RequestAdd, RequestRm
+from iib.web.models import Image, Operator, Request, RequestAdd, RequestRm, TaskOutbox, User
 
 
 def test_get_build(app, auth_env, client, db):
@@ -79,6 +81,60 @@ def test_get_build(app, auth_env, client, db):
     assert rv == expected
 
 
+@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
+def test_get_build_cached(mock_smfsc, db, minimal_request_add, worker_auth_env, client):
+    minimal_request_add.add_state('in_progress', 'Building the index image')
+    db.session.commit()
+    request_id = minimal_request_add.id
+
+    rv = client.get(f'/api/v1/builds/{request_id}')
+    assert rv.status_code == 200
+    assert rv.headers['ETag']
+    # The JSON of requests which aren't in a final state isn't cached
+    assert db.session.query(Request.serialized_json).filter_by(id=request_id).scalar() is None
+
+    rv = client.patch(
+        f'/api/v1/builds/{request_id}',
+        json={'state': 'complete', 'state_reason': 'All done!'},
+        environ_base=worker_auth_env,
+    )
+    assert rv.status_code == 200
+    rv = client.get(f'/api/v1/builds/{request_id}')
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+    expected = rv.json
+    assert expected['state'] == 'complete'
+    assert 'logs' in expected
+    serialized_json = db.session.query(Request.serialized_json).filter_by(id=request_id).scalar()
+    assert json.loads(serialized_json) == {k: v for k, v in expected.items() if k != 'logs'}
+
+    # The cached JSON is served with the logs and the same entity tag
+    with mock.patch('iib.web.api_v1.get_request_query_options') as mock_grqo:
+        rv = client.get(f'/api/v1/builds/{request_id}')
+        assert rv.status_code == 200
+        assert rv.json == expected
+        assert rv.headers['ETag'] == etag
+
+        rv = client.get(f'/api/v1/builds/{request_id}', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+    mock_grqo.assert_not_called()
+
+    # Patching the request resets the cached JSON
+    rv = client.patch(
+        f'/api/v1/builds/{request_id}',
+        json={'index_image': 'quay.io/namespace/index@sha256:fghijk'},
+        environ_base=worker_auth_env,
+    )
+    assert rv.status_code == 200
+    assert db.session.query(Request.serialized_json).filter_by(id=request_id).scalar() is None
+    rv = client.get(f'/api/v1/builds/{request_id}', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.json['index_image'] == 'quay.io/namespace/index@sha256:fghijk'
+    assert rv.headers['ETag'] != etag
+
+
 def test_get_builds(app, auth_env, client, db):
     total_requests = 50
     # flask_login.current_user is used in RequestAdd.from_json, which requires a request context
@@ -125,6 +181,88 @@ def test_get_builds(app, auth_env, client, db):
     assert 'state_history' in rv_json['items'][0]
 
 
+def test_get_builds_by_id(app, auth_env, client, db):
+    total_requests = 12
+    # flask_login.current_user is used in RequestAdd.from_json, which requires a request context
+    with app.test_request_context(environ_base=auth_env):
+        for i in range(total_requests):
+            data = {
+                'binary_image': 'quay.io/namespace/binary_image:latest',
+                'bundles': [f'quay.io/namespace/bundle:{i}'],
+                'from_index': f'quay.io/namespace/repo:{i}',
+            }
+            request = RequestAdd.from_json(data)
+            if i % 2 == 0:
+                request.add_state('failed', 'Failed due to an unknown error')
+            db.session.add(request)
+        db.session.commit()
+
+    rv_json = client.get('/api/v1/builds?count=false&per_page=5').json
+    assert [item['id'] for item in rv_json['items']] == [12, 11, 10, 9, 8]
+    assert rv_json['meta'] == {
+        'first': 'http://localhost/api/v1/builds?per_page=5&count=false',
+        'last': 'http://localhost/api/v1/builds?before_id=0&per_page=5&count=false',
+        'next': 'http://localhost/api/v1/builds?after_id=8&per_page=5&count=false',
+        'page': None,
+        'pages': None,
+        'per_page': 5,
+        'previous': None,
+        'total': None,
+    }
+
+    rv_json = client.get(rv_json['meta']['next']).json
+    assert [item['id'] for item in rv_json['items']] == [7, 6, 5, 4, 3]
+    assert rv_json['meta']['next'].endswith('after_id=3&per_page=5&count=false')
+    assert rv_json['meta']['previous'].endswith('before_id=7&per_page=5&count=false')
+
+    rv_json = client.get(rv_json['meta']['next']).json
+    assert [item['id'] for item in rv_json['items']] == [2, 1]
+    assert rv_json['meta']['next'] is None
+
+    rv_json = client.get(rv_json['meta']['previous']).json
+    assert [item['id'] for item in rv_json['items']] == [7, 6, 5, 4, 3]
+
+    rv_json = client.get('/api/v1/builds?before_id=0&per_page=5').json
+    assert [item['id'] for item in rv_json['items']] == [5, 4, 3, 2, 1]
+    assert rv_json['meta']['next'] is None
+    assert rv_json['meta']['previous'].endswith('before_id=5&per_page=5')
+    assert rv_json['meta']['pages'] == 3
+    assert rv_json['meta']['total'] == total_requests
+
+    rv_json = client.get('/api/v1/builds?after_id=12&state=failed&per_page=2').json
+    assert [item['id'] for item in rv_json['items']] == [11, 9]
+    assert rv_json['meta']['next'].endswith('after_id=9&per_page=2&state=failed')
+    assert rv_json['meta']['previous'] is None
+    assert rv_json['meta']['total'] == total_requests // 2
+
+
+@pytest.mark.parametrize(
+    'query, error',
+    (
+        (
+            'after_id=abc',
+            'The "after_id" query parameter must be an integer greater than or equal to 0',
+        ),
+        (
+            'before_id=-1',
+            'The "before_id" query parameter must be an integer greater than or equal to 0',
+        ),
+        (
+            'after_id=1&per_page=0',
+            'The "per_page" query parameter must be an integer greater than or equal to 1',
+        ),
+        (
+            'after_id=1&before_id=2',
+            'The "after_id" and "before_id" query parameters are mutually exclusive',
+        ),
+    ),
+)
+def test_get_builds_by_id_invalid(app, client, db, query, error):
+    rv = client.get(f'/api/v1/builds?{query}')
+    assert rv.status_code == 400
+    assert rv.json == {'error': error}
+
+
 def test_get_builds_invalid_state(app, client, db):
     rv = client.get('/api/v1/builds?state=is_it_lunch_yet%3F')
     assert rv.status_code == 400
@@ -212,6 +350,216 @@ def test_get_build_logs(
         assert rv.json == expected['json']
 
 
+@pytest.mark.parametrize(
+    'query, headers, expected_status, expected_data, expected_content_range',
+    (
+        ('', {}, 200, 'line 1\nline 2\n', None),
+        ('?offset=7', {}, 200, 'line 2\n', None),
+        ('?offset=100', {}, 200, '', None),
+        ('?tail=4', {}, 200, 'e 2\n', None),
+        ('?tail=100', {}, 200, 'line 1\nline 2\n', None),
+        ('', {'Range': 'bytes=7-'}, 206, 'line 2\n', 'bytes 7-13/14'),
+        ('', {'Range': 'bytes=-2'}, 206, '2\n', 'bytes 12-13/14'),
+        ('?offset=7', {'Range': 'bytes=0-3'}, 206, 'line', 'bytes 0-3/7'),
+        ('', {'Range': 'bytes=7-', 'If-Range': '"other"'}, 200, 'line 1\nline 2\n', None),
+    ),
+)
+def test_get_build_logs_partial(
+    client,
+    db,
+    minimal_request_add,
+    tmpdir,
+    query,
+    headers,
+    expected_status,
+    expected_data,
+    expected_content_range,
+):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('line 1\nline 2\n')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs{query}', headers=headers)
+
+    assert rv.status_code == expected_status
+    assert rv.mimetype == 'text/plain'
+    assert rv.data.decode('utf-8') == expected_data
+    assert rv.headers.get('Content-Range') == expected_content_range
+    assert rv.headers['X-IIB-Log-Size'] == '14'
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_get_build_logs_range_not_satisfiable(client, db, minimal_request_add, tmpdir):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('foobar')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs', headers={'Range': 'bytes=10-'})
+
+    assert rv.status_code == 416
+
+
+@pytest.mark.parametrize(
+    'query, error',
+    (
+        ('?offset=-1', 'The "offset" query parameter must be a non-negative integer'),
+        ('?tail=abc', 'The "tail" query parameter must be a non-negative integer'),
+        ('?offset=1&tail=1', 'The "offset" and "tail" query parameters are mutually exclusive'),
+    ),
+)
+def test_get_build_logs_invalid_query(client, db, minimal_request_add, tmpdir, query, error):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('foobar')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs{query}')
+
+    assert rv.status_code == 400
+    assert rv.json == {'error': error}
+
+
+def test_get_build_logs_etag(client, db, minimal_request_add, tmpdir):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    log_file = tmpdir.join(f'{request_id}.log')
+    log_file.write('foobar')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs')
+    assert rv.status_code == 200
+    etag = rv.headers['ETag']
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+    assert rv.headers['ETag'] == etag
+
+    # The ETag changes once more logs are written
+    log_file.write('foobar\nmore logs', mode='a')
+    rv = client.get(f'/api/v1/builds/{request_id}/logs', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_get_build_logs_gzip(client, db, minimal_request_add, tmpdir):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('foobar\n' * 100)
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs', headers={'Accept-Encoding': 'gzip'})
+
+    assert rv.status_code == 200
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(rv.data).decode('utf-8') == 'foobar\n' * 100
+
+    # Partial content isn't compressed
+    rv = client.get(
+        f'/api/v1/builds/{request_id}/logs',
+        headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-5'},
+    )
+    assert rv.status_code == 206
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.data == b'foobar'
+
+
+def test_get_build_logs_follow(client, db, minimal_request_add, tmpdir):
+    minimal_request_add.add_state('complete', 'The request is complete')
+    db.session.commit()
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('line 1\nline 2\nline 3')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs?follow=true')
+
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/event-stream'
+    # The final line is sent even without a line ending since the request is complete
+    assert rv.data.decode('utf-8') == (
+        'retry: 1000\n\n'
+        'id: 20\ndata: line 1\ndata: line 2\ndata: line 3\n\n'
+        'id: 20\nevent: end\ndata: \n\n'
+    )
+
+
+@pytest.mark.parametrize(
+    'query, headers, expected_events',
+    (
+        ('', {}, 'id: 14\ndata: line 1\ndata: line 2\n\n'),
+        ('&offset=7', {}, 'id: 14\ndata: line 2\n\n'),
+        ('', {'Last-Event-ID': '7'}, 'id: 14\ndata: line 2\n\n'),
+        ('', {'Last-Event-ID': '14'}, ''),
+    ),
+)
+def test_get_build_logs_follow_in_progress(
+    client, db, minimal_request_add, tmpdir, query, headers, expected_events
+):
+    minimal_request_add.add_state('in_progress', 'Starting things up!')
+    db.session.commit()
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    client.application.config['IIB_REQUEST_LOGS_FOLLOW_TIMEOUT'] = 0
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('line 1\nline 2\nline')
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs?follow=true{query}', headers=headers)
+
+    assert rv.status_code == 200
+    # The partial line isn't sent and the stream is closed once the timeout is reached
+    assert rv.data.decode('utf-8') == f'retry: 1000\n\n{expected_events}'
+
+
+@mock.patch('iib.web.api_v1.time.sleep')
+@mock.patch('iib.web.api_v1._get_request_state_name')
+def test_get_build_logs_follow_appended(
+    mock_grsn, mock_sleep, client, db, minimal_request_add, tmpdir
+):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    log_file = tmpdir.join(f'{request_id}.log')
+    log_file.write('line 1\n')
+    mock_grsn.side_effect = ['in_progress', 'in_progress', 'complete']
+    # Logs are appended while the client waits for them
+    mock_sleep.side_effect = lambda interval: log_file.write(
+        ['line 2\nline', ' 3\n'][mock_sleep.call_count - 1], mode='a'
+    )
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs?follow=true')
+
+    assert rv.data.decode('utf-8') == (
+        'retry: 1000\n\n'
+        'id: 7\ndata: line 1\n\n'
+        'id: 14\ndata: line 2\n\n'
+        'id: 21\ndata: line 3\n\n'
+        'id: 21\nevent: end\ndata: \n\n'
+    )
+    assert mock_sleep.call_count == 2
+
+
+def test_get_build_logs_follow_not_initiated(client, db, minimal_request_add, tmpdir):
+    minimal_request_add.add_state('in_progress', 'Starting things up!')
+    db.session.commit()
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    client.application.config['IIB_REQUEST_LOGS_FOLLOW_TIMEOUT'] = 0
+    request_id = minimal_request_add.id
+
+    rv = client.get(f'/api/v1/builds/{request_id}/logs?follow=true')
+
+    assert rv.status_code == 200
+    assert rv.mimetype == 'text/event-stream'
+    assert rv.data.decode('utf-8') == 'retry: 1000\n\n'
+
+
+def test_get_build_logs_follow_invalid_last_event_id(client, db, minimal_request_add, tmpdir):
+    client.application.config['IIB_REQUEST_LOGS_DIR'] = str(tmpdir)
+    request_id = minimal_request_add.id
+    tmpdir.join(f'{request_id}.log').write('foobar')
+
+    rv = client.get(
+        f'/api/v1/builds/{request_id}/logs?follow=true', headers={'Last-Event-ID': 'abc'}
+    )
+
+    assert rv.status_code == 400
+    assert rv.json == {'error': 'The "Last-Event-ID" header must be a non-negative integer'}
+
+
 def test_get_build_logs_not_configured(client, db, minimal_request_add):
     minimal_request_add.add_state('in_progress', 'Starting things up!')
     db.session.commit()
@@ -320,9 +668,9 @@ def test_add_bundles_overwrite_not_allowed(mock_smfsc, client, db):
 @mock.patch('iib.web.api_v1.db.session')
 @mock.patch('iib.web.api_v1.flask.jsonify')
 @mock.patch('iib.web.api_v1.RequestAdd')
-@mock.patch('iib.web.api_v1.handle_add_request.apply_async')
+@mock.patch('iib.web.api_v1.add_task_to_outbox')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_add_bundles_unique_bundles(mock_smfsc, mock_har, mock_radd, mock_fj, mock_dbs, client):
+def test_add_bundles_unique_bundles(mock_smfsc, mock_attob, mock_radd, mock_fj, mock_dbs, client):
     data = {
         'binary_image': 'binary:image',
         'bundles': ['same:thing', 'same:thing'],
@@ -336,7 +684,7 @@ def test_add_bundles_unique_bundles(mock_smfsc, mock_har, mock_radd, mock_fj, mo
     )
 
     # check if duplicate bundles were removed from payload
-    assert mock_har.call_args[1]['args'][0] == ['same:thing']
+    assert mock_attob.call_args[0][2][0] == ['same:thing']
 
 
 @pytest.mark.parametrize(
@@ -532,18 +880,9 @@ def test_add_bundle_from_index_and_add_arches_missing(mock_smfsc, db, auth_env,
         (True, [], 'some:thing', 'DeV'),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_add_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_add_bundle_success(
-    mock_smfsc,
-    mock_har,
-    overwrite_from_index,
-    db,
-    auth_env,
-    client,
-    bundles,
-    from_index,
-    distribution_scope,
+    mock_smfsc, overwrite_from_index, db, auth_env, client, bundles, from_index, distribution_scope
 ):
     data = {
         'binary_image': 'binary:image',
@@ -605,18 +944,16 @@ def test_add_bundle_success(
     assert rv.status_code == 201
     assert response_json == rv_json
     assert 'cnr_token' not in rv_json
-    assert 'token' not in mock_har.apply_async.call_args[1]['argsrepr']
-    assert '*****' in mock_har.apply_async.call_args[1]['argsrepr']
-    mock_har.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_add_request'
+    assert 'token' not in task.argsrepr
+    assert '*****' in task.argsrepr
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
 @pytest.mark.parametrize('force_overwrite', (False, True))
-@mock.patch('iib.web.api_v1.handle_add_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_add_bundle_forced_overwrite(
-    mock_smfsc, mock_har, force_overwrite, app, auth_env, client, db
-):
+def test_add_bundle_forced_overwrite(mock_smfsc, force_overwrite, app, auth_env, client, db):
     app.config['IIB_FORCE_OVERWRITE_FROM_INDEX'] = force_overwrite
     data = {
         'bundles': ['some:thing'],
@@ -627,15 +964,15 @@ def test_add_bundle_forced_overwrite(
 
     rv = client.post('/api/v1/builds/add', json=data, environ_base=auth_env)
     assert rv.status_code == 201
-    mock_har.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_add_request'
     # Fourth to last element in args is the overwrite_from_index parameter
-    assert mock_har.apply_async.call_args[1]['args'][-5] == force_overwrite
+    assert task.args[-5] == force_overwrite
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
 @pytest.mark.parametrize('force_backport', (False, True))
-@mock.patch('iib.web.api_v1.handle_add_request')
-def test_add_bundle_force_backport(mock_har, force_backport, db, auth_env, client):
+def test_add_bundle_force_backport(force_backport, db, auth_env, client):
     data = {
         'bundles': ['some:thing'],
         'binary_image': 'binary:image',
@@ -645,14 +982,14 @@ def test_add_bundle_force_backport(mock_har, force_backport, db, auth_env, clien
 
     rv = client.post('/api/v1/builds/add', json=data, environ_base=auth_env)
     assert rv.status_code == 201
-    mock_har.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_add_request'
     # Eigth element in args is the force_backport parameter
-    assert mock_har.apply_async.call_args[1]['args'][7] == force_backport
+    assert task.args[7] == force_backport
 
 
-@mock.patch('iib.web.api_v1.handle_add_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_add_bundle_overwrite_token_redacted(mock_smfsc, mock_har, app, auth_env, client, db):
+def test_add_bundle_overwrite_token_redacted(mock_smfsc, app, auth_env, client, db):
     token = 'username:password'
     data = {
         'bundles': ['some:thing'],
@@ -665,15 +1002,16 @@ def test_add_bundle_overwrite_token_redacted(mock_smfsc, mock_har, app, auth_env
     rv = client.post('/api/v1/builds/add', json=data, environ_base=auth_env)
     rv_json = rv.json
     assert rv.status_code == 201
-    mock_har.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_add_request'
     # Fourth to last element in args is the overwrite_from_index parameter
-    assert mock_har.apply_async.call_args[1]['args'][-5] is True
+    assert task.args[-5] is True
     # Third to last element in args is the overwrite_from_index_token parameter
-    assert mock_har.apply_async.call_args[1]['args'][-4] == token
+    assert task.args[-4] == token
     assert 'overwrite_from_index_token' not in rv_json
     assert token not in json.dumps(rv_json)
-    assert token not in mock_har.apply_async.call_args[1]['argsrepr']
-    assert '*****' in mock_har.apply_async.call_args[1]['argsrepr']
+    assert token not in task.argsrepr
+    assert '*****' in task.argsrepr
 
 
 @pytest.mark.parametrize(
@@ -697,10 +1035,9 @@ def test_add_bundle_overwrite_token_redacted(mock_smfsc, mock_har, app, auth_env
         ({'not.tbrady@DOMAIN.LOCAL': 'Patriots'}, True, None),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_add_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_add_bundle_custom_user_queue(
-    mock_smfsc, mock_har, app, auth_env, client, user_to_queue, overwrite_from_index, expected_queue
+    mock_smfsc, app, auth_env, client, db, user_to_queue, overwrite_from_index, expected_queue
 ):
     app.config['IIB_USER_TO_QUEUE'] = user_to_queue
     data = {'bundles': ['some:thing'], 'binary_image': 'binary:image', 'add_arches': ['s390x']}
@@ -710,10 +1047,9 @@ def test_add_bundle_custom_user_queue(
 
     rv = client.post('/api/v1/builds/add', json=data, environ_base=auth_env)
     assert rv.status_code == 201, rv.json
-    mock_har.apply_async.assert_called_once()
-    mock_har.apply_async.assert_called_with(
-        args=mock.ANY, argsrepr=mock.ANY, link_error=mock.ANY, queue=expected_queue
-    )
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_add_request'
+    assert task.queue == expected_queue
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
@@ -957,6 +1293,62 @@ def test_patch_request_add_success(mock_smfsc, db, minimal_request_add, worker_a
     mock_smfsc.assert_called_once_with(mock.ANY)
 
 
+def _count_statements(statements):
+    """
+    Count the SQL statements captured by the ``capture_statements`` fixture.
+
+    The statements are counted by their first words, up to the table name for the inserts. For
+    example, ``("INSERT OR IGNORE INTO image", True)`` for the inserts of images in bulk.
+
+    :param list statements: the ``(statement, executemany)`` tuples of the executed statements
+    :return: the number of statements keyed by their first words and ``executemany``
+    :rtype: collections.Counter
+    """
+    counter = collections.Counter()
+    for statement, executemany in statements:
+        words = statement.split()
+        end = words.index('INTO') + 2 if words[0] == 'INSERT' else 3
+        counter[(' '.join(words[:end]), executemany)] += 1
+    return counter
+
+
+@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
+def test_patch_request_add_bulk_statements(
+    mock_smfsc, capture_statements, db, minimal_request_add, worker_auth_env, client
+):
+    bundle_mapping = {
+        f'operator{i}': [f'quay.io/ns/operator{i}-bundle:v{j}' for j in range(10)]
+        for i in range(10)
+    }
+    data = {
+        'bundle_mapping': bundle_mapping,
+        'binary_image_resolved': 'quay.io/ns/binary-image@sha256:1234',
+        'from_index_resolved': 'quay.io/ns/index@sha256:1234',
+    }
+    bundles = Image.get_or_create_many(
+        {bundle for bundles in bundle_mapping.values() for bundle in bundles}
+    )
+    minimal_request_add.bundles.extend(bundles.values())
+    minimal_request_add.add_state('in_progress', 'Starting things up')
+    db.session.commit()
+
+    with capture_statements() as statements:
+        rv = client.patch(
+            f'/api/v1/builds/{minimal_request_add.id}', json=data, environ_base=worker_auth_env
+        )
+
+    assert rv.status_code == 200, rv.json
+    assert rv.json['bundle_mapping'] == bundle_mapping
+    assert rv.json['binary_image_resolved'] == 'quay.io/ns/binary-image@sha256:1234'
+    # The images and operators are queried and inserted at once instead of one by one
+    statements = _count_statements(statements)
+    for table in ('image', 'operator'):
+        assert statements[(f'INSERT OR IGNORE INTO {table}', True)] == 1
+        assert statements[(f'INSERT OR IGNORE INTO {table}', False)] == 0
+    assert Image.query.count() == 1 + 2 + 100
+    assert Operator.query.count() == 10
+
+
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_patch_request_rm_success(mock_smfsc, db, minimal_request_rm, worker_auth_env, client):
     data = {
@@ -1075,9 +1467,92 @@ def test_patch_request_regenerate_bundle_success(
     mock_smfsc.assert_called_once_with(mock.ANY)
 
 
-@mock.patch('iib.web.api_v1.handle_rm_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_remove_operator_success(mock_smfsc, mock_rm, db, auth_env, client):
+def test_patch_request_updates_success(
+    mock_smfsc, db, minimal_request_add, worker_auth_env, client
+):
+    minimal_request_add.add_state('in_progress', 'Starting things up')
+    db.session.commit()
+    data = [
+        {'state': 'in_progress', 'state_reason': 'Resolving the bundles'},
+        {
+            'binary_image_resolved': 'binary-image@sha256:1234',
+            'state': 'in_progress',
+            'state_reason': 'Building the index image',
+        },
+        {'arches': ['amd64'], 'state': 'complete', 'state_reason': 'All done!'},
+    ]
+
+    rv = client.patch(
+        f'/api/v1/builds/{minimal_request_add.id}/updates', json=data, environ_base=worker_auth_env
+    )
+
+    assert rv.status_code == 200, rv.json
+    assert rv.json['arches'] == ['amd64']
+    assert rv.json['binary_image_resolved'] == 'binary-image@sha256:1234'
+    assert rv.json['state'] == 'complete'
+    assert [state['state_reason'] for state in rv.json['state_history']] == [
+        'All done!',
+        'Building the index image',
+        'Resolving the bundles',
+        'Starting things up',
+    ]
+    mock_smfsc.assert_called_once_with(mock.ANY)
+
+
+@pytest.mark.parametrize(
+    'data, error_msg',
+    (
+        ({'state': 'complete', 'state_reason': 'All done!'}, 'must be a non-empty JSON array'),
+        ([], 'must be a non-empty JSON array'),
+        (
+            [{'state': 'in_progress', 'state_reason': 'Building the index image'}, {}],
+            'At least one key must be specified to update the request',
+        ),
+        (
+            [
+                {'state': 'complete', 'state_reason': 'All done!'},
+                {'state': 'in_progress', 'state_reason': 'Building the index image'},
+            ],
+            'A complete request cannot change states',
+        ),
+    ),
+)
+@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
+def test_patch_request_updates_invalid(
+    mock_smfsc, data, error_msg, db, minimal_request_add, worker_auth_env, client
+):
+    minimal_request_add.add_state('in_progress', 'Starting things up')
+    db.session.commit()
+
+    rv = client.patch(
+        f'/api/v1/builds/{minimal_request_add.id}/updates', json=data, environ_base=worker_auth_env
+    )
+
+    assert rv.status_code == 400
+    assert error_msg in rv.json['error']
+    mock_smfsc.assert_not_called()
+    # None of the updates are applied
+    rv = client.get(f'/api/v1/builds/{minimal_request_add.id}')
+    assert rv.json['state_reason'] == 'Starting things up'
+
+
+@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
+def test_patch_request_updates_forbidden_user(
+    mock_smfsc, minimal_request, worker_forbidden_env, client
+):
+    rv = client.patch(
+        f'/api/v1/builds/{minimal_request.id}/updates',
+        json=[{'arches': ['s390x']}],
+        environ_base=worker_forbidden_env,
+    )
+    assert rv.status_code == 403
+    assert 'This API endpoint is restricted to IIB workers' == rv.json['error']
+    mock_smfsc.assert_not_called()
+
+
+@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
+def test_remove_operator_success(mock_smfsc, db, auth_env, client):
     data = {
         'operators': ['some:thing'],
         'binary_image': 'binary:image',
@@ -1122,18 +1597,16 @@ def test_remove_operator_success(mock_smfsc, mock_rm, db, auth_env, client):
     rv_json['state_history'][0]['updated'] = '2020-02-12T17:03:00Z'
     rv_json['updated'] = '2020-02-12T17:03:00Z'
     rv_json['logs']['expiration'] = '2020-02-15T17:03:00Z'
-    mock_rm.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_rm_request'
     assert rv.status_code == 201
     assert response_json == rv_json
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
 @pytest.mark.parametrize('force_overwrite', (False, True))
-@mock.patch('iib.web.api_v1.handle_rm_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_remove_operator_forced_overwrite(
-    mock_smfsc, mock_hrr, force_overwrite, app, auth_env, client, db
-):
+def test_remove_operator_forced_overwrite(mock_smfsc, force_overwrite, app, auth_env, client, db):
     app.config['IIB_FORCE_OVERWRITE_FROM_INDEX'] = force_overwrite
     data = {
         'binary_image': 'binary:image',
@@ -1145,15 +1618,15 @@ def test_remove_operator_forced_overwrite(
 
     rv = client.post('/api/v1/builds/rm', json=data, environ_base=auth_env)
     assert rv.status_code == 201
-    mock_hrr.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_rm_request'
     # Third to last element in args is the overwrite_from_index parameter
-    assert mock_hrr.apply_async.call_args[1]['args'][-4] == force_overwrite
+    assert task.args[-4] == force_overwrite
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
-@mock.patch('iib.web.api_v1.handle_rm_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_remove_operator_overwrite_token_redacted(mock_smfsc, mock_hrr, app, auth_env, client, db):
+def test_remove_operator_overwrite_token_redacted(mock_smfsc, app, auth_env, client, db):
     token = 'username:password'
     data = {
         'binary_image': 'binary:image',
@@ -1166,14 +1639,15 @@ def test_remove_operator_overwrite_token_redacted(mock_smfsc, mock_hrr, app, aut
     rv = client.post('/api/v1/builds/rm', json=data, environ_base=auth_env)
     rv_json = rv.json
     assert rv.status_code == 201
-    mock_hrr.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_rm_request'
     # Third to last element in args is the overwrite_from_index parameter
-    assert mock_hrr.apply_async.call_args[1]['args'][-4] is True
-    assert mock_hrr.apply_async.call_args[1]['args'][-3] == token
+    assert task.args[-4] is True
+    assert task.args[-3] == token
     assert 'overwrite_from_index_token' not in rv_json
     assert token not in json.dumps(rv_json)
-    assert token not in mock_hrr.apply_async.call_args[1]['argsrepr']
-    assert '*****' in mock_hrr.apply_async.call_args[1]['argsrepr']
+    assert token not in task.argsrepr
+    assert '*****' in task.argsrepr
 
 
 @pytest.mark.parametrize(
@@ -1197,10 +1671,9 @@ def test_remove_operator_overwrite_token_redacted(mock_smfsc, mock_hrr, app, aut
         ({'not.tbrady@DOMAIN.LOCAL': 'Patriots'}, True, None),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_rm_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_remove_operator_custom_user_queue(
-    mock_smfsc, mock_hrr, app, auth_env, client, user_to_queue, overwrite_from_index, expected_queue
+    mock_smfsc, app, auth_env, client, db, user_to_queue, overwrite_from_index, expected_queue
 ):
     app.config['IIB_USER_TO_QUEUE'] = user_to_queue
     data = {
@@ -1214,10 +1687,9 @@ def test_remove_operator_custom_user_queue(
 
     rv = client.post('/api/v1/builds/rm', json=data, environ_base=auth_env)
     assert rv.status_code == 201, rv.json
-    mock_hrr.apply_async.assert_called_once()
-    mock_hrr.apply_async.assert_called_with(
-        args=mock.ANY, argsrepr=mock.ANY, link_error=mock.ANY, queue=expected_queue
-    )
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_rm_request'
+    assert task.queue == expected_queue
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
@@ -1227,9 +1699,8 @@ def test_not_found(client):
     assert rv.json == {'error': 'The requested resource was not found'}
 
 
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_regenerate_bundle_success(mock_smfsc, mock_hrbr, db, auth_env, client):
+def test_regenerate_bundle_success(mock_smfsc, db, auth_env, client):
     data = {'from_bundle_image': 'registry.example.com/bundle-image:latest'}
 
     # Assume a timestamp to simplify tests
@@ -1269,7 +1740,8 @@ def test_regenerate_bundle_success(mock_smfsc, mock_hrbr, db, auth_env, client):
     rv_json['updated'] = _timestamp
     rv_json['logs']['expiration'] = '2020-02-15T17:03:00Z'
     assert response_json == rv_json
-    mock_hrbr.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_regenerate_bundle_request'
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
@@ -1320,20 +1792,18 @@ def test_regenerate_bundle_missing_required_param(
         ({'not.tbrady@DOMAIN.LOCAL': 'Patriots'}, None),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_regenerate_bundle_custom_user_queue(
-    mock_smfsc, mock_hrbr, app, auth_env, client, user_to_queue, expected_queue
+    mock_smfsc, app, auth_env, client, db, user_to_queue, expected_queue
 ):
     app.config['IIB_USER_TO_QUEUE'] = user_to_queue
     data = {'from_bundle_image': 'registry.example.com/bundle-image:latest'}
 
     rv = client.post('/api/v1/builds/regenerate-bundle', json=data, environ_base=auth_env)
     assert rv.status_code == 201, rv.json
-    mock_hrbr.apply_async.assert_called_once()
-    mock_hrbr.apply_async.assert_called_with(
-        args=mock.ANY, link_error=mock.ANY, queue=expected_queue
-    )
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build.handle_regenerate_bundle_request'
+    assert task.queue == expected_queue
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
@@ -1345,10 +1815,9 @@ def test_regenerate_bundle_custom_user_queue(
         ({}, None, {'Han Solo': 'Don\'t everybody thank me at once.'}),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
 @mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
 def test_regenerate_bundle_batch_success(
-    mock_smfnbor, mock_hrbr, user_to_queue, expected_queue, annotations, app, auth_env, client, db
+    mock_smfnbor, user_to_queue, expected_queue, annotations, app, auth_env, client, db
 ):
     app.config['IIB_USER_TO_QUEUE'] = user_to_queue
 
@@ -1363,21 +1832,14 @@ def test_regenerate_bundle_batch_success(
     rv = client.post('/api/v1/builds/regenerate-bundle-batch', json=data, environ_base=auth_env)
 
     assert rv.status_code == 201, rv.json
-    assert mock_hrbr.apply_async.call_count == 2
-    mock_hrbr.apply_async.assert_has_calls(
-        (
-            mock.call(
-                args=['registry.example.com/bundle-image:latest', None, 1],
-                link_error=mock.ANY,
-                queue=expected_queue,
-            ),
-            mock.call(
-                args=['registry.example.com/bundle-image2:latest', None, 2],
-                link_error=mock.ANY,
-                queue=expected_queue,
-            ),
-        )
-    )
+    tasks = TaskOutbox.query.order_by(TaskOutbox.id).all()
+    assert len(tasks) == 2
+    for task in tasks:
+        assert task.task_name == 'iib.workers.tasks.build.handle_regenerate_bundle_request'
+        assert task.queue == expected_queue
+        assert task.argsrepr is None
+    assert tasks[0].args == ['registry.example.com/bundle-image:latest', None, 1]
+    assert tasks[1].args == ['registry.example.com/bundle-image2:latest', None, 2]
     assert len(rv.json) == 2
     assert all(r['batch_annotations'] == annotations for r in rv.json)
 
@@ -1387,8 +1849,7 @@ def test_regenerate_bundle_batch_success(
     assert requests_to_send_msgs_for[1].id == 2
 
 
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
-def test_regenerate_bundle_batch_invalid_request_type(mock_hrbr, app, auth_env, client, db):
+def test_regenerate_bundle_batch_invalid_request_type(app, auth_env, client, db):
     data = {
         'build_requests': [
             {'from_bundle_image': 'registry.example.com/bundle-image:latest'},
@@ -1408,7 +1869,7 @@ def test_regenerate_bundle_batch_invalid_request_type(mock_hrbr, app, auth_env,
             'in index 1.'
         )
     }
-    mock_hrbr.apply_async.assert_not_called()
+    assert TaskOutbox.query.count() == 0
 
 
 @pytest.mark.parametrize(
@@ -1439,10 +1900,8 @@ def test_regenerate_bundle_batch_invalid_input(payload, error_msg, app, auth_env
     assert rv.json == {'error': error_msg}
 
 
-@mock.patch('iib.web.api_v1.handle_add_request')
-@mock.patch('iib.web.api_v1.handle_rm_request')
 @mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
-def test_add_rm_batch_success(mock_smfnbor, mock_hrr, mock_har, app, auth_env, client, db):
+def test_add_rm_batch_success(mock_smfnbor, app, auth_env, client, db):
     annotations = {'msdhoni': 'The best captain ever!'}
     data = {
         'annotations': annotations,
@@ -1467,61 +1926,51 @@ def test_add_rm_batch_success(mock_smfnbor, mock_hrr, mock_har, app, auth_env, c
     rv = client.post('/api/v1/builds/add-rm-batch', json=data, environ_base=auth_env)
 
     assert rv.status_code == 201, rv.json
-    assert mock_hrr.apply_async.call_count == 1
-    assert mock_har.apply_async.call_count == 1
-    mock_har.apply_async.assert_has_calls(
-        (
-            mock.call(
-                args=[
-                    ['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'],
-                    1,
-                    'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                    'registry-proxy/rh-osbs-stage/iib:v4.5',
-                    ['amd64'],
-                    'no_tom_brady_anymore',
-                    'hello-operator',
-                    None,
-                    True,
-                    'some_token',
-                    None,
-                    None,
-                    {},
-                ],
-                argsrepr=(
-                    "[['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'], "
-                    "1, 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5', "
-                    "'registry-proxy/rh-osbs-stage/iib:v4.5', ['amd64'], '*****', "
-                    "'hello-operator', None, True, '*****', None, None, {}]"
-                ),
-                link_error=mock.ANY,
-                queue=None,
-            ),
-        )
+    tasks = TaskOutbox.query.order_by(TaskOutbox.id).all()
+    assert len(tasks) == 2
+    assert tasks[0].request_id == 1
+    assert tasks[0].task_name == 'iib.workers.tasks.build.handle_add_request'
+    assert tasks[0].args == [
+        ['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'],
+        1,
+        'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
+        'registry-proxy/rh-osbs-stage/iib:v4.5',
+        ['amd64'],
+        'no_tom_brady_anymore',
+        'hello-operator',
+        None,
+        True,
+        'some_token',
+        None,
+        None,
+        {},
+    ]
+    assert tasks[0].argsrepr == (
+        "[['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'], "
+        "1, 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5', "
+        "'registry-proxy/rh-osbs-stage/iib:v4.5', ['amd64'], '*****', "
+        "'hello-operator', None, True, '*****', None, None, {}]"
     )
-    mock_hrr.apply_async.assert_has_calls(
-        (
-            mock.call(
-                args=[
-                    ['kiali-ossm'],
-                    2,
-                    'registry:8443/iib-build:11',
-                    'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                    None,
-                    None,
-                    None,
-                    None,
-                    {},
-                ],
-                argsrepr=(
-                    "[['kiali-ossm'], 2, 'registry:8443/iib-build:11', "
-                    "'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5'"
-                    ", None, None, None, None, {}]"
-                ),
-                link_error=mock.ANY,
-                queue=None,
-            ),
-        )
+    assert tasks[0].queue is None
+    assert tasks[1].request_id == 2
+    assert tasks[1].task_name == 'iib.workers.tasks.build.handle_rm_request'
+    assert tasks[1].args == [
+        ['kiali-ossm'],
+        2,
+        'registry:8443/iib-build:11',
+        'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
+        None,
+        None,
+        None,
+        None,
+        {},
+    ]
+    assert tasks[1].argsrepr == (
+        "[['kiali-ossm'], 2, 'registry:8443/iib-build:11', "
+        "'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5'"
+        ", None, None, None, None, {}]"
     )
+    assert tasks[1].queue is None
 
     assert db.session.query(RequestAdd).filter_by(id=1).scalar()
     assert db.session.query(RequestRm).filter_by(id=2).scalar()
@@ -1534,8 +1983,151 @@ def test_add_rm_batch_success(mock_smfnbor, mock_hrr, mock_har, app, auth_env, c
     assert requests_to_send_msgs_for[1].id == 2
 
 
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
-def test_add_rm_batch_invalid_request_type(mock_hrbr, app, auth_env, client, db):
+def _get_add_rm_batch_statements(client, auth_env, capture_statements, batch_num, size):
+    """Submit a batch of add and rm requests and count the SQL statements per table."""
+    build_requests = []
+    for i in range(size):
+        build_requests.append(
+            {
+                'bundles': [f'quay.io/ns/bundle{batch_num}-{i}:v1', 'quay.io/ns/bundle:v1'],
+                'binary_image': 'quay.io/ns/binary-image:v1',
+                'from_index': f'quay.io/ns/index{batch_num}:v1',
+            }
+        )
+        build_requests.append(
+            {
+                'operators': [f'operator{batch_num}-{i}'],
+                'binary_image': 'quay.io/ns/binary-image:v1',
+                'from_index': f'quay.io/ns/index{batch_num}:v1',
+            }
+        )
+
+    with capture_statements() as statements:
+        rv = client.post(
+            '/api/v1/builds/add-rm-batch',
+            json={'build_requests': build_requests},
+            environ_base=auth_env,
+        )
+
+    assert rv.status_code == 201, rv.json
+    assert len(rv.json) == size * 2
+    return _count_statements(statements)
+
+
+@mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
+def test_add_rm_batch_bulk_statements(mock_smfnbor, app, auth_env, capture_statements, client, db):
+    # Create the user beforehand so that it's not created by one of the batches
+    User.get_or_create(auth_env['REMOTE_USER'])
+    db.session.commit()
+
+    small_batch = _get_add_rm_batch_statements(client, auth_env, capture_statements, 1, 5)
+    large_batch = _get_add_rm_batch_statements(client, auth_env, capture_statements, 2, 50)
+
+    # SQLite doesn't support reserving the primary keys, so these rows are inserted individually
+    for table in ('request', 'request_state', 'task_outbox'):
+        assert small_batch.pop((f'INSERT INTO {table}', False)) == 10
+        assert large_batch.pop((f'INSERT INTO {table}', False)) == 100
+    # The ID of the user is cached when the first batch is submitted, so it isn't queried again
+    user_select = ('SELECT user.id AS', False)
+    assert small_batch.pop(user_select) == large_batch.pop(user_select) + 1
+    # Everything else is queried and inserted in bulk regardless of the size of the batch
+    assert small_batch == large_batch
+    for table in ('image', 'operator'):
+        assert large_batch[(f'INSERT OR IGNORE INTO {table}', True)] == 1
+    for table in ('request_add_bundle', 'request_rm_operator'):
+        assert large_batch[(f'INSERT INTO {table}', True)] == 1
+
+    assert Image.query.count() == 1 + 1 + 2 + 55
+    request = db.session.query(RequestAdd).get(11)
+    assert {bundle.pull_specification for bundle in request.bundles} == {
+        'quay.io/ns/bundle2-0:v1',
+        'quay.io/ns/bundle:v1',
+    }
+    assert request.from_index.pull_specification == 'quay.io/ns/index2:v1'
+    assert request.state.state_name == 'in_progress'
+    request = db.session.query(RequestRm).get(12)
+    assert [operator.name for operator in request.operators] == ['operator2-0']
+    assert request.state.state_name == 'in_progress'
+
+
+@mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
+def test_add_rm_batch_reserved_primary_keys(
+    mock_smfnbor, app, auth_env, capture_statements, client, db
+):
+    build_requests = []
+    for i in range(3):
+        build_requests.append(
+            {
+                'bundles': [f'quay.io/ns/bundle{i}:v1'],
+                'binary_image': 'quay.io/ns/binary-image:v1',
+                'from_index': f'quay.io/ns/index{i}:v1',
+            }
+        )
+        build_requests.append(
+            {
+                'operators': [f'operator{i}'],
+                'binary_image': 'quay.io/ns/binary-image:v1',
+                'from_index': f'quay.io/ns/index{i}:v1',
+            }
+        )
+    # Create everything else beforehand so that only the primary keys use the PostgreSQL SQL
+    pull_specs = {'quay.io/ns/binary-image:v1'}
+    for i in range(3):
+        pull_specs.update({f'quay.io/ns/bundle{i}:v1', f'quay.io/ns/index{i}:v1'})
+    Image.get_or_create_many(pull_specs)
+    Operator.get_or_create_many({f'operator{i}' for i in range(3)})
+    User.get_or_create(auth_env['REMOTE_USER'])
+    db.session.commit()
+
+    # Simulate the sequences of the tables of a PostgreSQL database
+    sequences = collections.defaultdict(lambda: 100)
+    execute = db.session.execute
+
+    def _execute(statement, params=None, *args, **kwargs):
+        if 'nextval' not in str(statement):
+            return execute(statement, params, *args, **kwargs)
+        start = sequences[params['table']]
+        sequences[params['table']] += params['count']
+        # The values of the sequence aren't necessarily returned in order
+        return [(id_,) for id_ in reversed(range(start, start + params['count']))]
+
+    bind = mock.Mock()
+    bind.dialect.name = 'postgresql'
+    with capture_statements() as statements:
+        with mock.patch.object(db.session, 'get_bind', return_value=bind):
+            with mock.patch.object(db.session, 'execute', side_effect=_execute):
+                rv = client.post(
+                    '/api/v1/builds/add-rm-batch',
+                    json={'build_requests': build_requests},
+                    environ_base=auth_env,
+                )
+
+    assert rv.status_code == 201, rv.json
+    # The IDs of all the request types come from the sequence of the base table in order
+    assert [request['id'] for request in rv.json] == list(range(100, 106))
+    assert [request['request_type'] for request in rv.json] == ['add', 'rm'] * 3
+    for request_json, build_request in zip(rv.json, build_requests):
+        assert request_json['from_index'] == build_request['from_index']
+        assert request_json['state'] == 'in_progress'
+    # The rows are inserted in bulk with their reserved IDs
+    statements = _count_statements(statements)
+    for table in ('request', 'request_add', 'request_rm', 'request_state', 'task_outbox'):
+        assert statements[(f'INSERT INTO {table}', True)] == 1
+        assert statements[(f'INSERT INTO {table}', False)] == 0
+
+    db.session.expire_all()
+    for request_id in range(100, 106):
+        request = db.session.query(Request).get(request_id)
+        # The state set with post_update references the reserved ID of the state of the request
+        assert request.state.id == request_id
+        assert request.state.request_id == request_id
+        assert request.states == [request.state]
+    outbox = TaskOutbox.query.order_by(TaskOutbox.id).all()
+    assert [task.id for task in outbox] == list(range(100, 106))
+    assert [task.request_id for task in outbox] == list(range(100, 106))
+
+
+def test_add_rm_batch_invalid_request_type(app, auth_env, client, db):
     data = {
         'build_requests': [
             {'from_bundle_image': 'registry.example.com/bundle-image:latest'},
@@ -1555,7 +2147,7 @@ def test_add_rm_batch_invalid_request_type(mock_hrbr, app, auth_env, client, db)
             'in index 0.'
         )
     }
-    mock_hrbr.apply_async.assert_not_called()
+    assert TaskOutbox.query.count() == 0
 
 
 @pytest.mark.parametrize(
@@ -1590,9 +2182,8 @@ def test_regenerate_add_rm_batch_invalid_input(payload, error_msg, app, auth_env
     assert rv.json == {'error': error_msg}
 
 
-@mock.patch('iib.web.api_v1.handle_merge_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_merge_index_image_success(mock_smfsc, mock_merge, db, auth_env, client):
+def test_merge_index_image_success(mock_smfsc, db, auth_env, client):
     data = {
         'deprecation_list': ['some@sha256:bundle'],
         'binary_image': 'binary:image',
@@ -1636,17 +2227,15 @@ def test_merge_index_image_success(mock_smfsc, mock_merge, db, auth_env, client)
     rv_json['state_history'][0]['updated'] = '2020-02-12T17:03:00Z'
     rv_json['updated'] = '2020-02-12T17:03:00Z'
     rv_json['logs']['expiration'] = '2020-02-15T17:03:00Z'
-    mock_merge.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build_merge_index_image.handle_merge_request'
     assert rv.status_code == 201
     assert response_json == rv_json
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
-@mock.patch('iib.web.api_v1.handle_merge_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_merge_index_image_overwrite_token_redacted(
-    mock_smfsc, mock_merge, app, auth_env, client, db
-):
+def test_merge_index_image_overwrite_token_redacted(mock_smfsc, app, auth_env, client, db):
     token = 'username:password'
     data = {
         'deprecation_list': ['some@sha256:bundle'],
@@ -1660,14 +2249,15 @@ def test_merge_index_image_overwrite_token_redacted(
     rv = client.post('/api/v1/builds/merge-index-image', json=data, environ_base=auth_env)
     rv_json = rv.json
     assert rv.status_code == 201
-    mock_merge.apply_async.assert_called_once()
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build_merge_index_image.handle_merge_request'
     # Second to last element in args is the overwrite_from_index parameter
-    assert mock_merge.apply_async.call_args[1]['args'][5] is True
-    assert mock_merge.apply_async.call_args[1]['args'][6] == token
+    assert task.args[5] is True
+    assert task.args[6] == token
     assert 'overwrite_target_index_token' not in rv_json
     assert token not in json.dumps(rv_json)
-    assert token not in mock_merge.apply_async.call_args[1]['argsrepr']
-    assert '*****' in mock_merge.apply_async.call_args[1]['argsrepr']
+    assert token not in task.argsrepr
+    assert '*****' in task.argsrepr
 
 
 @pytest.mark.parametrize(
@@ -1691,17 +2281,9 @@ def test_merge_index_image_overwrite_token_redacted(
         ({'not.tbrady@DOMAIN.LOCAL': 'Patriots'}, True, None),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_merge_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_merge_index_image_custom_user_queue(
-    mock_smfsc,
-    mock_merge,
-    app,
-    auth_env,
-    client,
-    user_to_queue,
-    overwrite_from_index,
-    expected_queue,
+    mock_smfsc, app, auth_env, client, db, user_to_queue, overwrite_from_index, expected_queue
 ):
     app.config['IIB_USER_TO_QUEUE'] = user_to_queue
     data = {
@@ -1716,18 +2298,16 @@ def test_merge_index_image_custom_user_queue(
 
     rv = client.post('/api/v1/builds/merge-index-image', json=data, environ_base=auth_env)
     assert rv.status_code == 201, rv.json
-    mock_merge.apply_async.assert_called_once()
-    mock_merge.apply_async.assert_called_with(
-        args=mock.ANY, argsrepr=mock.ANY, link_error=mock.ANY, queue=expected_queue
-    )
+    task = TaskOutbox.query.one()
+    assert task.task_name == 'iib.workers.tasks.build_merge_index_image.handle_merge_request'
+    assert task.queue == expected_queue
     mock_smfsc.assert_called_once_with(mock.ANY, new_batch_msg=True)
 
 
 @pytest.mark.parametrize('overwrite_from_index', (True, False))
-@mock.patch('iib.web.api_v1.handle_merge_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_merge_index_image_fail_on_missing_overwrite_params(
-    mock_smfsc, mock_merge, app, auth_env, client, overwrite_from_index
+    mock_smfsc, app, auth_env, client, overwrite_from_index
 ):
     data = {
         'deprecation_list': ['some@sha256:bundle'],
@@ -1795,10 +2375,9 @@ def test_merge_index_image_fail_on_missing_overwrite_params(
         ),
     ),
 )
-@mock.patch('iib.web.api_v1.handle_merge_request')
 @mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
 def test_merge_index_image_fail_on_invalid_params(
-    mock_smfsc, mock_merge, app, auth_env, client, data, error_msg
+    mock_smfsc, app, auth_env, client, data, error_msg
 ):
     data = data
     rv = client.post('/api/v1/builds/merge-index-image', json=data, environ_base=auth_env)
@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+from unittest import mock
+
+import flask
+
+from iib.web.auth import _UserCache, load_user_from_request
+from iib.web.models import User
+
+
+def test_load_user_from_request_cached(app, auth_env, capture_statements, db):
+    with app.test_request_context(environ_base=auth_env):
+        user = load_user_from_request(flask.request)
+    assert user.id == 1
+    db.session.remove()
+
+    with capture_statements() as statements:
+        with app.test_request_context(environ_base=auth_env):
+            user = load_user_from_request(flask.request)
+            # The user is added to the session without querying it
+            assert user.id == 1
+            assert user.username == auth_env['REMOTE_USER']
+            assert user in db.session
+            # The user is the same object as the one loaded by other queries in the session
+            assert User.query.get(1) is user
+
+    assert statements == []
+    assert User.query.count() == 1
+
+
+def test_load_user_from_request_cache_disabled(app, auth_env, db):
+    app.config['IIB_USER_CACHE_MAX_SIZE'] = 0
+    for _ in range(2):
+        with app.test_request_context(environ_base=auth_env):
+            user = load_user_from_request(flask.request)
+        assert user.id == 1
+
+    assert not app.extensions['iib_user_cache'].get(auth_env['REMOTE_USER'])
+
+
+@mock.patch('iib.web.auth.time.monotonic')
+def test_user_cache_expires(mock_monotonic):
+    cache = _UserCache(max_size=10, ttl=300)
+    mock_monotonic.return_value = 1000
+    cache.set('tbrady@DOMAIN.LOCAL', 1)
+
+    mock_monotonic.return_value = 1299
+    assert cache.get('tbrady@DOMAIN.LOCAL') == 1
+    mock_monotonic.return_value = 1300
+    assert cache.get('tbrady@DOMAIN.LOCAL') is None
+
+
+def test_user_cache_evicts_least_recently_used():
+    cache = _UserCache(max_size=2, ttl=300)
+    cache.set('user1', 1)
+    cache.set('user2', 2)
+    # Using user1 makes user2 the least recently used user
+    assert cache.get('user1') == 1
+    cache.set('user3', 3)
+
+    assert cache.get('user1') == 1
+    assert cache.get('user2') is None
+    assert cache.get('user3') == 3
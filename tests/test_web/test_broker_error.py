@@ -1,199 +1,256 @@
+import collections
+import socket
+import sys
 from unittest import mock
 
 from kombu.exceptions import OperationalError
 
-from iib.web.models import Request, RequestStateMapping, RequestState, RequestAdd, RequestRm
+from iib.web.models import Request, RequestStateMapping, TaskOutbox
+from iib.web import outbox
+from iib.web.outbox import dispatch_tasks, run_task_dispatcher
 
 
-def assert_testing(rv, mock_smfsc, db):
-    response_json = {'error': 'The scheduling of the build request with ID 1 failed'}
-    assert rv.status_code == 500
-    assert response_json == rv.json
-    assert mock_smfsc.call_count == 2
+def _submit_add_rm_batch(client, auth_env):
+    data = {
+        'build_requests': [
+            {
+                'bundles': ['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'],
+                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
+                'from_index': 'registry-proxy/rh-osbs-stage/iib:v4.5',
+                'cnr_token': 'no_tom_brady_anymore',
+                'organization': 'hello-operator',
+            },
+            {
+                'operators': ['kiali-ossm'],
+                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
+                'from_index': 'registry:8443/iib-build:11',
+            },
+        ],
+    }
+    with mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests'):
+        rv = client.post('/api/v1/builds/add-rm-batch', json=data, environ_base=auth_env)
+    assert rv.status_code == 201, rv.json
+
+
+def _mock_broker(mock_celery_app, acks=None, nacks=None):
+    """
+    Mock the connection to the broker with publisher confirms.
+
+    :param list acks: the ``(delivery_tag, multiple)`` acknowledgements the broker sends; if
+        ``None``, the broker acknowledges all the published tasks at once
+    :param list nacks: the ``(delivery_tag, multiple)`` negative acknowledgements the broker sends
+    :return: the mocked connection and channel
+    """
+    connection = mock_celery_app.connection_or_acquire.return_value.__enter__.return_value
+    channel = connection.channel.return_value
+    channel.events = collections.defaultdict(set)
+
+    def _drain_events(timeout):
+        published = mock_celery_app.send_task.call_count
+        for callback in channel.events['basic_ack']:
+            for delivery_tag, multiple in acks if acks is not None else [(published, True)]:
+                callback(delivery_tag, multiple)
+        for callback in channel.events['basic_nack']:
+            for delivery_tag, multiple in nacks or []:
+                callback(delivery_tag, multiple)
+
+    connection.drain_events.side_effect = _drain_events
+    return connection, channel
+
+
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    connection, channel = _mock_broker(mock_celery_app)
+
+    assert dispatch_tasks(10) == 2
+
+    # All the tasks are published on a new channel and confirmed at once
+    connection.channel.assert_called_once_with()
+    channel.confirm_select.assert_called_once_with()
+    connection.drain_events.assert_called_once()
+    channel.close.assert_called_once_with()
+    mock_celery_app.amqp.Producer.assert_called_once_with(channel)
+    producer = mock_celery_app.amqp.Producer.return_value
+    assert mock_celery_app.send_task.call_count == 2
+    mock_celery_app.send_task.assert_has_calls(
+        (
+            mock.call(
+                'iib.workers.tasks.build.handle_add_request',
+                args=mock.ANY,
+                argsrepr=mock.ANY,
+                link_error=mock.ANY,
+                producer=producer,
+                queue=None,
+                retry=False,
+            ),
+            mock.call(
+                'iib.workers.tasks.build.handle_rm_request',
+                args=mock.ANY,
+                argsrepr=mock.ANY,
+                link_error=mock.ANY,
+                producer=producer,
+                queue=None,
+                retry=False,
+            ),
+        )
+    )
+    add_kwargs = mock_celery_app.send_task.call_args_list[0][1]
+    assert add_kwargs['args'][1] == 1
+    assert add_kwargs['args'][5] == 'no_tom_brady_anymore'
+    assert 'no_tom_brady_anymore' not in add_kwargs['argsrepr']
+    assert add_kwargs['link_error'].args == (1,)
+    assert TaskOutbox.query.count() == 0
+    for request_id in (1, 2):
+        request = db.session.query(Request).get(request_id)
+        assert request.state.state == RequestStateMapping.in_progress.value
 
-    req_state = db.session.query(Request).get(1)
-    assert req_state.state.state == RequestStateMapping.failed.value
 
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_limit(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    _mock_broker(mock_celery_app)
 
-@mock.patch('iib.web.api_v1.handle_add_request')
-@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_catch_add_bundle_failure(mock_smfsc, mock_har, db, auth_env, client):
-    mock_har.apply_async.side_effect = OperationalError
-    data = {
-        'bundles': ['some:thing'],
-        'binary_image': 'binary:image',
-        'add_arches': ['s390x'],
-        'organization': 'org',
-        'cnr_token': 'token',
-        'overwrite_from_index': True,
-    }
+    assert dispatch_tasks(1) == 1
 
-    rv = client.post('/api/v1/builds/add', json=data, environ_base=auth_env)
-    mock_har.apply_async.assert_called_once()
-    assert_testing(rv, mock_smfsc, db)
+    mock_celery_app.send_task.assert_called_once()
+    assert mock_celery_app.send_task.call_args[0][0] == 'iib.workers.tasks.build.handle_add_request'
+    assert TaskOutbox.query.one().request_id == 2
 
 
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
-@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_catch_regenerate_bundle_failure(mock_smfsc, mock_hrbr, db, auth_env, client):
-    mock_hrbr.apply_async.side_effect = OperationalError
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_empty_outbox(mock_celery_app, db):
+    assert dispatch_tasks(10) == 0
 
-    data = {
-        'from_bundle_image': 'registry.example.com/bundle-image:latest',
-    }
+    mock_celery_app.connection_or_acquire.assert_not_called()
 
-    rv = client.post('/api/v1/builds/regenerate-bundle', json=data, environ_base=auth_env)
-    mock_hrbr.apply_async.assert_called_once()
-    assert_testing(rv, mock_smfsc, db)
 
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_broker_unavailable(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    mock_celery_app.connection_or_acquire.side_effect = OperationalError
 
-@mock.patch('iib.web.api_v1.handle_rm_request')
-@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-def test_catch_remove_operator_failure(mock_smfsc, mock_rm, db, auth_env, client):
-    mock_rm.apply_async.side_effect = OperationalError
-    data = {
-        'operators': ['some:thing'],
-        'binary_image': 'binary:image',
-        'from_index': 'index:image',
-    }
+    assert dispatch_tasks(10) == 0
 
-    rv = client.post('/api/v1/builds/rm', json=data, environ_base=auth_env)
-    mock_rm.apply_async.assert_called_once()
-    assert_testing(rv, mock_smfsc, db)
+    # The tasks are kept in the outbox to be sent once the broker is available
+    assert [task.request_id for task in TaskOutbox.query.order_by(TaskOutbox.id)] == [1, 2]
+    for request_id in (1, 2):
+        request = db.session.query(Request).get(request_id)
+        assert request.state.state == RequestStateMapping.in_progress.value
 
 
-@mock.patch('iib.web.api_v1.handle_regenerate_bundle_request')
-@mock.patch('iib.web.api_v1.messaging.send_message_for_state_change')
-@mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
-def test_catch_regenerate_bundle_batch_failure(
-    mock_smfnbor, mock_smfsc, mock_hrbr, app, auth_env, client, db,
-):
-    mock_hrbr.apply_async.side_effect = OperationalError
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_broker_failure(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    connection, channel = _mock_broker(mock_celery_app)
+    mock_celery_app.send_task.side_effect = [None, OperationalError]
 
-    data = {
-        'build_requests': [
-            {'from_bundle_image': 'registry.example.com/bundle-image:latest'},
-            {'from_bundle_image': 'registry.example.com/bundle-image2:latest'},
-            {'from_bundle_image': 'registry.example.com/bundle-image3:latest'},
-        ]
-    }
-    rv = client.post('/api/v1/builds/regenerate-bundle-batch', json=data, environ_base=auth_env)
-
-    response_json = {'error': 'The scheduling of the build requests with IDs 1, 2, 3 failed'}
-    assert rv.status_code == 500
-    assert rv.json == response_json
-    assert mock_smfsc.call_count == 3
-    assert mock_hrbr.apply_async.call_count == 1
-
-    requests_to_send_msgs_for = mock_smfnbor.call_args[0][0]
-    assert len(requests_to_send_msgs_for) == 3
-    assert requests_to_send_msgs_for[0].id == 1
-    assert requests_to_send_msgs_for[1].id == 2
-
-    req_states = (
-        db.session.query(RequestState)
-        .join(Request, Request.request_state_id == RequestState.id)
-        .filter(Request.id.in_((1, 2, 3)))
-        .all()
-    )
-    assert len(req_states) == 3
-    for r in req_states:
-        assert r.state == RequestStateMapping.failed.value
+    assert dispatch_tasks(10) == 0
 
+    # The first task was published but not confirmed, so it's sent again later
+    assert mock_celery_app.send_task.call_count == 2
+    connection.drain_events.assert_not_called()
+    channel.close.assert_called_once_with()
+    assert [task.request_id for task in TaskOutbox.query.order_by(TaskOutbox.id)] == [1, 2]
 
-@mock.patch('iib.web.api_v1.handle_add_request')
-@mock.patch('iib.web.api_v1.handle_rm_request')
-@mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
-def test_add_rm_batch_add_failure(mock_smfnbor, mock_hrr, mock_har, app, auth_env, client, db):
-    mock_har.apply_async.side_effect = OperationalError
 
-    annotations = {'msdhoni': 'What? Who?'}
-    data = {
-        'annotations': annotations,
-        'build_requests': [
-            {
-                'bundles': ['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'],
-                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                'from_index': 'registry-proxy/rh-osbs-stage/iib:v4.5',
-                'add_arches': ['amd64'],
-                'cnr_token': 'no_tom_brady_anymore',
-                'organization': 'hello-operator',
-                'overwrite_from_index': True,
-                'overwrite_from_index_token': 'some_token',
-            },
-            {
-                'operators': ['kiali-ossm'],
-                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                'from_index': 'registry:8443/iib-build:11',
-            },
-        ],
-    }
-    rv = client.post('/api/v1/builds/add-rm-batch', json=data, environ_base=auth_env)
+def test_dispatch_tasks_publish_failure(app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    celery_app = outbox.celery_app
+    with mock.patch.object(celery_app, 'connection_or_acquire'), mock.patch.object(
+        celery_app.amqp, 'Producer'
+    ) as mock_producer:
+        connection, channel = _mock_broker(celery_app)
+        producer = mock_producer.return_value
+        producer.publish.side_effect = [None, OperationalError('Connection reset by peer')]
 
-    assert rv.status_code == 500, rv.json
-    assert mock_hrr.apply_async.call_count == 0
-    assert mock_har.apply_async.call_count == 1
+        assert dispatch_tasks(10) == 0
 
-    assert db.session.query(RequestAdd).get(1)
-    assert db.session.query(RequestRm).get(2)
+    # The task isn't published again by kombu on another channel without publisher confirms
+    assert producer.publish.call_count == 2
+    for publish_call in producer.publish.call_args_list:
+        assert publish_call[1]['retry'] is False
+    connection.drain_events.assert_not_called()
+    channel.close.assert_called_once_with()
+    assert [task.request_id for task in TaskOutbox.query.order_by(TaskOutbox.id)] == [1, 2]
 
-    response_json = {'error': 'The scheduling of the build requests with IDs 1, 2 failed'}
-    assert rv.json == response_json
 
-    requests_to_send_msgs_for = mock_smfnbor.call_args[0][0]
-    assert len(requests_to_send_msgs_for) == 2
-    assert requests_to_send_msgs_for[0].id == 1
-    assert requests_to_send_msgs_for[1].id == 2
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_nacked(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    _mock_broker(mock_celery_app, acks=[(2, False)], nacks=[(1, False)])
 
-    req_add = db.session.query(RequestAdd).get(1)
-    req_rm = db.session.query(RequestRm).get(2)
-    assert req_add.state.state == RequestStateMapping.failed.value
-    assert req_rm.state.state == RequestStateMapping.failed.value
+    assert dispatch_tasks(10) == 1
 
+    # Only the task the broker rejected is kept in the outbox
+    assert TaskOutbox.query.one().request_id == 1
+    request = db.session.query(Request).get(1)
+    assert request.state.state == RequestStateMapping.in_progress.value
 
-@mock.patch('iib.web.api_v1.handle_add_request')
-@mock.patch('iib.web.api_v1.handle_rm_request')
-@mock.patch('iib.web.api_v1.messaging.send_messages_for_new_batch_of_requests')
-def test_add_rm_batch_rm_failure(mock_smfnbor, mock_hrr, mock_har, app, auth_env, client, db):
-    mock_hrr.apply_async.side_effect = OperationalError
 
-    annotations = {'msdhoni': 'Who is that guy?'}
-    data = {
-        'annotations': annotations,
-        'build_requests': [
-            {
-                'bundles': ['registry-proxy/rh-osbs/lgallett-bundle:v1.0-9'],
-                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                'from_index': 'registry-proxy/rh-osbs-stage/iib:v4.5',
-                'add_arches': ['amd64'],
-                'cnr_token': 'no_tom_brady_anymore',
-                'organization': 'hello-operator',
-                'overwrite_from_index': True,
-                'overwrite_from_index_token': 'some_token',
-            },
-            {
-                'operators': ['kiali-ossm'],
-                'binary_image': 'registry-proxy/rh-osbs/openshift-ose-operator-registry:v4.5',
-                'from_index': 'registry:8443/iib-build:11',
-            },
-        ],
-    }
-    rv = client.post('/api/v1/builds/add-rm-batch', json=data, environ_base=auth_env)
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_confirm_timeout(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    connection, _ = _mock_broker(mock_celery_app)
+    connection.drain_events.side_effect = [None, socket.timeout]
+
+    assert dispatch_tasks(10) == 0
+
+    assert connection.drain_events.call_count == 2
+    assert connection.drain_events.call_args[1]['timeout'] <= 30
+    assert TaskOutbox.query.count() == 2
+
+
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_confirms_unsupported(mock_celery_app, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    connection = mock_celery_app.connection_or_acquire.return_value.__enter__.return_value
+    connection.channel.return_value = mock.Mock(spec_set=['close'])
+
+    assert dispatch_tasks(10) == 2
+
+    connection.drain_events.assert_not_called()
+    assert TaskOutbox.query.count() == 0
+
+
+@mock.patch('iib.web.outbox.messaging.send_message_for_state_change')
+@mock.patch('iib.web.outbox.celery_app')
+def test_dispatch_tasks_invalid_task(mock_celery_app, mock_smfsc, app, auth_env, client, db):
+    _submit_add_rm_batch(client, auth_env)
+    connection, _ = _mock_broker(mock_celery_app, acks=[(1, False)])
+    error = TypeError('Invalid arguments')
+    mock_celery_app.send_task.side_effect = [error, None]
+    logged_errors = []
+
+    with mock.patch.object(app.logger, 'exception') as mock_log_exception:
+        # The error is logged while it's handled so that its traceback is included
+        mock_log_exception.side_effect = lambda *args: logged_errors.append(sys.exc_info()[1])
+        assert dispatch_tasks(10) == 0
+
+    mock_log_exception.assert_called_once_with(
+        'The scheduling of the build request with ID %d failed', 1
+    )
+    assert logged_errors == [error]
+
+    # The tasks after the invalid task are sent on the next call
+    assert TaskOutbox.query.one().request_id == 2
+    request = db.session.query(Request).get(1)
+    assert request.state.state == RequestStateMapping.failed.value
+    assert request.state.state_reason == 'The scheduling of the request failed'
+    mock_smfsc.assert_called_once_with(request)
+
+    assert dispatch_tasks(10) == 1
+    assert TaskOutbox.query.count() == 0
 
-    assert rv.status_code == 500, rv.json
-    assert mock_hrr.apply_async.call_count == 1
-    assert mock_har.apply_async.call_count == 1
 
-    response_json = {'error': 'The scheduling of the build requests with IDs 2 failed'}
-    assert rv.json == response_json
+@mock.patch('iib.web.outbox.time.sleep')
+@mock.patch('iib.web.outbox.dispatch_tasks')
+def test_run_task_dispatcher_once(mock_dt, mock_sleep, app):
+    app.config['IIB_TASK_DISPATCH_BATCH_SIZE'] = 5
+    mock_dt.side_effect = [5, 5, 2]
 
-    requests_to_send_msgs_for = mock_smfnbor.call_args[0][0]
-    assert len(requests_to_send_msgs_for) == 2
-    assert requests_to_send_msgs_for[0].id == 1
-    assert requests_to_send_msgs_for[1].id == 2
+    run_task_dispatcher(once=True)
 
-    req_add = db.session.query(RequestAdd).get(1)
-    req_rm = db.session.query(RequestRm).get(2)
-    # First request is processed because we are testing failing on RequestRM
-    assert req_add.state.state == RequestStateMapping.in_progress.value
-    assert req_rm.state.state == RequestStateMapping.failed.value
+    assert mock_dt.call_count == 3
+    mock_dt.assert_called_with(5)
+    mock_sleep.assert_not_called()
@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import json
+import threading
 from unittest import mock
 
 import proton
@@ -192,12 +193,18 @@ def test_send_messages(mock_gsd, mock_bc, app):
     envelopes = [
         messaging.Envelope('topic://VirtualTopic.eng.star_wars', msg_one),
         messaging.Envelope('topic://VirtualTopic.eng.star_wars2', msg_one),
-        messaging.Envelope('topic://VirtualTopic.eng.star_wars', msg_two),
     ]
     messaging.send_messages(envelopes)
+    messaging.send_messages([messaging.Envelope('topic://VirtualTopic.eng.star_wars', msg_two)])
+    # Wait for the messages to be sent by the background thread
+    app.extensions['iib_message_sender'].stop()
 
+    # Verify that the connection is reused between the state changes
     mock_bc.assert_called_once_with(
-        urls=['amqps://message-broker:5671'], timeout=30, ssl_domain=mock_gsd.return_value
+        urls=['amqps://message-broker:5671'],
+        timeout=30,
+        ssl_domain=mock_gsd.return_value,
+        heartbeat=60,
     )
     # Verify that even though three messages were sent, only two senders were created since only
     # two unique addresses were used
@@ -227,6 +234,96 @@ def test_send_messages_nonfatal(mock_gsd, mock_bc, app):
     messaging.send_messages(
         [messaging.Envelope('topic://VirtualTopic.eng.star_wars', '{"han": "solo"}')]
     )
+    app.extensions['iib_message_sender'].stop()
+
+    # The connection is retried once
+    assert mock_bc.call_count == 2
+
+
+@mock.patch('iib.web.messaging.BlockingConnection')
+@mock.patch('iib.web.messaging._get_ssl_domain')
+def test_send_messages_reconnect(mock_gsd, mock_bc, app):
+    mock_failed_connection = mock.Mock()
+    mock_failed_connection.create_sender.return_value.send.side_effect = [
+        None,
+        proton.ConnectionException('Connection disconnected'),
+    ]
+    mock_connection = mock.Mock()
+    mock_bc.side_effect = [mock_failed_connection, mock_connection]
+
+    msg_one = proton.Message('{"han": "solo"}')
+    msg_two = proton.Message('{"star": "wars"}')
+    messaging.send_messages(
+        [
+            messaging.Envelope('topic://VirtualTopic.eng.star_wars', msg_one),
+            messaging.Envelope('topic://VirtualTopic.eng.star_wars', msg_two),
+        ]
+    )
+    app.extensions['iib_message_sender'].stop()
+
+    assert mock_bc.call_count == 2
+    mock_failed_connection.close.assert_called_once_with()
+    # Only the message that failed is sent again
+    mock_connection.create_sender.return_value.send.assert_called_once_with(msg_two, timeout=30)
+
+
+@mock.patch('iib.web.messaging.BlockingConnection')
+@mock.patch('iib.web.messaging._get_ssl_domain')
+def test_send_messages_queue_full(mock_gsd, mock_bc, app):
+    app.config['IIB_MESSAGING_QUEUE_SIZE'] = 1
+    connecting = threading.Event()
+    connected = threading.Event()
+
+    def _connect(*args, **kwargs):
+        connecting.set()
+        connected.wait()
+        return mock.Mock()
+
+    mock_bc.side_effect = _connect
+    envelopes = [messaging.Envelope('topic://VirtualTopic.eng.star_wars', '{"han": "solo"}')]
+
+    messaging.send_messages(envelopes)
+    sender = app.extensions['iib_message_sender']
+    # Wait for the first messages to be taken from the queue by the background thread
+    connecting.wait()
+    assert sender.enqueue(envelopes) is True
+    # The messages are discarded instead of waiting for the broker
+    assert sender.enqueue(envelopes) is False
+
+    connected.set()
+    sender.stop()
+    assert not sender.thread.is_alive()
+
+
+def test_send_messages_idle(app):
+    sender = messaging._MessageSender(app)
+    mock_connection = mock.Mock(disconnected=False)
+    sender.connection = mock_connection
+    sender.address_to_sender = {'topic://VirtualTopic.eng.star_wars': mock.Mock()}
+
+    sender._process_events()
+
+    mock_connection.container.do_work.assert_called_once_with(0.1)
+    assert sender.connection is mock_connection
+
+    # The connection is discarded once the broker closes it
+    mock_connection.disconnected = 'amqp:resource-limit-exceeded'
+    sender._process_events()
+
+    assert sender.connection is None
+    assert sender.address_to_sender == {}
+    mock_connection.close.assert_called_once_with()
+    sender.stop()
+
+
+def test_send_messages_missing_config(app):
+    app.config['IIB_MESSAGING_URLS'] = []
+
+    messaging.send_messages(
+        [messaging.Envelope('topic://VirtualTopic.eng.star_wars', '{"han": "solo"}')]
+    )
+
+    assert 'iib_message_sender' not in app.extensions
 
 
 @pytest.mark.parametrize('request_msg_expected', (True, False))
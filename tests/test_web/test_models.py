@@ -1,7 +1,12 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 from datetime import timedelta
+import os
+import time
+from unittest import mock
 
 import pytest
+import sqlalchemy
+from sqlalchemy.orm import joinedload, with_polymorphic
 
 from iib.exceptions import ValidationError
 from iib.web import models
@@ -122,3 +127,320 @@ def test_batch_request_states(db):
     db.session.commit()
 
     assert request.batch.request_states == ['in_progress', 'failed', 'complete']
+
+
+def test_batch_request_state_counts(db):
+    binary_image = models.Image(pull_specification='quay.io/add/binary-image:latest')
+    db.session.add(binary_image)
+    batch = models.Batch()
+    db.session.add(batch)
+    for state in ('in_progress', 'complete', 'complete'):
+        request = models.RequestAdd(batch=batch, binary_image=binary_image)
+        request.add_state(state, 'Some state')
+        db.session.add(request)
+    # Requests in other batches are not counted
+    request = models.RequestAdd(batch=models.Batch(), binary_image=binary_image)
+    request.add_state('failed', 'Some state')
+    db.session.add(request)
+
+    db.session.commit()
+
+    assert batch.request_state_counts == {'complete': 2, 'in_progress': 1}
+
+
+def test_image_get_or_create_many(db):
+    existing = models.Image.get_or_create('quay.io/ns/existing:v1')
+    db.session.commit()
+
+    rv = models.Image.get_or_create_many(['quay.io/ns/existing:v1', 'quay.io/ns/new@sha256:123'])
+
+    assert rv.keys() == {'quay.io/ns/existing:v1', 'quay.io/ns/new@sha256:123'}
+    assert rv['quay.io/ns/existing:v1'] is existing
+    assert rv['quay.io/ns/new@sha256:123'].id is not None
+    assert models.Image.query.count() == 2
+
+
+def test_image_get_or_create_many_invalid(db):
+    with pytest.raises(ValidationError, match='Image quay.io/ns/image should have a tag'):
+        models.Image.get_or_create_many(['quay.io/ns/image:v1', 'quay.io/ns/image'])
+
+
+def test_operator_get_or_create_many(db):
+    existing = models.Operator.get_or_create('existing-operator')
+    db.session.commit()
+
+    rv = models.Operator.get_or_create_many(['existing-operator', 'new-operator', 'new-operator'])
+
+    assert rv.keys() == {'existing-operator', 'new-operator'}
+    assert rv['existing-operator'] is existing
+    assert rv['new-operator'].id is not None
+    assert models.Operator.query.count() == 2
+
+
+def test_operator_get_or_create_many_concurrent_insert(app, db):
+    execute = db.session.execute
+
+    def _execute(statement, *args, **kwargs):
+        # Simulate another transaction inserting one of the operators before this one
+        if isinstance(statement, sqlalchemy.sql.expression.Insert):
+            execute(models.Operator.__table__.insert(), {'name': 'operator2'})
+        return execute(statement, *args, **kwargs)
+
+    with mock.patch.object(db.session, 'execute', side_effect=_execute):
+        rv = models.Operator.get_or_create_many({'operator1', 'operator2'})
+
+    assert rv.keys() == {'operator1', 'operator2'}
+    assert models.Operator.query.count() == 2
+
+
+@mock.patch('iib.web.models.db.session')
+def test_operator_get_or_create_many_postgresql(mock_session, app):
+    mock_session.get_bind.return_value.dialect.name = 'postgresql'
+    table = models.Operator.__table__
+    # The operator inserted concurrently by another transaction isn't returned
+    mock_session.execute.return_value = [{table.c.id: 3, table.c.name: 'operator1'}]
+
+    with mock.patch.object(models.Operator, 'query') as mock_query:
+        mock_query.filter.return_value = []
+        rv = models.Operator.get_or_create_many({'operator1', 'operator2'})
+
+    statement = mock_session.execute.call_args[0][0]
+    assert str(statement.compile(dialect=sqlalchemy.dialects.postgresql.dialect())) == (
+        'INSERT INTO operator (name) VALUES (%(name_m0)s), (%(name_m1)s) '
+        'ON CONFLICT (name) DO NOTHING RETURNING operator.id, operator.name'
+    )
+    assert rv.keys() == {'operator1'}
+    assert rv['operator1'].id == 3
+    assert sqlalchemy.inspect(rv['operator1']).detached
+    mock_session.add.assert_called_once_with(rv['operator1'])
+    # The operators which weren't returned are queried after the insert
+    assert mock_query.filter.call_count == 2
+
+
+def test_get_or_create_list(db):
+    existing = models.Image(pull_specification='quay.io/ns/existing:v1')
+
+    rv = models._get_or_create_list(
+        models.Image,
+        ['quay.io/ns/image:v2', 'quay.io/ns/existing:v1', 'quay.io/ns/image:v1'],
+        {'quay.io/ns/existing:v1': existing},
+    )
+
+    assert [image.pull_specification for image in rv] == [
+        'quay.io/ns/image:v2',
+        'quay.io/ns/existing:v1',
+        'quay.io/ns/image:v1',
+    ]
+    assert rv[1] is existing
+    assert models.Image.query.count() == 2
+
+
+def test_batch_get_or_create_images_and_operators(db):
+    build_requests = [
+        {
+            'binary_image': 'quay.io/ns/binary-image:v1',
+            'bundles': ['quay.io/ns/bundle:v1', 'quay.io/ns/bundle:v1', 'invalid', 3],
+            'from_index': 'quay.io/ns/index:v1',
+        },
+        {'operators': ['operator', ''], 'from_index': ['not', 'a', 'string']},
+        {'from_bundle_image': 'quay.io/ns/bundle:v2'},
+        'not a build request',
+    ]
+
+    images, operators = models.Batch.get_or_create_images_and_operators(build_requests)
+
+    # The invalid values are skipped so that they're reported when the build request is validated
+    assert images.keys() == {
+        'quay.io/ns/binary-image:v1',
+        'quay.io/ns/bundle:v1',
+        'quay.io/ns/bundle:v2',
+        'quay.io/ns/index:v1',
+    }
+    assert operators.keys() == {'operator'}
+
+
+def test_reserve_primary_keys_unsupported_database(db):
+    request = models.RequestRegenerateBundle()
+    request.add_state('in_progress', 'Starting up')
+
+    models.reserve_primary_keys([request, request.state])
+
+    assert request.id is None
+    assert request.state.id is None
+
+
+@mock.patch('iib.web.models.db.session')
+def test_reserve_primary_keys(mock_session):
+    mock_session.get_bind.return_value.dialect.name = 'postgresql'
+    mock_session.execute.side_effect = [[(8,), (7,)], [(3,)]]
+    requests = [models.RequestAdd(), models.RequestRm()]
+    existing_request = models.RequestRm(id=1)
+    operator = models.Operator(name='operator')
+
+    models.reserve_primary_keys(requests + [existing_request, operator])
+
+    assert [request.id for request in requests] == [7, 8]
+    assert existing_request.id == 1
+    assert operator.id == 3
+    # The sequence of the base table is used for all the request types
+    assert mock_session.execute.call_count == 2
+    assert mock_session.execute.call_args_list[0][0][1] == {
+        'table': 'request',
+        'column': 'id',
+        'count': 2,
+    }
+    assert mock_session.execute.call_args_list[1][0][1] == {
+        'table': 'operator',
+        'column': 'id',
+        'count': 1,
+    }
+
+
+@mock.patch('iib.web.models.db.session')
+def test_reserve_primary_keys_no_sequence(mock_session):
+    mock_session.get_bind.return_value.dialect.name = 'postgresql'
+    mock_session.execute.return_value = [(None,)]
+    operator = models.Operator(name='operator')
+
+    models.reserve_primary_keys([operator])
+
+    assert operator.id is None
+
+
+def _create_requests_of_each_type(db, total):
+    """Create requests of each type with their relationships set."""
+    operator = models.Operator(name='operator')
+    db.session.add(operator)
+    for i in range(total):
+        batch = models.Batch()
+        db.session.add(batch)
+        binary_image = models.Image.get_or_create(f'quay.io/namespace/binary-image:{i}')
+        from_index = models.Image.get_or_create(f'quay.io/namespace/index-image:{i}')
+        if i % 4 == 0:
+            bundle = models.Image.get_or_create(f'quay.io/namespace/bundle:{i}')
+            bundle.operator = operator
+            request = models.RequestAdd(
+                batch=batch, binary_image=binary_image, from_index=from_index, bundles=[bundle]
+            )
+        elif i % 4 == 1:
+            request = models.RequestRm(
+                batch=batch, binary_image=binary_image, from_index=from_index, operators=[operator]
+            )
+        elif i % 4 == 2:
+            request = models.RequestRegenerateBundle(batch=batch, from_bundle_image=from_index)
+        else:
+            request = models.RequestMergeIndexImage(
+                batch=batch,
+                binary_image=binary_image,
+                deprecation_list=[models.Image.get_or_create(f'quay.io/namespace/bundle:{i}')],
+                source_from_index=from_index,
+                target_index=models.Image.get_or_create(f'quay.io/namespace/target:{i}'),
+            )
+        request.add_architecture('amd64')
+        request.add_state('in_progress', 'Starting up')
+        request.add_state('complete', 'Completed successfully')
+        db.session.add(request)
+    db.session.commit()
+    # Empty the identity map so that the requests are loaded from the database
+    db.session.expunge_all()
+
+
+def _count_requests_json_statements(db, capture_statements, query, per_page, verbose):
+    """
+    Query a page of requests, convert them to JSON and count the SQL statements executed.
+
+    :return: the number of SQL statements executed
+    :rtype: int
+    """
+    try:
+        with capture_statements() as statements:
+            requests = query.order_by(models.Request.id.desc()).limit(per_page).all()
+            items = [request.to_json(verbose=verbose) for request in requests]
+    finally:
+        db.session.expunge_all()
+
+    assert len(items) == per_page
+    return len(statements)
+
+
+def _get_request_queries(verbose):
+    """
+    Get the queries of the requests with the joined options and with the selectin options.
+
+    :return: the queries keyed by the name of their options
+    :rtype: dict
+    """
+    # These are the options that joined every request type table and image relationship
+    joined_request = with_polymorphic(models.Request, '*')
+    joined_options = [
+        joinedload(models.Request.user),
+        joinedload(models.RequestAdd.binary_image),
+        joinedload(models.RequestAdd.binary_image_resolved),
+        joinedload(models.RequestAdd.bundles),
+        joinedload(models.RequestAdd.from_index),
+        joinedload(models.RequestAdd.from_index_resolved),
+        joinedload(models.RequestAdd.index_image),
+        joinedload(models.RequestRegenerateBundle.bundle_image),
+        joinedload(models.RequestRegenerateBundle.from_bundle_image),
+        joinedload(models.RequestRegenerateBundle.from_bundle_image_resolved),
+        joinedload(models.RequestRm.binary_image),
+        joinedload(models.RequestRm.binary_image_resolved),
+        joinedload(models.RequestRm.from_index),
+        joinedload(models.RequestRm.from_index_resolved),
+        joinedload(models.RequestRm.index_image),
+        joinedload(models.RequestRm.operators),
+        joinedload(models.Request.states if verbose else models.Request.state),
+    ]
+    return {
+        'joined': joined_request.query.options(*joined_options),
+        'selectin': models.Request.query.options(
+            *models.get_request_query_options(verbose=verbose)
+        ),
+    }
+
+
+@pytest.mark.parametrize('verbose', (False, True))
+def test_get_request_query_options_statements(app, capture_statements, db, verbose):
+    _create_requests_of_each_type(db, 100)
+
+    results = {}
+    # The verbose JSON contains the URL of the logs, which requires a request context
+    with app.test_request_context('/api/v1/builds'):
+        for per_page in (20, 100):
+            results[per_page] = {
+                name: _count_requests_json_statements(
+                    db, capture_statements, query, per_page, verbose
+                )
+                for name, query in _get_request_queries(verbose).items()
+            }
+
+    # The number of queries doesn't depend on the number of requests on the page
+    assert results[20]['selectin'] == results[100]['selectin'] == 20
+    # The joined options still lazy load the relationships which aren't joined for each request
+    assert results[20]['joined'] < results[100]['joined']
+    for per_page in (20, 100):
+        assert results[per_page]['selectin'] < results[per_page]['joined']
+
+
+# The latency depends on the machine and SQLite doesn't have the network round trips of
+# PostgreSQL, so the latency is only measured on demand and reported instead of asserted
+@pytest.mark.skipif(not os.getenv('IIB_BENCHMARK'), reason='IIB_BENCHMARK is not set')
+@pytest.mark.parametrize('verbose', (False, True))
+def test_get_request_query_options_latency(app, capsys, capture_statements, db, verbose):
+    _create_requests_of_each_type(db, 100)
+
+    with app.test_request_context('/api/v1/builds'):
+        for per_page in (20, 100):
+            for name, query in _get_request_queries(verbose).items():
+                durations = []
+                for _ in range(5):
+                    start = time.perf_counter()
+                    _count_requests_json_statements(
+                        db, capture_statements, query, per_page, verbose
+                    )
+                    durations.append(time.perf_counter() - start)
+                with capsys.disabled():
+                    print(
+                        f'\nConverting {per_page} requests to JSON (verbose={verbose}) with the '
+                        f'{name} options took {min(durations) * 1000:.1f} ms'
+                    )
@@ -1,4 +1,5 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import threading
 from unittest import mock
 
 import requests
@@ -34,6 +35,34 @@ def test_get_request_not_ok(mock_session):
         api_utils.get_request(3)
 
 
+@mock.patch('iib.workers.api_utils.get_requests_session')
+def test_thread_local_session(mock_get_requests_session):
+    mock_get_requests_session.side_effect = lambda auth: mock.Mock(auth=auth)
+    session = api_utils.ThreadLocalSession(auth=True)
+    sessions = []
+
+    def _use_session():
+        sessions.append(session.session)
+        session.post('https://greenwave.domain.local/api/v1.0/decision')
+
+    threads = [threading.Thread(target=_use_session) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    _use_session()
+
+    # Every thread uses its own session and reuses it between calls
+    assert len({id(thread_session) for thread_session in sessions}) == 3
+    assert session.session is sessions[-1]
+    assert mock_get_requests_session.call_count == 3
+    for thread_session in sessions:
+        assert thread_session.auth is True
+        thread_session.post.assert_called_once_with(
+            'https://greenwave.domain.local/api/v1.0/decision'
+        )
+
+
 @mock.patch('iib.workers.api_utils.update_request')
 def test_set_request_state(mock_update_request):
     state = 'failed'
@@ -91,3 +120,139 @@ def test_update_request_not_ok(mock_session, exc_msg, expected):
 
     with pytest.raises(IIBError, match=expected):
         api_utils.update_request(3, {'index_image': 'index-image:latest'}, exc_msg=exc_msg)
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+def test_buffer_request_updates(mock_session):
+    with api_utils.buffer_request_updates(3):
+        api_utils.set_request_state(3, 'in_progress', 'Resolving the bundles')
+        api_utils.update_request(3, {'binary_image': 'binary-image:latest'})
+        api_utils.set_request_state(3, 'in_progress', 'Building the index image')
+        api_utils.update_request(3, {'arches': ['amd64']})
+        # The updates of other requests are not buffered
+        api_utils.update_request(4, {'arches': ['amd64']})
+        assert mock_session.patch.call_count == 1
+
+        api_utils.set_request_state(3, 'complete', 'The request completed successfully')
+        # The terminal state is sent right away
+        assert mock_session.patch.call_count == 2
+
+    mock_session.patch.assert_called_with(
+        'http://iib-api:8080/api/v1/builds/3/updates',
+        json=[
+            {
+                'binary_image': 'binary-image:latest',
+                'state': 'in_progress',
+                'state_reason': 'Resolving the bundles',
+            },
+            {
+                'arches': ['amd64'],
+                'state': 'in_progress',
+                'state_reason': 'Building the index image',
+            },
+            {'state': 'complete', 'state_reason': 'The request completed successfully'},
+        ],
+        timeout=30,
+    )
+    assert not api_utils._buffers
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+def test_buffer_request_updates_flush_on_error(mock_session):
+    with pytest.raises(IIBError, match='Something went wrong'):
+        with api_utils.buffer_request_updates(3):
+            api_utils.update_request(3, {'arches': ['amd64']})
+            mock_session.patch.assert_not_called()
+            raise IIBError('Something went wrong')
+
+    # The single buffered update is sent using the regular API endpoint
+    mock_session.patch.assert_called_once_with(
+        'http://iib-api:8080/api/v1/builds/3', json={'arches': ['amd64']}, timeout=30
+    )
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+@mock.patch('iib.workers.config.get_worker_config')
+def test_buffer_request_updates_flush_on_timer(mock_gwc, mock_session):
+    mock_gwc.return_value = mock.Mock(
+        iib_api_timeout=30,
+        iib_api_update_flush_interval=0.01,
+        iib_api_url='http://iib-api:8080/api/v1/',
+    )
+    flushed = threading.Event()
+
+    def _patch(*args, **kwargs):
+        flushed.set()
+        return mock.Mock(ok=True)
+
+    mock_session.patch.side_effect = _patch
+
+    with api_utils.buffer_request_updates(3):
+        api_utils.update_request(3, {'arches': ['amd64']})
+        assert flushed.wait(5)
+
+    mock_session.patch.assert_called_once()
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+@mock.patch('iib.workers.config.get_worker_config')
+def test_buffer_request_updates_flush_on_timer_failed(mock_gwc, mock_session):
+    mock_gwc.return_value = mock.Mock(
+        iib_api_timeout=30,
+        iib_api_update_flush_interval=0.01,
+        iib_api_url='http://iib-api:8080/api/v1/',
+    )
+    flushed = threading.Event()
+
+    def _patch(*args, **kwargs):
+        flushed.set()
+        return mock.Mock(ok=False, status_code=500, text='Internal Server Error')
+
+    mock_session.patch.side_effect = _patch
+
+    with api_utils.buffer_request_updates(3):
+        # The exception message can't be formatted with the payload
+        api_utils.update_request(3, {'arches': ['amd64']}, exc_msg='Failed to set {index_image}')
+        assert flushed.wait(5)
+        # The error of the timer thread is raised by the next flush
+        with pytest.raises(KeyError):
+            api_utils.flush_request_updates(3)
+
+        # The update that failed to be sent is kept and sent again
+        mock_session.patch.side_effect = None
+        mock_session.patch.return_value.ok = True
+        api_utils.flush_request_updates(3)
+        assert mock_session.patch.call_count == 2
+        mock_session.patch.assert_called_with(
+            'http://iib-api:8080/api/v1/builds/3', json={'arches': ['amd64']}, timeout=30
+        )
+
+    assert mock_session.patch.call_count == 2
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+@mock.patch('iib.workers.config.get_worker_config')
+def test_buffer_request_updates_disabled(mock_gwc, mock_session):
+    mock_gwc.return_value = mock.Mock(
+        iib_api_timeout=30,
+        iib_api_update_flush_interval=0,
+        iib_api_url='http://iib-api:8080/api/v1/',
+    )
+
+    with api_utils.buffer_request_updates(3):
+        api_utils.update_request(3, {'arches': ['amd64']})
+        mock_session.patch.assert_called_once()
+
+
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+def test_buffer_request_updates_not_ok(mock_session):
+    mock_session.patch.return_value.ok = False
+
+    with pytest.raises(IIBError, match='Setting the index image to index:image failed'):
+        with api_utils.buffer_request_updates(3):
+            api_utils.set_request_state(3, 'in_progress', 'Building the index image')
+            api_utils.update_request(
+                3,
+                {'index_image': 'index:image', 'state': 'complete', 'state_reason': 'Done'},
+                exc_msg='Setting the index image to {index_image} failed',
+            )
@@ -150,12 +150,17 @@ def test_validate_celery_config_invalid_organization_customizations(config, erro
 @pytest.mark.parametrize(
     'file_type, access, error',
     (
-        ('file', True, 'iib_request_logs_dir, {logs_dir}, must exist and be a directory'),
-        (None, True, 'iib_request_logs_dir, {logs_dir}, must exist and be a directory'),
-        ('dir', False, 'iib_request_logs_dir, {logs_dir}, is not writable!'),
+        ('file', True, '{directory_key}, {logs_dir}, must exist and be a directory'),
+        (None, True, '{directory_key}, {logs_dir}, must exist and be a directory'),
+        ('dir', False, '{directory_key}, {logs_dir}, is not writable!'),
     ),
 )
-def test_validate_celery_config_request_logs_dir_misconfigured(tmpdir, file_type, access, error):
+@pytest.mark.parametrize(
+    'directory_key', ('iib_index_db_cache_dir', 'iib_request_logs_dir', 'iib_skopeo_cache_dir')
+)
+def test_validate_celery_config_directory_misconfigured(
+    tmpdir, file_type, access, error, directory_key
+):
     iib_request_logs_dir = tmpdir.join('logs')
 
     if file_type == 'file':
@@ -176,10 +181,61 @@ def test_validate_celery_config_request_logs_dir_misconfigured(tmpdir, file_type
     conf = {
         'iib_api_url': 'http://localhost:8080/api/v1/',
         'iib_organization_customizations': {},
-        'iib_request_logs_dir': iib_request_logs_dir,
+        directory_key: iib_request_logs_dir,
         'iib_registry': 'registry',
         'iib_required_labels': {},
     }
-    error = error.format(logs_dir=iib_request_logs_dir)
+    error = error.format(directory_key=directory_key, logs_dir=iib_request_logs_dir)
     with pytest.raises(ConfigError, match=error):
         validate_celery_config(conf)
+
+
+@pytest.mark.parametrize(
+    'key',
+    (
+        'iib_api_update_flush_interval',
+        'iib_greenwave_decision_cache_ttl',
+        'iib_greenwave_timeout',
+        'iib_image_storage_max_size',
+        'iib_index_db_cache_max_size',
+        'iib_index_registry_pool_size',
+        'iib_omps_timeout',
+        'iib_registry_client_timeout',
+        'iib_skopeo_cache_max_entries',
+        'iib_skopeo_cache_max_files',
+        'iib_skopeo_cache_tag_ttl',
+    ),
+)
+@pytest.mark.parametrize('value', (-1, '30', None))
+def test_validate_celery_config_non_negative_integer_invalid(key, value):
+    conf = {
+        'iib_api_url': 'http://localhost:8080/api/v1/',
+        'iib_organization_customizations': {},
+        'iib_registry': 'registry',
+        'iib_required_labels': {},
+        key: value,
+    }
+    with pytest.raises(ConfigError, match=f'{key} must be a non-negative integer'):
+        validate_celery_config(conf)
+
+
+@pytest.mark.parametrize(
+    'key',
+    (
+        'iib_build_concurrency',
+        'iib_greenwave_concurrency',
+        'iib_legacy_export_concurrency',
+        'iib_resolve_concurrency',
+    ),
+)
+@pytest.mark.parametrize('value', (0, '5', None))
+def test_validate_celery_config_positive_integer_invalid(key, value):
+    conf = {
+        'iib_api_url': 'http://localhost:8080/api/v1/',
+        'iib_organization_customizations': {},
+        'iib_registry': 'registry',
+        'iib_required_labels': {},
+        key: value,
+    }
+    with pytest.raises(ConfigError, match=f'{key} must be a positive integer'):
+        validate_celery_config(conf)
@@ -3,13 +3,20 @@ import json
 from unittest import mock
 
 import pytest
+import requests
 
 from iib.exceptions import IIBError
 from iib.workers import greenwave
 
 
+@pytest.fixture(autouse=True)
+def decision_cache():
+    with mock.patch.object(greenwave, '_decision_cache', new_callable=dict) as decision_cache:
+        yield decision_cache
+
+
 @mock.patch('iib.workers.greenwave._get_koji_build_nvr')
-@mock.patch('iib.workers.greenwave.requests.post')
+@mock.patch('iib.workers.greenwave.requests_session.post')
 def test_gate_bundles_success(mock_requests, mock_gkbn):
     mock_gkbn.return_value = 'n-v-r'
     mock_requests.return_value.ok = True
@@ -21,7 +28,7 @@ def test_gate_bundles_success(mock_requests, mock_gkbn):
         'product_version': 'cvp',
     }
     greenwave.gate_bundles(['some-bundle'], greenwave_config)
-    mock_gkbn.assert_called_once_with('some-bundle')
+    mock_gkbn.assert_called_once_with('some-bundle', None)
     mock_requests.assert_called_once()
 
 
@@ -60,17 +67,16 @@ def test_gate_bundles_success(mock_requests, mock_gkbn):
                 ],
             },
             (
-                'Unsatisfied Greenwave policy for some-bundle '
+                r'Unsatisfied Greenwave policy for some-bundle \(test cases: '
+                r'test-case-operator-metadata-fetch, test-case-operator-metadata-preparation\) '
                 'with decision_context: iib_cvp_redhat_operator, '
-                'product_version: cvp, subject_type: koji_build '
-                'and test cases: test-case-operator-metadata-fetch, '
-                'test-case-operator-metadata-preparation'
+                'product_version: cvp and subject_type: koji_build'
             ),
         ),
     ),
 )
 @mock.patch('iib.workers.greenwave._get_koji_build_nvr')
-@mock.patch('iib.workers.greenwave.requests.post')
+@mock.patch('iib.workers.greenwave.requests_session.post')
 def test_gate_bundles_failure(
     mock_requests, mock_gkbn, greenwave_request_success, greenwave_json_rv, error_msg
 ):
@@ -85,12 +91,12 @@ def test_gate_bundles_failure(
     }
     with pytest.raises(IIBError, match=error_msg):
         greenwave.gate_bundles(['some-bundle'], greenwave_config)
-    mock_gkbn.assert_called_once_with('some-bundle')
+    mock_gkbn.assert_called_once_with('some-bundle', None)
     mock_requests.assert_called_once()
 
 
 @mock.patch('iib.workers.greenwave._get_koji_build_nvr')
-@mock.patch('iib.workers.greenwave.requests.post')
+@mock.patch('iib.workers.greenwave.requests_session.post')
 def test_gate_bundles_invalid_json(mock_requests, mock_gkbn):
     mock_gkbn.return_value = 'n-v-r'
     mock_requests.return_value.ok = True
@@ -104,9 +110,85 @@ def test_gate_bundles_invalid_json(mock_requests, mock_gkbn):
     error_msg = 'Key "policies_satisfied" missing in Greenwave response for some-bundle'
     with pytest.raises(IIBError, match=error_msg):
         greenwave.gate_bundles(['some-bundle'], greenwave_config)
-    mock_gkbn.assert_called_once_with('some-bundle')
+    mock_gkbn.assert_called_once_with('some-bundle', None)
+    mock_requests.assert_called_once()
+
+
+@mock.patch('iib.workers.greenwave._get_koji_build_nvr')
+@mock.patch('iib.workers.greenwave.requests_session.post')
+def test_gate_bundles_multiple_unsatisfied(mock_requests, mock_gkbn):
+    mock_gkbn.side_effect = lambda bundle, image_metadata: f'{bundle}-1-1'
+
+    def _post(url, json, timeout):
+        rv = mock.Mock(ok=True)
+        if json['subject_identifier'] == 'bundle2-1-1':
+            rv.json.return_value = {'policies_satisfied': True}
+        else:
+            rv.json.return_value = {
+                'policies_satisfied': False,
+                'unsatisfied_requirements': [{'testcase': f'{json["subject_identifier"]}-test'}],
+            }
+        return rv
+
+    mock_requests.side_effect = _post
+
+    greenwave_config = {
+        'subject_type': 'koji_build',
+        'decision_context': 'iib_cvp_redhat_operator',
+        'product_version': 'cvp',
+    }
+    # Each unsatisfied bundle is reported with its own test cases
+    error_msg = (
+        r'Unsatisfied Greenwave policy for bundle1 \(test cases: bundle1-1-1-test\), '
+        r'bundle3 \(test cases: bundle3-1-1-test\) with'
+    )
+    with pytest.raises(IIBError, match=error_msg):
+        greenwave.gate_bundles(['bundle1', 'bundle2', 'bundle3'], greenwave_config)
+    assert mock_requests.call_count == 3
+
+
+@mock.patch('iib.workers.greenwave._get_koji_build_nvr')
+@mock.patch('iib.workers.greenwave.requests_session.post')
+def test_gate_bundles_cached_decision(mock_requests, mock_gkbn, decision_cache):
+    mock_gkbn.return_value = 'n-v-r'
+    mock_requests.return_value.ok = True
+    mock_requests.return_value.json.return_value = {'policies_satisfied': True}
+
+    greenwave_config = {
+        'subject_type': 'koji_build',
+        'decision_context': 'iib_cvp_redhat_operator',
+        'product_version': 'cvp',
+    }
+    greenwave.gate_bundles(['some-bundle'], greenwave_config)
+    greenwave.gate_bundles(['some-bundle'], greenwave_config)
     mock_requests.assert_called_once()
 
+    # A different decision context is not cached
+    greenwave.gate_bundles(['some-bundle'], {**greenwave_config, 'decision_context': 'other'})
+    assert mock_requests.call_count == 2
+
+    # The decision is requested again once it expires
+    for key, (_, data) in decision_cache.items():
+        decision_cache[key] = (0, data)
+    greenwave.gate_bundles(['some-bundle'], greenwave_config)
+    assert mock_requests.call_count == 3
+
+
+@mock.patch('iib.workers.greenwave._get_koji_build_nvr')
+@mock.patch('iib.workers.greenwave.requests_session.post')
+def test_gate_bundles_connection_failed(mock_requests, mock_gkbn):
+    mock_gkbn.return_value = 'n-v-r'
+    mock_requests.side_effect = requests.ConnectionError()
+
+    greenwave_config = {
+        'subject_type': 'koji_build',
+        'decision_context': 'iib_cvp_redhat_operator',
+        'product_version': 'cvp',
+    }
+    error_msg = 'Gating check failed for some-bundle: the connection to Greenwave failed'
+    with pytest.raises(IIBError, match=error_msg):
+        greenwave.gate_bundles(['some-bundle'], greenwave_config)
+
 
 @mock.patch('iib.workers.greenwave.get_image_labels')
 def test_get_koji_build_nvr(mock_gil):
@@ -0,0 +1,426 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import base64
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import os
+import tarfile
+import threading
+from unittest import mock
+
+import pytest
+
+from iib.exceptions import IIBError
+from iib.workers import registry
+
+
+CONFIG = json.dumps({'architecture': 'amd64', 'config': {'Labels': {'version': 'v4.5'}}})
+CONFIG_DIGEST = 'sha256:config'
+MANIFEST = json.dumps(
+    {
+        'schemaVersion': 2,
+        'mediaType': registry.MEDIA_TYPE_MANIFEST_V2,
+        'config': {'digest': CONFIG_DIGEST},
+        'layers': [],
+    },
+    indent=3,
+)
+MANIFEST_DIGEST = 'sha256:manifest'
+MANIFEST_LIST = json.dumps(
+    {
+        'schemaVersion': 2,
+        'mediaType': registry.MEDIA_TYPE_MANIFEST_LIST_V2,
+        'manifests': [
+            {'digest': 'sha256:s390x', 'platform': {'architecture': 's390x', 'os': 'linux'}},
+            {'digest': MANIFEST_DIGEST, 'platform': {'architecture': 'amd64', 'os': 'linux'}},
+        ],
+    }
+)
+
+
+class StubRegistry(object):
+    """A stub container registry which requires bearer token authentication."""
+
+    def __init__(self):
+        """Start the stub registry on a random port in a background thread."""
+        self.requests = []
+        self.token_requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), self._get_handler())
+        self.host = f'127.0.0.1:{self.server.server_port}'
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the stub registry."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self._handle(include_body=False)
+
+            def do_GET(self):
+                self._handle(include_body=True)
+
+            def _send(self, status, body=b'', headers=None, include_body=True):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if include_body:
+                    self.wfile.write(body)
+
+            def _handle(self, include_body):
+                if self.path.startswith('/token'):
+                    stub.token_requests.append((self.path, self.headers.get('Authorization')))
+                    body = json.dumps({'token': 'secret', 'expires_in': 300}).encode('utf-8')
+                    self._send(200, body)
+                    return
+
+                stub.requests.append((self.command, self.path))
+                if self.headers.get('Authorization') != 'Bearer secret':
+                    challenge = (
+                        f'Bearer realm="http://{stub.host}/token",service="stub",'
+                        'scope="repository:ns/repo:pull"'
+                    )
+                    self._send(401, headers={'WWW-Authenticate': challenge})
+                    return
+
+                routes = {
+                    '/v2/ns/repo/manifests/latest': (
+                        MANIFEST_LIST,
+                        registry.MEDIA_TYPE_MANIFEST_LIST_V2,
+                        'sha256:list',
+                    ),
+                    '/v2/ns/repo/manifests/v1': (
+                        MANIFEST,
+                        registry.MEDIA_TYPE_MANIFEST_V2,
+                        MANIFEST_DIGEST,
+                    ),
+                    f'/v2/ns/repo/manifests/{MANIFEST_DIGEST}': (
+                        MANIFEST,
+                        registry.MEDIA_TYPE_MANIFEST_V2,
+                        MANIFEST_DIGEST,
+                    ),
+                    f'/v2/ns/repo/blobs/{CONFIG_DIGEST}': (
+                        CONFIG,
+                        'application/octet-stream',
+                        CONFIG_DIGEST,
+                    ),
+                }
+                if self.path not in routes:
+                    self._send(404, b'{"errors": [{"code": "MANIFEST_UNKNOWN"}]}')
+                    return
+
+                body, media_type, digest = routes[self.path]
+                headers = {'Content-Type': media_type, 'Docker-Content-Digest': digest}
+                self._send(200, body.encode('utf-8'), headers, include_body)
+
+        return Handler
+
+
+@pytest.fixture()
+def stub_registry():
+    stub = StubRegistry()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture()
+def docker_config(tmpdir):
+    tmpdir.mkdir('.docker')
+    with mock.patch('os.path.expanduser', return_value=str(tmpdir)):
+        yield tmpdir.join('.docker', 'config.json')
+
+
+def test_get_manifest(stub_registry, docker_config):
+    client = registry.RegistryClient(scheme='http')
+
+    assert client.get_manifest(f'{stub_registry.host}/ns/repo:v1') == MANIFEST
+    assert client.get_manifest(f'{stub_registry.host}/ns/repo:latest') == MANIFEST_LIST
+
+    # The token is only requested once and is reused for the second manifest
+    assert len(stub_registry.token_requests) == 1
+    token_path, token_auth = stub_registry.token_requests[0]
+    assert token_path == '/token?scope=repository%3Ans%2Frepo%3Apull&service=stub'
+    assert token_auth is None
+    assert stub_registry.requests == [
+        ('GET', '/v2/ns/repo/manifests/v1'),
+        ('GET', '/v2/ns/repo/manifests/v1'),
+        ('GET', '/v2/ns/repo/manifests/latest'),
+    ]
+
+
+def test_get_manifest_credentials(stub_registry, docker_config):
+    auth = base64.b64encode(b'user:pass').decode('utf-8')
+    docker_config.write(json.dumps({'auths': {stub_registry.host: {'auth': auth}}}))
+    client = registry.RegistryClient(scheme='http')
+
+    client.get_manifest(f'{stub_registry.host}/ns/repo:v1')
+
+    assert stub_registry.token_requests[0][1] == f'Basic {auth}'
+
+    # Changing the credentials, like set_registry_token does, results in a new token
+    auth_two = base64.b64encode(b'user:pass2').decode('utf-8')
+    docker_config.write(json.dumps({'auths': {stub_registry.host: {'auth': auth_two}}}))
+    client.get_manifest(f'{stub_registry.host}/ns/repo:v1')
+
+    assert len(stub_registry.token_requests) == 2
+    assert stub_registry.token_requests[1][1] == f'Basic {auth_two}'
+
+
+def test_get_manifest_digest(stub_registry, docker_config):
+    client = registry.RegistryClient(scheme='http')
+
+    assert client.get_manifest_digest(f'{stub_registry.host}/ns/repo:v1') == MANIFEST_DIGEST
+    assert stub_registry.requests[-1] == ('HEAD', '/v2/ns/repo/manifests/v1')
+
+
+@pytest.mark.parametrize('tag', ('latest', 'v1'))
+def test_get_config(stub_registry, docker_config, tag):
+    client = registry.RegistryClient(scheme='http')
+
+    assert client.get_config(f'{stub_registry.host}/ns/repo:{tag}') == CONFIG
+
+
+def test_get_config_missing_arch(stub_registry, docker_config):
+    client = registry.RegistryClient(scheme='http')
+
+    expected = f'The manifest list {stub_registry.host}/ns/repo:latest does not contain a ppc64le'
+    with pytest.raises(IIBError, match=expected):
+        client.get_config(f'{stub_registry.host}/ns/repo:latest', arch='ppc64le')
+
+
+def _create_layer(files):
+    """
+    Create a gzipped layer blob.
+
+    :param dict files: the paths in the layer mapped to their content; a value of ``None`` is a
+        directory, a value starting with ``->`` is a symlink and a value starting with ``=>`` is a
+        hard link
+    :return: the file-like object of the layer
+    :rtype: io.BytesIO
+    """
+    layer = io.BytesIO()
+    with tarfile.open(fileobj=layer, mode='w:gz') as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(path)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tar.addfile(info)
+            elif content.startswith('->'):
+                info.type = tarfile.SYMTYPE
+                info.linkname = content[2:]
+                tar.addfile(info)
+            elif content.startswith('=>'):
+                info.type = tarfile.LNKTYPE
+                info.linkname = content[2:]
+                info.mode = 0o644
+                tar.addfile(info)
+            else:
+                data = content.encode('utf-8')
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+    layer.seek(0)
+    return layer
+
+
+def _read_tree(path):
+    tree = {}
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            relative_path = os.path.relpath(file_path, path)
+            if os.path.islink(file_path):
+                tree[relative_path] = f'->{os.readlink(file_path)}'
+            else:
+                with open(file_path) as f:
+                    tree[relative_path] = f.read()
+    return tree
+
+
+@pytest.mark.parametrize('dest_exists', (True, False))
+@mock.patch.object(registry.RegistryClient, 'get_blob')
+@mock.patch.object(registry.RegistryClient, '_get_image_manifest')
+def test_copy_files(mock_gim, mock_gb, dest_exists, tmpdir):
+    # The layers are listed from the base layer to the top layer
+    layers = {
+        'sha256:base': _create_layer(
+            {
+                'manifests': None,
+                'manifests/csv.yaml': 'base csv',
+                'manifests/crd.yaml': 'base crd',
+                'manifests/removed.yaml': 'removed',
+                'manifests/old/file.yaml': 'old',
+                'metadata/annotations.yaml': 'annotations',
+                'etc/passwd': 'root',
+            }
+        ),
+        'sha256:middle': _create_layer(
+            {
+                './manifests/.wh.removed.yaml': '',
+                './manifests/old/.wh..wh..opq': '',
+                './manifests/old/new.yaml': 'new',
+                './manifests/link.yaml': '->csv.yaml',
+                './manifests/hard.yaml': '=>manifests/old/new.yaml',
+            }
+        ),
+        'sha256:top': _create_layer({'/manifests/csv.yaml': 'top csv'}),
+    }
+    mock_gim.return_value = {
+        'schemaVersion': 2,
+        'layers': [{'digest': digest} for digest in layers],
+    }
+    mock_gb.side_effect = lambda pull_spec, digest, stream: mock.Mock(raw=layers[digest])
+    if dest_exists:
+        dest_path = str(tmpdir)
+        manifests_path = os.path.join(dest_path, 'manifests')
+    else:
+        dest_path = manifests_path = str(tmpdir.join('manifests'))
+
+    client = registry.RegistryClient()
+    client.copy_files('quay.io/ns/repo:v1', '/manifests', dest_path)
+
+    assert _read_tree(manifests_path) == {
+        'csv.yaml': 'top csv',
+        'crd.yaml': 'base crd',
+        'link.yaml': '->csv.yaml',
+        'hard.yaml': 'new',
+        'old/new.yaml': 'new',
+    }
+    # The top layer is read first
+    assert [c[0][1] for c in mock_gb.call_args_list] == [
+        'sha256:top',
+        'sha256:middle',
+        'sha256:base',
+    ]
+
+
+@pytest.mark.parametrize(
+    'top_files, expected',
+    (
+        ({'database/index.db': 'top db'}, 'top db'),
+        ({'database/.wh..wh..opq': ''}, None),
+        ({'.wh.database': ''}, None),
+    ),
+)
+@mock.patch.object(registry.RegistryClient, 'get_blob')
+@mock.patch.object(registry.RegistryClient, '_get_image_manifest')
+def test_copy_files_stops_at_file(mock_gim, mock_gb, top_files, expected, tmpdir):
+    layers = {
+        'sha256:base': _create_layer({'database/index.db': 'base db'}),
+        'sha256:top': _create_layer(top_files),
+    }
+    mock_gim.return_value = {
+        'schemaVersion': 2,
+        'layers': [{'digest': digest} for digest in layers],
+    }
+    mock_gb.side_effect = lambda pull_spec, digest, stream: mock.Mock(raw=layers[digest])
+    dest_path = str(tmpdir.join('index.db'))
+
+    client = registry.RegistryClient()
+    if expected is None:
+        with pytest.raises(IIBError, match='The path /database/index.db does not exist'):
+            client.copy_files('quay.io/ns/repo:v1', '/database/index.db', dest_path)
+    else:
+        client.copy_files('quay.io/ns/repo:v1', '/database/index.db', dest_path)
+        with open(dest_path) as f:
+            assert f.read() == expected
+
+    # The base layer isn't downloaded since the top layer provides or hides the file
+    mock_gb.assert_called_once()
+    assert mock_gb.call_args[0][1] == 'sha256:top'
+
+
+@mock.patch.object(registry.RegistryClient, 'get_blob')
+@mock.patch.object(registry.RegistryClient, '_get_image_manifest')
+def test_copy_files_hard_link_not_copied(mock_gim, mock_gb, tmpdir):
+    mock_gim.return_value = {'schemaVersion': 2, 'layers': [{'digest': 'sha256:base'}]}
+    mock_gb.return_value = mock.Mock(
+        raw=_create_layer({'data.db': 'db', 'database/index.db': '=>data.db'})
+    )
+
+    client = registry.RegistryClient()
+    expected = 'The hard link /database/index.db can\'t be copied since its target /data.db'
+    with pytest.raises(IIBError, match=expected):
+        client.copy_files('quay.io/ns/repo:v1', '/database/index.db', str(tmpdir))
+
+
+@mock.patch.object(registry.RegistryClient, 'get_blob')
+@mock.patch.object(registry.RegistryClient, '_get_image_manifest')
+def test_copy_files_not_found(mock_gim, mock_gb, tmpdir):
+    mock_gim.return_value = {'schemaVersion': 2, 'layers': [{'digest': 'sha256:base'}]}
+    mock_gb.return_value = mock.Mock(raw=_create_layer({'etc/passwd': 'root'}))
+
+    client = registry.RegistryClient()
+    expected = 'The path /manifests does not exist in quay.io/ns/repo:v1'
+    with pytest.raises(IIBError, match=expected):
+        client.copy_files('quay.io/ns/repo:v1', '/manifests', str(tmpdir.join('manifests')))
+
+
+@mock.patch.object(registry.RegistryClient, 'get_blob')
+@mock.patch.object(registry.RegistryClient, '_get_image_manifest')
+def test_copy_files_invalid_layer(mock_gim, mock_gb, tmpdir):
+    mock_gim.return_value = {'schemaVersion': 2, 'layers': [{'digest': 'sha256:base'}]}
+    mock_gb.return_value = mock.Mock(raw=io.BytesIO(b'not a tar archive'))
+
+    client = registry.RegistryClient()
+    expected = 'Failed to extract the layer sha256:base of quay.io/ns/repo:v1'
+    with pytest.raises(IIBError, match=expected):
+        client.copy_files('quay.io/ns/repo:v1', '/manifests', str(tmpdir.join('manifests')))
+
+
+def test_get_manifest_not_found(stub_registry, docker_config):
+    client = registry.RegistryClient(scheme='http')
+    pull_spec = f'{stub_registry.host}/ns/repo:missing'
+
+    with pytest.raises(IIBError, match=f'Failed to inspect docker://{pull_spec}'):
+        client.get_manifest(pull_spec)
+
+
+@pytest.mark.parametrize(
+    'registry_name, auths, expected',
+    (
+        ('quay.io', {'quay.io': {'auth': 'dXNlcjpwYXNz'}}, 'dXNlcjpwYXNz'),
+        ('quay.io', {'https://quay.io': {'username': 'user', 'password': 'pass'}}, 'dXNlcjpwYXNz'),
+        ('docker.io', {'https://index.docker.io/v1/': {'auth': 'dXNlcjpwYXNz'}}, 'dXNlcjpwYXNz'),
+        ('quay.io', {'registry.redhat.io': {'auth': 'dXNlcjpwYXNz'}}, None),
+    ),
+)
+def test_get_credentials(docker_config, registry_name, auths, expected):
+    docker_config.write(json.dumps({'auths': auths}))
+
+    assert registry._get_credentials(registry_name) == expected
+
+
+def test_get_credentials_no_config(docker_config):
+    assert registry._get_credentials('quay.io') is None
+
+
+@pytest.mark.parametrize(
+    'pull_spec, expected_host, expected_repository',
+    (
+        ('quay.io/ns/repo:latest', 'quay.io', 'ns/repo'),
+        ('docker.io/busybox:latest', 'registry-1.docker.io', 'library/busybox'),
+        ('busybox', 'registry-1.docker.io', 'library/busybox'),
+        ('localhost:5000/ns/sub/repo@sha256:123', 'localhost:5000', 'ns/sub/repo'),
+    ),
+)
+def test_get_registry_host_and_repository(pull_spec, expected_host, expected_repository):
+    image = registry.ImageName.parse(pull_spec)
+
+    assert registry._get_registry_host(image) == expected_host
+    assert registry._get_repository(image) == expected_repository
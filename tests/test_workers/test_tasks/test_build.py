@@ -1,8 +1,11 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 import copy
+import json
 import os
 import re
+import sqlite3
 import textwrap
+import time
 from unittest import mock
 
 from operator_manifest.operator import OperatorManifest
@@ -11,6 +14,7 @@ import ruamel.yaml
 
 from iib.exceptions import IIBError
 from iib.workers.tasks import build
+from iib.workers.tasks.utils import ImageMetadata
 
 
 yaml = ruamel.yaml.YAML()
@@ -26,14 +30,50 @@ def test_build_image(mock_run_cmd):
     assert '/some/dir/some.Dockerfile' in build_args
 
 
-@mock.patch('iib.workers.tasks.build.run_cmd')
+@pytest.mark.parametrize('concurrency', (1, 4))
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build._push_image')
+@mock.patch('iib.workers.tasks.build._build_image')
+def test_build_and_push_images(mock_bi, mock_pi, mock_gwc, concurrency):
+    mock_gwc.return_value = {'iib_build_concurrency': concurrency}
+
+    build._build_and_push_images('/some/dir', 'index.Dockerfile', 3, {'s390x', 'amd64', 'ppc64le'})
+
+    assert mock_bi.call_count == 3
+    assert mock_pi.call_count == 3
+    for arch in ('amd64', 'ppc64le', 's390x'):
+        mock_bi.assert_any_call('/some/dir', 'index.Dockerfile', 3, arch)
+        mock_pi.assert_any_call(3, arch)
+    if concurrency == 1:
+        assert [c[0][3] for c in mock_bi.call_args_list] == ['amd64', 'ppc64le', 's390x']
+
+
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build._push_image')
+@mock.patch('iib.workers.tasks.build._build_image')
+def test_build_and_push_images_failure(mock_bi, mock_pi, mock_gwc):
+    mock_gwc.return_value = {'iib_build_concurrency': 2}
+
+    def _build_image(dockerfile_dir, dockerfile_name, request_id, arch):
+        if arch == 'amd64':
+            raise IIBError('Failed to build the container image on the arch amd64')
+        time.sleep(0.05)
+
+    mock_bi.side_effect = _build_image
+
+    with pytest.raises(IIBError, match='Failed to build the container image on the arch amd64'):
+        build._build_and_push_images('/some/dir', 'Dockerfile', 3, {'amd64', 'ppc64le', 's390x'})
+
+    # The other arches are not pushed since the request failed while they were building
+    mock_pi.assert_not_called()
+
+
+@mock.patch('iib.workers.tasks.build.cleanup_images')
 @mock.patch('iib.workers.tasks.build.reset_docker_config')
-def test_cleanup(mock_rdc, mock_run_cmd):
+def test_cleanup(mock_rdc, mock_ci):
     build._cleanup()
 
-    mock_run_cmd.assert_called_once()
-    rmi_args = mock_run_cmd.call_args[0][0]
-    assert rmi_args[0:2] == ['podman', 'rmi']
+    mock_ci.assert_called_once_with()
     mock_rdc.assert_called_once_with()
 
 
@@ -175,6 +215,27 @@ def test_get_image_arches_not_manifest_list(mock_si):
         build._get_image_arches('image:latest')
 
 
+@mock.patch('iib.workers.tasks.utils.skopeo_inspect')
+def test_get_image_metadata_shared(mock_si):
+    raw_manifest = json.dumps(
+        {'mediaType': 'application/vnd.docker.distribution.manifest.v2+json', 'schemaVersion': 2}
+    )
+    config = {'architecture': 'amd64', 'config': {'Labels': {'some_label': 'value'}}}
+    mock_si.side_effect = [raw_manifest, config]
+    image_metadata = ImageMetadata()
+
+    resolved = build._get_resolved_image('quay.io/ns/image:8', image_metadata=image_metadata)
+    assert build._get_image_arches(resolved, image_metadata) == {'amd64'}
+    assert build.get_image_label(resolved, 'some_label', image_metadata) == 'value'
+    assert build.get_image_label('quay.io/ns/image:8', 'some_label', image_metadata) == 'value'
+
+    # The raw manifest and the config are each fetched once
+    assert mock_si.call_args_list == [
+        mock.call('docker://quay.io/ns/image:8', '--raw', return_json=False),
+        mock.call(f'docker://{resolved}', '--config'),
+    ]
+
+
 @pytest.mark.parametrize('label, expected', (('some_label', 'value'), ('not_there', None)))
 @mock.patch('iib.workers.tasks.utils.skopeo_inspect')
 def test_get_image_label(mock_si, label, expected):
@@ -276,7 +337,7 @@ def test_get_resolved_image_manifest_list(mock_si):
         '204f6700'
     )
     mock_si.assert_called_once_with(
-        'docker://docker.io/library/centos:8', '--raw', return_json=False
+        'docker://docker.io/library/centos:8', '--raw', return_json=False, use_cache=True
     )
 
 
@@ -326,13 +387,33 @@ def test_get_resolved_image_schema_1(mock_si):
     mock_si.assert_has_calls(
         [
             mock.call(
-                'docker://registry.example.com/repository/name:1.0.0', '--raw', return_json=False
+                'docker://registry.example.com/repository/name:1.0.0',
+                '--raw',
+                return_json=False,
+                use_cache=True,
             ),
             mock.call('docker://registry.example.com/repository/name:1.0.0'),
         ]
     )
 
 
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build.get_registry_client')
+@mock.patch('iib.workers.tasks.build.skopeo_inspect')
+def test_get_resolved_image_schema_1_registry_client(mock_si, mock_grc, mock_gwc):
+    mock_gwc.return_value = mock.Mock(iib_use_registry_client=True)
+    mock_si.return_value = '{"schemaVersion": 1}'
+    mock_grc.return_value.get_manifest_digest.return_value = 'sha256:123456'
+
+    rv = build._get_resolved_image('registry.example.com/repository/name:1.0.0')
+
+    assert rv == 'registry.example.com/repository/name@sha256:123456'
+    mock_si.assert_called_once()
+    mock_grc.return_value.get_manifest_digest.assert_called_once_with(
+        'registry.example.com/repository/name:1.0.0'
+    )
+
+
 @pytest.mark.parametrize(
     'skopeo_inspect_rv, expected_response',
     (
@@ -381,6 +462,46 @@ def test_get_resolved_bundles_failure(mock_si):
         build._get_resolved_bundles(['some_bundle@some_sha'])
 
 
+@pytest.mark.parametrize('concurrency', (1, 3))
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build._get_resolved_bundle')
+def test_get_resolved_bundles_order(mock_grb, mock_gwc, concurrency):
+    mock_gwc.return_value = mock.Mock(iib_resolve_concurrency=concurrency)
+
+    def _get_resolved_bundle(bundle, image_metadata):
+        # Finish the bundles in the reverse order to ensure the output order doesn't depend on it
+        time.sleep({'bundle:1': 0.03, 'bundle:2': 0.02}.get(bundle, 0))
+        return {'bundle:latest': 'bundle@sha256:3'}.get(bundle, bundle.replace(':', '@sha256:'))
+
+    mock_grb.side_effect = _get_resolved_bundle
+
+    bundles = ['bundle:1', 'bundle:2', 'bundle:3', 'bundle:2', 'bundle:latest']
+    rv = build._get_resolved_bundles(bundles)
+
+    assert rv == ['bundle@sha256:1', 'bundle@sha256:2', 'bundle@sha256:3']
+    # Duplicate pull specifications are only resolved once
+    assert mock_grb.call_count == 4
+
+
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build._get_resolved_bundle')
+def test_get_resolved_bundles_concurrent_failure(mock_grb, mock_gwc):
+    mock_gwc.return_value = mock.Mock(iib_resolve_concurrency=3)
+
+    def _get_resolved_bundle(bundle, image_metadata):
+        if bundle == 'bundle:2':
+            time.sleep(0.03)
+        if bundle in ('bundle:2', 'bundle:3'):
+            raise IIBError(f'Failed to inspect docker://{bundle}')
+        return bundle
+
+    mock_grb.side_effect = _get_resolved_bundle
+
+    # The error of the first failing bundle in the input is raised even if another failed earlier
+    with pytest.raises(IIBError, match='Failed to inspect docker://bundle:2'):
+        build._get_resolved_bundles(['bundle:1', 'bundle:2', 'bundle:3'])
+
+
 @pytest.mark.parametrize('from_index', (None, 'some_index:latest'))
 @pytest.mark.parametrize('bundles', (['bundle:1.2', 'bundle:1.3'], []))
 @pytest.mark.parametrize('overwrite_csv', (True, False))
@@ -910,10 +1031,13 @@ def test_handle_add_request(
         ['some-bundle:2.3-1'],
         None,
         binary_image_config=binary_image_config,
+        image_metadata=mock.ANY,
     )
     mock_gb.assert_called_once()
     assert 2 == mock_alti.call_count
-    mock_glsp.assert_called_once_with(['some-bundle@sha'], 3, 'v4.5', force_backport=force_backport)
+    mock_glsp.assert_called_once_with(
+        ['some-bundle@sha'], 3, 'v4.5', force_backport=force_backport, image_metadata=mock.ANY
+    )
 
     filter_args = mock_gmb.call_args[0]
     assert ['some-bundle@sha'] in filter_args
@@ -972,7 +1096,7 @@ def test_handle_add_request_gating_failure(mock_grb, mock_vl, mock_gb, mock_srs,
     mock_cleanup.assert_called_once_with()
     mock_srs.assert_called_once()
     mock_vl.assert_called_once()
-    mock_gb.assert_called_once_with(['some-bundle@sha'], greenwave_config)
+    mock_gb.assert_called_once_with(['some-bundle@sha'], greenwave_config, mock.ANY)
 
 
 @mock.patch('iib.workers.tasks.build._cleanup')
@@ -1000,7 +1124,7 @@ def test_handle_add_request_bundle_resolution_failure(mock_grb, mock_srs, mock_c
         )
     mock_cleanup.assert_called_once_with()
     mock_srs.assert_called_once()
-    mock_grb.assert_called_once_with(bundles)
+    mock_grb.assert_called_once_with(bundles, mock.ANY)
 
 
 @mock.patch('iib.workers.tasks.build._cleanup')
@@ -1135,6 +1259,7 @@ def test_handle_rm_request(
         None,
         binary_image_config=binary_image_config,
         distribution_scope=None,
+        image_metadata=mock.ANY,
     )
     mock_oir.assert_called_once()
     assert mock_alti.call_count == 2
@@ -1242,8 +1367,10 @@ def test_handle_regenerate_bundle_request(
     mock_aob.return_value = {'operators.operatorframework.io.bundle.package.v1': 'amqstreams-cmp'}
     mock_capml.return_value = bundle_image
     mock_gwc.return_value = {
+        'iib_build_concurrency': 4,
         'iib_index_image_output_registry': iib_index_image_output_registry,
         'iib_registry': 'quay.io',
+        'iib_use_registry_client': False,
     }
     mock_gil.return_value = pinned_by_iib_label
 
@@ -1252,12 +1379,12 @@ def test_handle_regenerate_bundle_request(
     mock_cleanup.assert_called_once()
 
     mock_gri.assert_called_once()
-    mock_gri.assert_called_with('bundle-image:latest')
+    mock_gri.assert_called_with('bundle-image:latest', image_metadata=mock.ANY)
 
     mock_pp.assert_called_once_with(from_bundle_image_resolved)
 
     mock_gia.assert_called_once()
-    mock_gia.assert_called_with('bundle-image@sha256:abcdef')
+    mock_gia.assert_called_with('bundle-image@sha256:abcdef', mock.ANY)
 
     assert mock_cffi.call_count == 2
     mock_cffi.assert_has_calls(
@@ -1356,6 +1483,20 @@ def test_copy_files_from_image(mock_run_cmd, fail_rm):
     )
 
 
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build.get_registry_client')
+@mock.patch('iib.workers.tasks.build.run_cmd')
+def test_copy_files_from_image_registry_client(mock_run_cmd, mock_grc, mock_gwc):
+    mock_gwc.return_value = {'iib_use_registry_client': True}
+    image = 'bundle-image@sha256:abcdef'
+    dest_path = '/destination/path/manifests'
+
+    build._copy_files_from_image(image, '/manifests', dest_path)
+
+    mock_grc.return_value.copy_files.assert_called_once_with(image, '/manifests', dest_path)
+    mock_run_cmd.assert_not_called()
+
+
 @mock.patch('iib.workers.tasks.build._apply_package_name_suffix')
 @mock.patch('iib.workers.tasks.build._get_resolved_image')
 @mock.patch('iib.workers.tasks.build._adjust_csv_annotations')
@@ -1815,145 +1956,178 @@ def test_get_missing_bundles_match_hash():
     )
 
 
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
-@mock.patch('iib.workers.tasks.build.run_cmd')
-@mock.patch('iib.workers.tasks.build._copy_files_from_image')
+@pytest.mark.parametrize('cached', (True, False))
+@mock.patch('iib.workers.tasks.build.get_worker_config')
+@mock.patch('iib.workers.tasks.build._get_resolved_image')
 @mock.patch('iib.workers.tasks.build.get_image_label')
-def test_get_present_bundles(mock_gil, mock_copy, mock_run_cmd, mock_popen, mock_sleep, tmpdir):
-    with open(tmpdir.join('cidfile.txt'), 'w+') as f:
-        f.write('container_id')
-    mock_gil.return_value = 'some-path'
-    mock_run_cmd.side_effect = [
-        'api.Registry.ListBundles',
-        '{"packageName": "package1", "version": "v1.0"\n}'
-        '\n{\n"packageName": "package2", "version": "v2.0"}',
-    ]
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.stderr.read.return_value = 'address already in use'
-    my_mock.poll.side_effect = [1, None]
-    assert build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir)) == [
-        {'packageName': 'package1', 'version': 'v1.0'},
-        {'packageName': 'package2', 'version': 'v2.0'},
+@mock.patch('iib.workers.tasks.build.get_cached_index_db')
+@mock.patch('iib.workers.tasks.build._copy_files_from_image')
+@mock.patch('iib.workers.tasks.build.cache_index_db')
+def test_get_index_database_cache(
+    mock_cid, mock_cffi, mock_gcid, mock_gil, mock_gri, mock_gwc, cached
+):
+    mock_gwc.return_value = {'iib_index_db_cache_dir': '/var/cache/iib'}
+    mock_gri.return_value = 'quay.io/ns/index@sha256:123'
+    mock_gil.return_value = '/database/index.db'
+    mock_gcid.return_value = cached
+
+    assert build._get_index_database('quay.io/ns/index:v4.6', '/tmp/dir') == '/tmp/dir/index.db'
+
+    mock_gil.assert_called_once_with(
+        'quay.io/ns/index@sha256:123', 'operators.operatorframework.io.index.database.v1'
+    )
+    mock_gcid.assert_called_once_with('sha256:123', '/tmp/dir/index.db')
+    if cached:
+        mock_cffi.assert_not_called()
+        mock_cid.assert_not_called()
+    else:
+        mock_cffi.assert_called_once_with(
+            'quay.io/ns/index@sha256:123', '/database/index.db', '/tmp/dir'
+        )
+        mock_cid.assert_called_once_with('sha256:123', '/tmp/dir/index.db')
+
+
+def _create_index_db(db_path, channel_entries):
+    connection = sqlite3.connect(db_path)
+    connection.executescript(
+        textwrap.dedent(
+            """\
+            CREATE TABLE operatorbundle (
+              name TEXT PRIMARY KEY, csv TEXT, bundle TEXT, bundlepath TEXT, version TEXT
+            );
+            CREATE TABLE channel_entry (
+              entry_id INTEGER PRIMARY KEY, channel_name TEXT, package_name TEXT,
+              operatorbundle_name TEXT, replaces INTEGER, depth INTEGER
+            );
+            """
+        )
+    )
+    bundles = {
+        'package1.v1.0': ('quay.io/ns/bundle1@sha256:123456', 'v1.0'),
+        'package1.v1.1': ('quay.io/ns/bundle1@sha256:234567', 'v1.1'),
+        'package2.v2.0': (None, None),
+    }
+    for name, (bundle_path, version) in bundles.items():
+        connection.execute(
+            'INSERT INTO operatorbundle (name, bundlepath, version) VALUES (?, ?, ?)',
+            (name, bundle_path, version),
+        )
+    for channel_name, package_name, bundle_name, depth in channel_entries:
+        connection.execute(
+            'INSERT INTO channel_entry (channel_name, package_name, operatorbundle_name, depth) '
+            'VALUES (?, ?, ?, ?)',
+            (channel_name, package_name, bundle_name, depth),
+        )
+    connection.commit()
+    connection.close()
+
+
+def test_get_present_bundles_from_db(tmpdir):
+    db_path = str(tmpdir.join('index.db'))
+    _create_index_db(
+        db_path,
+        [
+            ('stable', 'package1', 'package1.v1.1', 0),
+            ('stable', 'package1', 'package1.v1.0', 1),
+            ('beta', 'package1', 'package1.v1.1', 0),
+            # The same bundle is in the replaces chain of the channel multiple times
+            ('stable', 'package1', 'package1.v1.0', 2),
+            ('alpha', 'package2', 'package2.v2.0', 0),
+        ],
+    )
+
+    rv = build._get_present_bundles_from_db(db_path)
+
+    assert sorted(rv, key=lambda b: (b['csvName'], b['channelName'])) == [
+        {
+            'bundlePath': 'quay.io/ns/bundle1@sha256:123456',
+            'channelName': 'stable',
+            'csvName': 'package1.v1.0',
+            'packageName': 'package1',
+            'version': 'v1.0',
+        },
+        {
+            'bundlePath': 'quay.io/ns/bundle1@sha256:234567',
+            'channelName': 'beta',
+            'csvName': 'package1.v1.1',
+            'packageName': 'package1',
+            'version': 'v1.1',
+        },
+        {
+            'bundlePath': 'quay.io/ns/bundle1@sha256:234567',
+            'channelName': 'stable',
+            'csvName': 'package1.v1.1',
+            'packageName': 'package1',
+            'version': 'v1.1',
+        },
+        {
+            'bundlePath': '',
+            'channelName': 'alpha',
+            'csvName': 'package2.v2.0',
+            'packageName': 'package2',
+            'version': '',
+        },
     ]
-    assert mock_run_cmd.call_count == 2
 
 
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
-@mock.patch('iib.workers.tasks.build.run_cmd')
+def test_get_present_bundles_from_db_invalid(tmpdir):
+    db_path = str(tmpdir.join('index.db'))
+    sqlite3.connect(db_path).close()
+
+    with pytest.raises(sqlite3.OperationalError, match='no such table'):
+        build._get_present_bundles_from_db(db_path)
+
+
+@mock.patch('iib.workers.tasks.build._get_present_bundles_from_grpc')
 @mock.patch('iib.workers.tasks.build._copy_files_from_image')
 @mock.patch('iib.workers.tasks.build.get_image_label')
-def test_get_no_present_bundles(mock_gil, mock_copy, mock_run_cmd, mock_popen, mock_sleep, tmpdir):
-    with open(tmpdir.join('cidfile.txt'), 'w+') as f:
-        f.write('container_id')
-    mock_gil.return_value = 'some-path'
-    mock_run_cmd.side_effect = [
-        'api.Registry.ListBundles',
-        '',
-    ]
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.stderr.read.return_value = 'address already in use'
-    my_mock.poll.side_effect = [1, None]
-    assert build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir)) == []
-    assert mock_run_cmd.call_count == 2
-
-
-@mock.patch('time.time')
-@mock.patch('os.remove')
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
-@mock.patch('iib.workers.tasks.build.run_cmd')
+def test_get_present_bundles(mock_gil, mock_copy, mock_gpbfg, tmpdir):
+    mock_gil.return_value = '/database/index.db'
+    _create_index_db(str(tmpdir.join('index.db')), [('stable', 'package1', 'package1.v1.0', 0)])
+
+    rv = build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir))
+
+    assert [bundle['csvName'] for bundle in rv] == ['package1.v1.0']
+    mock_gpbfg.assert_not_called()
+
+
+@mock.patch('iib.workers.tasks.build._get_present_bundles_from_grpc')
 @mock.patch('iib.workers.tasks.build._copy_files_from_image')
 @mock.patch('iib.workers.tasks.build.get_image_label')
-def test_get_present_bundles_grpc_not_initialize(
-    mock_gil, mock_copy, mock_run_cmd, mock_popen, mock_sleep, mock_remove, mock_time, tmpdir,
-):
-    with open(tmpdir.join('cidfile.txt'), 'w+') as f:
-        f.write('container_id')
-    mock_run_cmd.side_effect = ['', '', '', '', ''] * 4
-    mock_time.side_effect = list(range(1, 80))
-    mock_gil.return_value = 'some-path'
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.poll.return_value = None
-    with pytest.raises(IIBError, match='Index registry has not been initialized after 5 tries'):
-        build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir))
-    assert mock_run_cmd.call_count == 20
-
-
-@mock.patch('time.time')
-@mock.patch('os.remove')
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
+def test_get_present_bundles_fallback(mock_gil, mock_copy, mock_gpbfg, tmpdir):
+    mock_gil.return_value = '/database/index.db'
+    # The database file was not created, so it can't be opened
+    mock_gpbfg.return_value = [{'packageName': 'package1', 'version': 'v1.0'}]
+
+    rv = build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir))
+
+    assert rv == [{'packageName': 'package1', 'version': 'v1.0'}]
+    mock_gpbfg.assert_called_once_with(str(tmpdir.join('index.db')))
+
+
+@mock.patch('iib.workers.tasks.build.serve_index_registry')
 @mock.patch('iib.workers.tasks.build.run_cmd')
-@mock.patch('iib.workers.tasks.build._copy_files_from_image')
-@mock.patch('iib.workers.tasks.build.get_image_label')
-def test_get_present_bundles_grpc_delayed_initialize(
-    mock_gil, mock_copy, mock_run_cmd, mock_popen, mock_sleep, mock_remove, mock_time, tmpdir,
-):
-    with open(tmpdir.join('cidfile.txt'), 'w+') as f:
-        f.write('container_id')
-    mock_time.side_effect = [i * 0.5 for i in range(1, 80)]
-    mock_gil.return_value = 'some-path'
-    mock_run_cmd.side_effect = [
-        '',
-        '',
-        '',
-        '',
-        '',
-        '',
-        'api.Registry.ListBundles',
+def test_get_present_bundles_from_grpc(mock_run_cmd, mock_sir):
+    mock_sir.return_value.__enter__.return_value = 50051
+    mock_run_cmd.return_value = (
         '{"packageName": "package1", "version": "v1.0"\n}'
-        '\n{\n"packageName": "package2", "version": "v2.0"}',
-    ]
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.poll.return_value = None
-    assert build._get_present_bundles('quay.io/index-image:4.5', str(tmpdir)) == [
+        '\n{\n"packageName": "package2", "version": "v2.0"}'
+    )
+    assert build._get_present_bundles_from_grpc('/tmp/index.db') == [
         {'packageName': 'package1', 'version': 'v1.0'},
         {'packageName': 'package2', 'version': 'v2.0'},
     ]
-    assert mock_run_cmd.call_count == 8
+    mock_sir.assert_called_once_with('/tmp/index.db')
+    mock_run_cmd.assert_called_once_with(
+        ['grpcurl', '-plaintext', 'localhost:50051', 'api.Registry/ListBundles'],
+        exc_msg='Failed to get bundle data from index image',
+    )
 
 
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
+@mock.patch('iib.workers.tasks.build.serve_index_registry')
 @mock.patch('iib.workers.tasks.build.run_cmd')
-def test_serve_image_registry(mock_run_cmd, mock_popen, mock_sleep, tmpdir):
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.stderr.read.side_effect = [
-        'address already in use',
-        'address already in use',
-    ]
-    mock_run_cmd.return_value = 'api.Registry.ListBundles'
-    my_mock.poll.side_effect = [1, 1, None]
-    port, _ = build._serve_index_registry('some_path.db')
-    assert port == 50053
-    assert my_mock.poll.call_count == 3
-
-
-@mock.patch('iib.workers.tasks.build.get_worker_config')
-@mock.patch('time.sleep')
-@mock.patch('subprocess.Popen')
-def test_serve_image_registry_no_ports(mock_popen, mock_sleep, mock_config, tmpdir):
-    my_mock = mock.MagicMock()
-    mock_popen.return_value = my_mock
-    my_mock.stderr.read.side_effect = [
-        'address already in use',
-        'address already in use',
-        'address already in use',
-    ]
-    my_mock.poll.side_effect = [1, 1, 1, None]
-    mock_config.return_value = {
-        'iib_grpc_start_port': 50051,
-        'iib_grpc_init_wait_time': 1,
-        'iib_grpc_max_port_tries': 3,
-        'iib_grpc_max_tries': 3,
-    }
-    with pytest.raises(IIBError, match='No free port has been found after 3 attempts.'):
-        build._serve_index_registry('some_path.db')
-    assert my_mock.poll.call_count == 3
+def test_get_no_present_bundles_from_grpc(mock_run_cmd, mock_sir):
+    mock_sir.return_value.__enter__.return_value = 50051
+    mock_run_cmd.return_value = ''
+    assert build._get_present_bundles_from_grpc('/tmp/index.db') == []
+    mock_run_cmd.assert_called_once()
@@ -17,8 +17,7 @@ from iib.workers.tasks import build_merge_index_image
 @mock.patch('iib.workers.tasks.build_merge_index_image._update_index_image_pull_spec')
 @mock.patch('iib.workers.tasks.build._verify_index_image')
 @mock.patch('iib.workers.tasks.build_merge_index_image._create_and_push_manifest_list')
-@mock.patch('iib.workers.tasks.build_merge_index_image._push_image')
-@mock.patch('iib.workers.tasks.build_merge_index_image._build_image')
+@mock.patch('iib.workers.tasks.build_merge_index_image._build_and_push_images')
 @mock.patch('iib.workers.tasks.build_merge_index_image._deprecate_bundles')
 @mock.patch('iib.workers.tasks.build_merge_index_image._get_external_arch_pull_spec')
 @mock.patch('iib.workers.tasks.build_merge_index_image._get_bundles_from_deprecation_list')
@@ -40,8 +39,7 @@ def test_handle_merge_request(
     mock_gbfdl,
     mock_geaps,
     mock_dep_b,
-    mock_bi,
-    mock_pi,
+    mock_bapi,
     mock_capml,
     mock_vii,
     mock_uiips,
@@ -80,6 +78,7 @@ def test_handle_merge_request(
         target_index=target_index,
         distribution_scope='stage',
         binary_image_config=binary_image_config,
+        image_metadata=mock.ANY,
     )
     mock_uiibs.assert_called_once_with(1, prebuild_info)
     if target_index:
@@ -91,8 +90,7 @@ def test_handle_merge_request(
     mock_gbfdl.assert_called_once()
     mock_geaps.assert_called_once()
     mock_dep_b.assert_called_once()
-    assert mock_bi.call_count == 2
-    assert mock_pi.call_count == 2
+    mock_bapi.assert_called_once_with(mock.ANY, 'index.Dockerfile', 1, {'amd64', 'other_arch'})
     assert mock_capml.call_count == 1
     mock_uiips.assert_called_once()
 
@@ -100,8 +98,7 @@ def test_handle_merge_request(
 @mock.patch('iib.workers.tasks.build_merge_index_image._update_index_image_pull_spec')
 @mock.patch('iib.workers.tasks.build._verify_index_image')
 @mock.patch('iib.workers.tasks.build_merge_index_image._create_and_push_manifest_list')
-@mock.patch('iib.workers.tasks.build_merge_index_image._push_image')
-@mock.patch('iib.workers.tasks.build_merge_index_image._build_image')
+@mock.patch('iib.workers.tasks.build_merge_index_image._build_and_push_images')
 @mock.patch('iib.workers.tasks.build_merge_index_image._deprecate_bundles')
 @mock.patch('iib.workers.tasks.build_merge_index_image._get_external_arch_pull_spec')
 @mock.patch('iib.workers.tasks.build_merge_index_image._get_bundles_from_deprecation_list')
@@ -123,8 +120,7 @@ def test_handle_merge_request_no_deprecate(
     mock_gbfdl,
     mock_geaps,
     mock_dep_b,
-    mock_bi,
-    mock_pi,
+    mock_bapi,
     mock_capml,
     mock_vii,
     mock_uiips,
@@ -158,6 +154,7 @@ def test_handle_merge_request_no_deprecate(
         source_from_index='source-from-index:1.0',
         target_index='target-from-index:1.0',
         distribution_scope='stage',
+        image_metadata=mock.ANY,
     )
     mock_uiibs.assert_called_once_with(1, prebuild_info)
     assert mock_gpb.call_count == 2
@@ -165,8 +162,7 @@ def test_handle_merge_request_no_deprecate(
     mock_gbfdl.assert_called_once()
     mock_geaps.assert_called_once()
     assert mock_dep_b.call_count == 0
-    assert mock_bi.call_count == 2
-    assert mock_pi.call_count == 2
+    mock_bapi.assert_called_once_with(mock.ANY, 'index.Dockerfile', 1, {'amd64', 'other_arch'})
     mock_vii.assert_not_called()
     mock_capml.assert_called_once()
     mock_uiips.assert_called_once()
@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import json
+from unittest import mock
+
+import pytest
+
+from iib.exceptions import IIBError
+from iib.workers.tasks import image_storage
+
+
+@pytest.fixture()
+def last_used():
+    with mock.patch.object(image_storage, '_last_used', new_callable=dict) as last_used:
+        yield last_used
+
+
+@pytest.fixture()
+def mock_config():
+    with mock.patch('iib.workers.tasks.image_storage.get_worker_config') as mock_gwc:
+        mock_gwc.return_value = {'iib_image_storage_max_size': 100}
+        yield mock_gwc.return_value
+
+
+def _image(image_id, names, size, created=0, repo_digests=None):
+    return {
+        'Id': image_id,
+        'Names': names,
+        'RepoDigests': repo_digests or [],
+        'Size': size,
+        'Created': created,
+    }
+
+
+@mock.patch('iib.workers.tasks.image_storage.run_cmd')
+def test_cleanup_images_within_budget(mock_run_cmd, last_used, mock_config):
+    images = [
+        _image('1', ['localhost/iib-build:1-amd64'], 500),
+        _image('2', ['localhost/iib-build:1-s390x'], 500),
+        _image('3', ['registry.redhat.io/openshift4/ose-operator-registry:v4.6'], 60),
+    ]
+    mock_run_cmd.side_effect = [json.dumps(images), '']
+
+    image_storage.cleanup_images()
+
+    # Only the images built by IIB are removed
+    assert mock_run_cmd.call_count == 2
+    assert mock_run_cmd.call_args[0][0] == ['podman', 'rmi', '--force', '1', '2']
+
+
+@mock.patch('iib.workers.tasks.image_storage.run_cmd')
+def test_cleanup_images_evicts_least_recently_used(mock_run_cmd, last_used, mock_config):
+    images = [
+        # The most recently created image was not used by a request since the worker started
+        _image('1', ['quay.io/ns/old:latest'], 40, created=300),
+        _image(
+            '2',
+            ['quay.io/ns/binary:v4.6'],
+            40,
+            created=100,
+            repo_digests=['quay.io/ns/binary@sha256:binary'],
+        ),
+        _image('3', ['quay.io/ns/index:v4.6'], 40, created=200),
+        _image('4', [], 40, created=50),
+    ]
+    mock_run_cmd.side_effect = [json.dumps(images), IIBError('image is in use'), '', '']
+    image_storage.mark_images_used(None, 'quay.io/ns/index:v4.6')
+    image_storage.mark_images_used('quay.io/ns/binary@sha256:binary')
+
+    image_storage.cleanup_images()
+
+    removed = [c[0][0] for c in mock_run_cmd.call_args_list[1:]]
+    # The image in use fails to be removed, so the next least recently used image is removed
+    assert removed == [['podman', 'rmi', '4'], ['podman', 'rmi', '1'], ['podman', 'rmi', '3']]
+    assert last_used == {'quay.io/ns/binary@sha256:binary': mock.ANY}
+
+
+@mock.patch('iib.workers.tasks.image_storage.run_cmd')
+def test_cleanup_images_no_budget(mock_run_cmd, last_used, mock_config):
+    mock_config['iib_image_storage_max_size'] = 0
+    images = [_image('1', ['quay.io/ns/binary:v4.6'], 40), _image('2', ['quay.io/ns/a:1'], 40)]
+    mock_run_cmd.side_effect = [json.dumps(images), '', '']
+
+    image_storage.cleanup_images()
+
+    assert mock_run_cmd.call_count == 3
+
+
+@pytest.mark.parametrize(
+    'name, expected',
+    (
+        ('localhost/iib-build:1-amd64', True),
+        ('iib-build:1-amd64', True),
+        ('quay.io/ns/iib-build:1', False),
+        ('registry.redhat.io/openshift4/ose-operator-registry:v4.6', False),
+    ),
+)
+def test_is_built_image(name, expected):
+    assert image_storage._is_built_image(name) is expected
@@ -0,0 +1,68 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+import os
+from unittest import mock
+
+import pytest
+
+from iib.workers.tasks import index_db_cache
+
+
+@pytest.fixture()
+def cache_dir(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    with mock.patch('iib.workers.tasks.index_db_cache.get_worker_config') as mock_gwc:
+        mock_gwc.return_value = {
+            'iib_index_db_cache_dir': str(cache_dir),
+            'iib_index_db_cache_max_size': 10,
+        }
+        yield cache_dir
+
+
+def test_index_db_cache(cache_dir, tmpdir):
+    db_path = tmpdir.join('index.db')
+    db_path.write('database')
+    dest_path = tmpdir.join('copy.db')
+
+    assert index_db_cache.get_cached_index_db('sha256:123', str(dest_path)) is False
+    index_db_cache.cache_index_db('sha256:123', str(db_path))
+    assert index_db_cache.get_cached_index_db('sha256:123', str(dest_path)) is True
+
+    assert dest_path.read() == 'database'
+    assert cache_dir.join('sha256-123.db').read() == 'database'
+    # No temporary files are left behind
+    assert sorted(os.listdir(cache_dir)) == ['.lock', 'sha256-123.db']
+
+
+def test_index_db_cache_eviction(cache_dir, tmpdir):
+    db_path = tmpdir.join('index.db')
+    db_path.write('1234')
+
+    for i, digest in enumerate(('sha256:1', 'sha256:2')):
+        index_db_cache.cache_index_db(digest, str(db_path))
+        os.utime(cache_dir.join(f'sha256-{i + 1}.db'), (i, i))
+
+    # Reading an entry marks it as recently used
+    assert index_db_cache.get_cached_index_db('sha256:1', str(tmpdir.join('copy.db'))) is True
+    # The cache exceeds the maximum size of 10 bytes with a third entry
+    index_db_cache.cache_index_db('sha256:3', str(db_path))
+
+    assert sorted(os.listdir(cache_dir)) == ['.lock', 'sha256-1.db', 'sha256-3.db']
+
+
+def test_index_db_cache_too_large(cache_dir, tmpdir):
+    db_path = tmpdir.join('index.db')
+    db_path.write('a large database')
+
+    index_db_cache.cache_index_db('sha256:123', str(db_path))
+
+    assert os.listdir(cache_dir) == []
+
+
+@mock.patch('iib.workers.tasks.index_db_cache.get_worker_config')
+def test_index_db_cache_disabled(mock_gwc, tmpdir):
+    mock_gwc.return_value = {'iib_index_db_cache_dir': None}
+    db_path = tmpdir.join('index.db')
+    db_path.write('database')
+
+    index_db_cache.cache_index_db('sha256:123', str(db_path))
+    assert index_db_cache.get_cached_index_db('sha256:123', str(tmpdir.join('copy.db'))) is False
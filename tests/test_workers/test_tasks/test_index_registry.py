@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+from collections import OrderedDict
+import os
+import threading
+import time
+from unittest import mock
+
+from celery.signals import worker_process_shutdown
+import pytest
+
+from iib.exceptions import IIBError
+from iib.workers.tasks import index_registry
+
+# Connect the handlers of the Celery signals
+import iib.workers.tasks.celery  # noqa: F401
+
+
+SERVING_LOG = 'time="2020-09-01T00:00:00Z" level=info msg="serving registry" port=50051\n'
+
+
+class FakeProcess(object):
+    """A fake ``opm registry serve`` process."""
+
+    def __init__(self, stderr_lines, returncode=None):
+        """
+        Initialize the fake process.
+
+        :param list stderr_lines: the lines to write to stderr
+        :param int returncode: if set, the process exits with this code after writing stderr;
+            otherwise, it runs until it's killed
+        """
+        self._stderr_lines = stderr_lines
+        self._exit_returncode = returncode
+        self._killed = threading.Event()
+        self.returncode = None
+
+    @property
+    def stderr(self):
+        """Write the stderr lines and then exit or wait to be killed."""
+        yield from self._stderr_lines
+        if self._exit_returncode is None:
+            self._killed.wait()
+        else:
+            self.returncode = self._exit_returncode
+
+    def poll(self):
+        """Get the return code."""
+        return self.returncode
+
+    def kill(self):
+        """Kill the process."""
+        self.returncode = -9
+        self._killed.set()
+
+    def wait(self):
+        """Wait for the process to exit."""
+        return self.returncode
+
+
+@pytest.fixture()
+def servers():
+    with mock.patch.object(index_registry, '_servers', new_callable=OrderedDict) as servers:
+        yield servers
+        index_registry.stop_index_registry_servers()
+
+
+@pytest.fixture()
+def mock_config():
+    with mock.patch('iib.workers.tasks.index_registry.get_worker_config') as mock_gwc:
+        mock_gwc.return_value = {
+            'iib_grpc_init_wait_time': 5,
+            'iib_grpc_max_tries': 2,
+            'iib_index_registry_pool_size': 1,
+        }
+        yield mock_gwc.return_value
+
+
+def _create_db(tmpdir, name, content='database'):
+    db = tmpdir.join(name)
+    db.write(content)
+    return str(db)
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_reuse(mock_popen, servers, mock_config, tmpdir):
+    mock_popen.side_effect = lambda *args, **kwargs: FakeProcess([SERVING_LOG])
+    db_path = _create_db(tmpdir, 'index.db')
+    other_db_path = _create_db(tmpdir.mkdir('other'), 'index.db')
+
+    with index_registry.serve_index_registry(db_path) as port:
+        assert isinstance(port, int)
+    # The same database content is served by the same service
+    with index_registry.serve_index_registry(other_db_path) as other_port:
+        assert other_port == port
+
+    mock_popen.assert_called_once()
+    cmd = mock_popen.call_args[0][0]
+    assert cmd[:5] == ['opm', 'registry', 'serve', '-p', str(port)]
+    # The service serves its own copy of the database
+    served_db_path = cmd[6]
+    assert served_db_path != db_path
+    assert os.path.isfile(served_db_path)
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_eviction(mock_popen, servers, mock_config, tmpdir):
+    processes = []
+
+    def _popen(*args, **kwargs):
+        processes.append(FakeProcess([SERVING_LOG]))
+        return processes[-1]
+
+    mock_popen.side_effect = _popen
+    db_path = _create_db(tmpdir, 'index.db')
+    other_db_path = _create_db(tmpdir, 'other.db', 'other database')
+
+    with index_registry.serve_index_registry(db_path):
+        with index_registry.serve_index_registry(other_db_path):
+            other_served_db_path = mock_popen.call_args[0][0][6]
+        # The other service is the only idle one, so it fits in the pool
+        assert processes[1].poll() is None
+
+    # The other service is the least recently used idle service, so it's evicted
+    assert len(servers) == 1
+    assert processes[0].poll() is None
+    assert processes[1].poll() == -9
+    assert not os.path.exists(other_served_db_path)
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_restart_exited(mock_popen, servers, mock_config, tmpdir):
+    processes = []
+
+    def _popen(*args, **kwargs):
+        processes.append(FakeProcess([SERVING_LOG]))
+        return processes[-1]
+
+    mock_popen.side_effect = _popen
+    db_path = _create_db(tmpdir, 'index.db')
+
+    with index_registry.serve_index_registry(db_path):
+        pass
+    processes[0].kill()
+    with index_registry.serve_index_registry(db_path):
+        pass
+
+    assert mock_popen.call_count == 2
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_address_in_use(mock_popen, servers, mock_config, tmpdir):
+    mock_popen.side_effect = [
+        FakeProcess(['Error: listen tcp :50051: bind: address already in use\n'], 1),
+        FakeProcess([SERVING_LOG]),
+    ]
+    db_path = _create_db(tmpdir, 'index.db')
+
+    with index_registry.serve_index_registry(db_path) as port:
+        assert port == int(mock_popen.call_args[0][0][4])
+
+    assert mock_popen.call_count == 2
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_failed(mock_popen, servers, mock_config, tmpdir):
+    mock_popen.return_value = FakeProcess(['Error: unable to open database file\n'], 1)
+    db_path = _create_db(tmpdir, 'index.db')
+
+    with pytest.raises(IIBError, match='has failed with error "Error: unable to open database'):
+        with index_registry.serve_index_registry(db_path):
+            pass
+
+    assert not servers
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_not_initialized(mock_popen, servers, mock_config, tmpdir):
+    mock_config['iib_grpc_init_wait_time'] = 0.01
+    mock_popen.side_effect = lambda *args, **kwargs: FakeProcess(['loading the database\n'])
+    db_path = _create_db(tmpdir, 'index.db')
+
+    with pytest.raises(IIBError, match='Index registry has not been initialized after 2 tries'):
+        with index_registry.serve_index_registry(db_path):
+            pass
+
+    assert mock_popen.call_count == 2
+
+
+@mock.patch('subprocess.Popen')
+def test_serve_index_registry_concurrent_start(mock_popen, servers, mock_config, tmpdir):
+    serving = threading.Event()
+
+    def _slow_stderr():
+        serving.wait(5)
+        yield SERVING_LOG
+
+    processes = []
+
+    def _popen(*args, **kwargs):
+        # The first service doesn't start until the second one is served
+        processes.append(FakeProcess(_slow_stderr() if not processes else [SERVING_LOG]))
+        return processes[-1]
+
+    mock_popen.side_effect = _popen
+    db_path = _create_db(tmpdir, 'index.db')
+    other_db_path = _create_db(tmpdir, 'other.db', 'other database')
+    ports = []
+
+    def _serve():
+        with index_registry.serve_index_registry(db_path) as port:
+            ports.append(port)
+
+    threads = [threading.Thread(target=_serve) for _ in range(2)]
+    threads[0].start()
+    while not processes:
+        time.sleep(0.01)
+    # The second request for the same database waits for the service being started
+    threads[1].start()
+
+    # Starting a service doesn't block the requests for other databases
+    with index_registry.serve_index_registry(other_db_path) as other_port:
+        assert not ports
+    serving.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert mock_popen.call_count == 2
+    assert ports[0] == ports[1]
+    assert ports[0] != other_port
+
+
+@mock.patch('iib.workers.tasks.index_registry.socket.socket')
+def test_get_free_port_in_use(mock_socket):
+    sock = mock_socket.return_value.__enter__.return_value
+    sock.getsockname.side_effect = [('127.0.0.1', 5000), ('127.0.0.1', 5001)]
+
+    with mock.patch.object(index_registry, '_ports', {5000}) as ports:
+        # The port of another service of this process isn't used again
+        assert index_registry._get_free_port() == 5001
+        assert ports == {5000, 5001}
+
+
+@mock.patch('subprocess.Popen')
+def test_stop_index_registry_servers_on_worker_process_shutdown(
+    mock_popen, servers, mock_config, tmpdir
+):
+    process = FakeProcess([SERVING_LOG])
+    mock_popen.return_value = process
+    db_path = _create_db(tmpdir, 'index.db')
+    with index_registry.serve_index_registry(db_path):
+        served_db_path = mock_popen.call_args[0][0][6]
+
+    # The prefork worker processes exit without running the atexit handlers
+    worker_process_shutdown.send(sender=None, pid=os.getpid(), exitcode=0)
+
+    assert not servers
+    assert process.poll() == -9
+    assert not os.path.exists(served_db_path)
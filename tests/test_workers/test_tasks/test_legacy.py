@@ -1,8 +1,12 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+import io
 import json
+import os
 from unittest import mock
+import zipfile
 
 import pytest
+import requests
 
 from iib.exceptions import IIBError
 from iib.workers.tasks import legacy
@@ -64,49 +68,52 @@ def test_verify_package_info_missing_pkg(mock_listdir):
         legacy._verify_package_info('/some/dir/download-pkg/download-pkg', 'index:image')
 
 
-@mock.patch('shutil.make_archive')
-def test_zip_package_success(mock_shutil):
-    legacy._zip_package('something/download-pkg/download-pkg')
-    mock_shutil.assert_called_once_with(
-        'something/download-pkg/manifests', 'zip', 'something/download-pkg/download-pkg'
-    )
+def test_zip_package_success(tmpdir):
+    package_dir = tmpdir.mkdir('download-pkg').mkdir('download-pkg')
+    package_dir.join('package.yaml').write('packageName: download-pkg')
+    package_dir.mkdir('1.1.1').join('csv.yaml').write('kind: ClusterServiceVersion')
+
+    package_zip = legacy._zip_package(str(package_dir))
+
+    with zipfile.ZipFile(package_zip) as zip_file:
+        assert sorted(zip_file.namelist()) == ['1.1.1/', '1.1.1/csv.yaml', 'package.yaml']
+        assert zip_file.read('1.1.1/csv.yaml') == b'kind: ClusterServiceVersion'
+    # Nothing is written to disk
+    assert tmpdir.join('download-pkg').listdir() == [package_dir]
 
 
-@mock.patch('shutil.make_archive')
-def test_zip_package_failure(mock_shutil):
-    mock_shutil.side_effect = AttributeError('Nothing works!')
+@mock.patch('zipfile.ZipFile')
+def test_zip_package_failure(mock_zipfile):
+    mock_zipfile.side_effect = AttributeError('Nothing works!')
     with pytest.raises(IIBError, match='Unable to zip exported package for download-pkg'):
         legacy._zip_package('something/download-pkg/download-pkg')
 
 
-@mock.patch('iib.workers.tasks.legacy.open')
-@mock.patch('iib.workers.tasks.legacy.requests.post')
-def test_push_package_manifest_success(mock_requests, mock_open):
+@mock.patch('iib.workers.tasks.legacy.requests_session.post')
+def test_push_package_manifest_success(mock_requests):
     mock_requests.return_value.ok = True
-    legacy._push_package_manifest(
-        'something/download-pkg/download-pkg', 'cnr_token', 'organization'
+    package_zip = io.BytesIO(b'zip')
+    legacy._push_package_manifest(package_zip, 'cnr_token', 'organization')
+    mock_requests.assert_called_once_with(
+        'some_urlorganization/zipfile',
+        headers={'Authorization': 'cnr_token'},
+        files={'file': ('manifests.zip', package_zip, 'application/zip')},
+        timeout=120,
     )
-    mock_open.assert_called_once_with('something/download-pkg/manifests.zip', 'rb')
-    mock_requests.assert_called_once()
 
 
-@mock.patch('iib.workers.tasks.legacy.open')
-@mock.patch('iib.workers.tasks.legacy.requests.post')
-def test_push_package_manifest_failure(mock_requests, mock_open):
+@mock.patch('iib.workers.tasks.legacy.requests_session.post')
+def test_push_package_manifest_failure(mock_requests):
     mock_requests.return_value.ok = False
     mock_requests.return_value.json.return_value = {"message": "Unauthorized"}
     expected = 'Push to organization in the legacy app registry was unsucessful: Unauthorized'
     with pytest.raises(IIBError, match=expected):
-        legacy._push_package_manifest(
-            'something/download-pkg/download-pkg', 'cnr_token', 'organization'
-        )
-    mock_open.assert_called_once_with('something/download-pkg/manifests.zip', 'rb')
+        legacy._push_package_manifest(io.BytesIO(b'zip'), 'cnr_token', 'organization')
     mock_requests.assert_called_once()
 
 
-@mock.patch('iib.workers.tasks.legacy.open')
-@mock.patch('iib.workers.tasks.legacy.requests.post')
-def test_push_package_manifest_failure_invalid_json(mock_requests, mock_open):
+@mock.patch('iib.workers.tasks.legacy.requests_session.post')
+def test_push_package_manifest_failure_invalid_json(mock_requests):
     mock_requests.return_value.ok = False
     mock_requests.return_value.json.side_effect = json.JSONDecodeError('Invalid Json', '', 1)
     mock_requests.return_value.text = 'Something went wrong'
@@ -114,13 +121,21 @@ def test_push_package_manifest_failure_invalid_json(mock_requests, mock_open):
         'Push to organization in the legacy app registry was unsucessful: Something went wrong'
     )
     with pytest.raises(IIBError, match=expected):
-        legacy._push_package_manifest(
-            'something/download-pkg/download-pkg', 'cnr_token', 'organization'
-        )
-    mock_open.assert_called_once_with('something/download-pkg/manifests.zip', 'rb')
+        legacy._push_package_manifest(io.BytesIO(b'zip'), 'cnr_token', 'organization')
     mock_requests.assert_called_once()
 
 
+@mock.patch('iib.workers.tasks.legacy.requests_session.post')
+def test_push_package_manifest_connection_failed(mock_requests):
+    mock_requests.side_effect = requests.ConnectionError()
+    expected = (
+        'Push to organization in the legacy app registry was unsucessful: '
+        'the connection to OMPS failed'
+    )
+    with pytest.raises(IIBError, match=expected):
+        legacy._push_package_manifest(io.BytesIO(b'zip'), 'cnr_token', 'organization')
+
+
 @mock.patch('iib.workers.tasks.legacy.run_cmd')
 def test_opm_index_export(mock_run_cmd):
     legacy._opm_index_export('from:index', 'prometheus', '/')
@@ -132,13 +147,16 @@ def test_opm_index_export(mock_run_cmd):
     assert 'prometheus' in opm_args
 
 
+@mock.patch('iib.workers.tasks.legacy.podman_pull')
 @mock.patch('iib.workers.tasks.legacy._verify_package_info')
 @mock.patch('iib.workers.tasks.legacy._zip_package')
 @mock.patch('iib.workers.tasks.legacy._push_package_manifest')
 @mock.patch('iib.workers.tasks.legacy.set_omps_operator_version')
 @mock.patch('iib.workers.tasks.legacy.set_request_state')
 @mock.patch('iib.workers.tasks.legacy._opm_index_export')
-def test_export_legacy_packages(mock_oie, mock_srs, mock_soov, mock_ppm, mock_zp, mock_vpi):
+def test_export_legacy_packages(
+    mock_oie, mock_srs, mock_soov, mock_ppm, mock_zp, mock_vpi, mock_pp
+):
 
     mock_ppm.return_value = {
         'extracted_files': [
@@ -169,14 +187,60 @@ def test_export_legacy_packages(mock_oie, mock_srs, mock_soov, mock_ppm, mock_zp
     packages = {'lgallett-bundle'}
     legacy.export_legacy_packages(packages, 3, 'from:index', 'token', 'org')
 
+    mock_pp.assert_called_once_with('from:index')
     mock_oie.assert_called_once()
     mock_vpi.assert_called_once()
     mock_zp.assert_called_once()
-    mock_ppm.assert_called_once()
+    mock_ppm.assert_called_once_with(mock_zp.return_value, 'token', 'org')
     mock_srs.assert_called_once()
     mock_soov.assert_called_once_with(3, {'lgallett-bundle': '37.0.0'})
 
 
+@mock.patch('iib.workers.tasks.legacy.podman_pull')
+@mock.patch('iib.workers.tasks.legacy._verify_package_info')
+@mock.patch('iib.workers.tasks.legacy._zip_package')
+@mock.patch('iib.workers.tasks.legacy._push_package_manifest')
+@mock.patch('iib.workers.tasks.legacy.set_omps_operator_version')
+@mock.patch('iib.workers.tasks.legacy.set_request_state')
+@mock.patch('iib.workers.tasks.legacy._opm_index_export')
+def test_export_legacy_packages_concurrent(
+    mock_oie, mock_srs, mock_soov, mock_ppm, mock_zp, mock_vpi, mock_pp
+):
+    mock_zp.side_effect = lambda package_dir: os.path.basename(package_dir)
+    mock_ppm.side_effect = lambda package_zip, cnr_token, organization: {
+        'version': f'{package_zip}-1.0.0'
+    }
+    packages = {'package1', 'package2', 'package3'}
+
+    legacy.export_legacy_packages(packages, 3, 'from:index', 'token', 'org')
+
+    # The index image is only pulled once for all the packages
+    mock_pp.assert_called_once_with('from:index')
+    assert sorted(c[0][1] for c in mock_oie.call_args_list) == sorted(packages)
+    expected = {p: f'{p}-1.0.0' for p in packages}
+    mock_soov.assert_called_once_with(3, expected)
+
+
+@mock.patch('iib.workers.tasks.legacy.podman_pull')
+@mock.patch('iib.workers.tasks.legacy._push_package_manifest')
+@mock.patch('iib.workers.tasks.legacy.set_omps_operator_version')
+@mock.patch('iib.workers.tasks.legacy._opm_index_export')
+def test_export_legacy_packages_failure(mock_oie, mock_soov, mock_ppm, mock_pp):
+    def _opm_index_export(rebuilt_index_image, package, temp_dir):
+        raise IIBError(f'Failed to push {package} to the legacy application registry')
+
+    mock_oie.side_effect = _opm_index_export
+
+    # The error of the first package in sorted order is raised
+    with pytest.raises(IIBError, match='Failed to push package1 to the legacy'):
+        legacy.export_legacy_packages(
+            {'package3', 'package1', 'package2'}, 3, 'from:index', 'token', 'org'
+        )
+
+    mock_ppm.assert_not_called()
+    mock_soov.assert_not_called()
+
+
 @pytest.mark.parametrize(
     'cnr_token_val, error_msg',
     (
@@ -1,11 +1,15 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
+from collections import OrderedDict
 import logging
+import os
 import textwrap
+import time
 from unittest import mock
 
 import pytest
 
 from iib.exceptions import IIBError
+from iib.workers.api_utils import set_request_state
 from iib.workers.config import get_worker_config
 from iib.workers.tasks import utils
 
@@ -17,6 +21,46 @@ def test_get_image_labels(mock_si):
     assert utils.get_image_labels('some-image:latest') == skopeo_rv['config']['Labels']
 
 
+@mock.patch('iib.workers.tasks.utils.skopeo_inspect')
+def test_get_image_labels_image_metadata(mock_si):
+    mock_si.return_value = {'config': {'Labels': {'some_label': 'value'}}}
+    image_metadata = utils.ImageMetadata()
+
+    assert utils.get_image_labels('some-image:latest', image_metadata) == {'some_label': 'value'}
+    assert utils.get_image_labels('docker://some-image:latest', image_metadata) == {
+        'some_label': 'value'
+    }
+
+    mock_si.assert_called_once_with('docker://some-image:latest', '--config')
+
+
+@mock.patch('iib.workers.tasks.utils.skopeo_inspect')
+def test_image_metadata_manifest(mock_si):
+    mock_si.return_value = '{"schemaVersion": 2}'
+    image_metadata = utils.ImageMetadata()
+
+    assert image_metadata.get_raw_manifest('some-image:latest') == '{"schemaVersion": 2}'
+    assert image_metadata.get_manifest('some-image:latest') == {'schemaVersion': 2}
+
+    mock_si.assert_called_once_with('docker://some-image:latest', '--raw', return_json=False)
+
+
+@mock.patch('iib.workers.tasks.utils.skopeo_inspect')
+def test_image_metadata_resolved(mock_si):
+    mock_si.return_value = {'config': {'Labels': {'some_label': 'value'}}}
+    image_metadata = utils.ImageMetadata()
+    image_metadata.set_resolved(
+        'some-image:latest', 'some-image@sha256:123456', raw_manifest='{"schemaVersion": 2}'
+    )
+
+    # The resolved pull specification shares the raw manifest and config with the original one
+    assert image_metadata.get_raw_manifest('some-image@sha256:123456') == '{"schemaVersion": 2}'
+    assert image_metadata.get_config('some-image:latest') == mock_si.return_value
+    assert image_metadata.get_config('some-image@sha256:123456') == mock_si.return_value
+
+    mock_si.assert_called_once_with('docker://some-image@sha256:123456', '--config')
+
+
 @pytest.mark.parametrize('config_exists', (True, False))
 @pytest.mark.parametrize('template_exists', (True, False))
 @mock.patch('os.path.expanduser')
@@ -224,6 +268,199 @@ def test_skopeo_inspect(mock_run_cmd):
     assert skopeo_args == expected
 
 
+@pytest.mark.parametrize(
+    'args, expected',
+    (
+        (
+            ('docker://quay.io/ns/image:latest', '--raw'),
+            ('docker://quay.io/ns/image:latest --raw', False),
+        ),
+        (
+            ('docker://quay.io/ns/image@sha256:abcdef', '--config'),
+            ('sha256:abcdef --config', True),
+        ),
+        (('docker://quay.io/ns/image:latest',), (None, False)),
+        (('docker://quay.io/ns/image:latest', '--tls-verify=false'), (None, False)),
+        (('oci:/some/path', '--raw'), (None, False)),
+    ),
+)
+def test_get_skopeo_cache_key(args, expected):
+    assert utils._get_skopeo_cache_key(args) == expected
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_digest(mock_run_cmd, mock_cache):
+    mock_run_cmd.return_value = '{"schemaVersion": 2}'
+    image = 'docker://quay.io/ns/image@sha256:abcdef'
+
+    assert utils.skopeo_inspect(image, '--raw') == {'schemaVersion': 2}
+    # Digests are immutable, so the same digest in a different repository is a cache hit
+    assert utils.skopeo_inspect(
+        'docker://quay.io/other/image@sha256:abcdef', '--raw', return_json=False
+    ) == ('{"schemaVersion": 2}')
+    mock_run_cmd.assert_called_once()
+
+    # A different mode is a cache miss
+    utils.skopeo_inspect(image, '--config')
+    assert mock_run_cmd.call_count == 2
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.time.time')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_tag_ttl(mock_run_cmd, mock_time, mock_cache):
+    mock_run_cmd.side_effect = ['{"version": 1}', '{"version": 2}', '{"version": 3}']
+    mock_time.return_value = 1000
+    image = 'docker://quay.io/ns/image:latest'
+
+    assert utils.skopeo_inspect(image, '--raw') == {'version': 1}
+    mock_time.return_value = 1010
+    assert utils.skopeo_inspect(image, '--raw') == {'version': 1}
+    # The entry has expired since the default TTL is 30 seconds
+    mock_time.return_value = 1031
+    assert utils.skopeo_inspect(image, '--raw') == {'version': 2}
+    # The cache is bypassed but it's still updated
+    assert utils.skopeo_inspect(image, '--raw', use_cache=False) == {'version': 3}
+    assert utils.skopeo_inspect(image, '--raw') == {'version': 3}
+    assert mock_run_cmd.call_count == 3
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.get_worker_config')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_max_entries(mock_run_cmd, mock_gwc, mock_cache):
+    mock_gwc.return_value = mock.Mock(
+        iib_skopeo_cache_dir=None,
+        iib_use_registry_client=False,
+        iib_skopeo_cache_max_entries=2,
+        iib_skopeo_cache_tag_ttl=30,
+        iib_skopeo_timeout='300s',
+    )
+    mock_run_cmd.return_value = '{}'
+
+    for digest in ('sha256:1', 'sha256:2', 'sha256:1', 'sha256:3'):
+        utils.skopeo_inspect(f'docker://quay.io/ns/image@{digest}', '--raw')
+
+    assert mock_run_cmd.call_count == 3
+    # sha256:2 was the least recently used entry, so it was evicted
+    assert list(mock_cache.keys()) == ['sha256:1 --raw', 'sha256:3 --raw']
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.get_worker_config')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_on_disk(mock_run_cmd, mock_gwc, mock_cache, tmpdir):
+    mock_gwc.return_value = mock.Mock(
+        iib_skopeo_cache_dir=str(tmpdir),
+        iib_use_registry_client=False,
+        iib_skopeo_cache_max_entries=2048,
+        iib_skopeo_cache_max_files=10000,
+        iib_skopeo_cache_tag_ttl=30,
+        iib_skopeo_timeout='300s',
+    )
+    mock_run_cmd.return_value = '{"config": {"Labels": {}}}'
+    image = 'docker://quay.io/ns/image@sha256:abcdef'
+
+    utils.skopeo_inspect(image, '--config')
+    assert len(tmpdir.listdir()) == 1
+
+    # Simulate a new worker process with an empty in-process cache
+    mock_cache.clear()
+    assert utils.skopeo_inspect(image, '--config') == {'config': {'Labels': {}}}
+    mock_run_cmd.assert_called_once()
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.get_worker_config')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_on_disk_pruned(mock_run_cmd, mock_gwc, mock_cache, tmpdir):
+    mock_gwc.return_value = mock.Mock(
+        iib_skopeo_cache_dir=str(tmpdir),
+        iib_use_registry_client=False,
+        iib_skopeo_cache_max_entries=2048,
+        iib_skopeo_cache_max_files=2,
+        iib_skopeo_cache_tag_ttl=30,
+        iib_skopeo_timeout='300s',
+    )
+    mock_run_cmd.return_value = '{}'
+    now = time.time()
+
+    utils.skopeo_inspect('docker://quay.io/ns/image:latest', '--raw')
+    utils.skopeo_inspect('docker://quay.io/ns/image@sha256:1', '--raw')
+    tag_entry, digest_entry = sorted(tmpdir.listdir(), key=lambda path: path.basename, reverse=True)
+    assert tag_entry.basename.startswith('tag-')
+    assert digest_entry.basename.startswith('digest-')
+    # The tag entry is expired and the digest entry is the oldest one
+    os.utime(str(tag_entry), (now - 60, now - 60))
+    os.utime(str(digest_entry), (now - 10, now - 10))
+
+    utils.skopeo_inspect('docker://quay.io/ns/image@sha256:2', '--raw')
+    assert len(tmpdir.listdir()) == 2
+    assert not tag_entry.exists()
+    utils.skopeo_inspect('docker://quay.io/ns/image@sha256:3', '--raw')
+    assert len(tmpdir.listdir()) == 2
+    assert not digest_entry.exists()
+
+
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.get_worker_config')
+@mock.patch('iib.workers.tasks.utils.os.replace')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_cache_on_disk_write_failed(
+    mock_run_cmd, mock_replace, mock_gwc, mock_cache, tmpdir
+):
+    mock_gwc.return_value = mock.Mock(
+        iib_skopeo_cache_dir=str(tmpdir),
+        iib_use_registry_client=False,
+        iib_skopeo_cache_max_entries=2048,
+        iib_skopeo_cache_max_files=10000,
+        iib_skopeo_cache_tag_ttl=30,
+        iib_skopeo_timeout='300s',
+    )
+    mock_run_cmd.return_value = '{}'
+    mock_replace.side_effect = OSError('No space left on device')
+
+    # Failing to write the cache entry isn't fatal and the temporary file is removed
+    assert utils.skopeo_inspect('docker://quay.io/ns/image@sha256:1', '--raw') == {}
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.parametrize('config', ('{"architecture": "amd64"}', None))
+@mock.patch.object(utils, '_skopeo_inspect_cache', new_callable=OrderedDict)
+@mock.patch('iib.workers.tasks.utils.get_worker_config')
+@mock.patch('iib.workers.tasks.utils.get_registry_client')
+@mock.patch('iib.workers.tasks.utils.run_cmd')
+def test_skopeo_inspect_registry_client(mock_run_cmd, mock_grc, mock_gwc, mock_cache, config):
+    mock_gwc.return_value = mock.Mock(
+        iib_skopeo_cache_dir=None,
+        iib_use_registry_client=True,
+        iib_skopeo_cache_max_entries=2048,
+        iib_skopeo_cache_tag_ttl=30,
+        iib_skopeo_timeout='300s',
+    )
+    mock_grc.return_value.get_manifest.return_value = '{"schemaVersion": 2}'
+    mock_grc.return_value.get_config.return_value = config
+    mock_run_cmd.return_value = '{"architecture": "s390x"}'
+
+    assert utils.skopeo_inspect('docker://quay.io/ns/image:latest', '--raw') == {'schemaVersion': 2}
+    mock_grc.return_value.get_manifest.assert_called_once_with('quay.io/ns/image:latest')
+
+    rv = utils.skopeo_inspect('docker://quay.io/ns/image:latest', '--config')
+    mock_grc.return_value.get_config.assert_called_once_with('quay.io/ns/image:latest')
+    if config:
+        assert rv == {'architecture': 'amd64'}
+        mock_run_cmd.assert_not_called()
+    else:
+        # Schema 1 images fall back to skopeo
+        assert rv == {'architecture': 's390x'}
+        mock_run_cmd.assert_called_once()
+
+    # Arguments not supported by the registry client still use skopeo
+    utils.skopeo_inspect('docker://quay.io/ns/image:latest')
+    assert mock_run_cmd.call_args[0][0][-1] == 'docker://quay.io/ns/image:latest'
+
+
 @mock.patch('iib.workers.tasks.utils.run_cmd')
 def test_podman_pull(mock_run_cmd):
     image = 'some-image:latest'
@@ -259,6 +496,20 @@ def test_request_logger(tmpdir):
     assert original_handlers_count == len(logging.getLogger().handlers)
 
 
+@mock.patch('iib.workers.api_utils.requests_auth_session')
+def test_request_updates_buffered(mock_session):
+    @utils.request_updates_buffered
+    def mock_handler(spam, request_id):
+        set_request_state(request_id, 'in_progress', 'Resolving the bundles')
+        set_request_state(request_id, 'in_progress', 'Building the index image')
+        mock_session.patch.assert_not_called()
+
+    mock_handler('spam', request_id=3)
+
+    mock_session.patch.assert_called_once()
+    assert mock_session.patch.call_args[0][0] == 'http://iib-api:8080/api/v1/builds/3/updates'
+
+
 def test_request_logger_no_request_id(tmpdir):
     logs_dir = tmpdir.join('logs')
     logs_dir.mkdir()